@@ -0,0 +1,58 @@
+import time
+
+import torch
+from transformers import ElectraConfig
+
+from simpletransformers.custom_models.models import ElectraForLanguageModelingModel
+
+# Measures the time taken to sample the generator tokens of an ELECTRA pretraining step. The previous implementation
+# (softmax and multinomial over the full vocabulary at every position) is compared with sampling only the masked
+# positions, with multinomial and Gumbel-max sampling. Set "device" to "cuda" to benchmark on GPU.
+device = "cpu"
+batch_size = 16
+seq_length = 512
+vocab_size = 52000
+mlm_probability = 0.15
+n_warmup = 2
+n_steps = 10
+
+config = ElectraConfig(
+    vocab_size=vocab_size, embedding_size=128, hidden_size=64, num_hidden_layers=1, num_attention_heads=1
+)
+model = ElectraForLanguageModelingModel(config).to(device)
+
+logits = torch.randn(batch_size, seq_length, vocab_size, device=device)
+mask = torch.rand(batch_size, seq_length, device=device) < mlm_probability
+
+
+def sample_all_positions():
+    sample_probs = torch.softmax(logits, dim=-1, dtype=torch.float32).view(-1, vocab_size)
+    return torch.multinomial(sample_probs, 1).view(batch_size, -1)[mask]
+
+
+def sample_masked_positions(sampling):
+    model.sampling = sampling
+    return model.sample_tokens(logits[mask])
+
+
+def benchmark(sample):
+    for _ in range(n_warmup):
+        sample()
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        sample()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_steps * 1000
+
+
+all_positions = benchmark(sample_all_positions)
+masked_multinomial = benchmark(lambda: sample_masked_positions("multinomial"))
+masked_gumbel = benchmark(lambda: sample_masked_positions("gumbel"))
+
+print(f"All positions, multinomial:    {all_positions:8.2f} ms")
+print(f"Masked positions, multinomial: {masked_multinomial:8.2f} ms")
+print(f"Masked positions, Gumbel-max:  {masked_gumbel:8.2f} ms")
@@ -0,0 +1,46 @@
+import time
+
+import torch
+from torch.utils.data import DataLoader, RandomSampler, TensorDataset
+
+from simpletransformers.dataloader_utils import TensorBatchSampler, get_batch_sliced_dataloader
+
+# Measures the training step time of a small model on TensorDataset features loaded with the default DataLoader
+# (indexing each example, then stacking the examples of a batch) and with batch slicing (one index_select per tensor).
+# The smaller the model and the larger the batch, the larger the share of the step time spent loading the batch.
+n_examples = 16384
+max_seq_length = 128
+vocab_size = 30000
+args = {"dataloader_num_workers": 0, "pin_memory": False, "prefetch_factor": None, "persistent_workers": False}
+
+dataset = TensorDataset(
+    torch.randint(vocab_size, (n_examples, max_seq_length)),
+    torch.ones(n_examples, max_seq_length, dtype=torch.long),
+    torch.zeros(n_examples, max_seq_length, dtype=torch.long),
+    torch.randint(2, (n_examples,)),
+)
+
+model = torch.nn.Sequential(torch.nn.EmbeddingBag(vocab_size, 64), torch.nn.Linear(64, 2))
+optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+
+
+def benchmark(dataloader):
+    start = time.perf_counter()
+    for input_ids, input_mask, segment_ids, label_ids in dataloader:
+        loss = torch.nn.functional.cross_entropy(model(input_ids), label_ids)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    return (time.perf_counter() - start) / len(dataloader) * 1000
+
+
+for batch_size in [32, 128, 512]:
+    default_loader = DataLoader(dataset, sampler=RandomSampler(dataset), batch_size=batch_size)
+    sliced_loader = get_batch_sliced_dataloader(dataset, TensorBatchSampler(n_examples, batch_size, shuffle=True), args)
+
+    default_step = benchmark(default_loader)
+    sliced_step = benchmark(sliced_loader)
+    print(
+        f"Batch size {batch_size:4d}: default {default_step:7.2f} ms/step, batch slicing {sliced_step:7.2f} ms/step"
+        f" ({default_step / sliced_step:.1f}x)"
+    )
@@ -0,0 +1,36 @@
+import time
+
+import numpy as np
+
+from simpletransformers.classification import ClassificationModel
+
+# Measures the latency of single sentence predictions with the in-process fast path of predict(), and with the regular
+# path (feature conversion in the worker pool, DataLoader, progress bars). Set "use_cuda" to True to benchmark on GPU.
+n_warmup = 5
+n_requests = 200
+sentence = "Example sentence to be classified by a model serving online requests."
+
+model = ClassificationModel("roberta", "roberta-base", use_cuda=False, args={"silent": True})
+
+
+def benchmark(fast_predict_max_examples):
+    model.args["fast_predict_max_examples"] = fast_predict_max_examples
+    for _ in range(n_warmup):
+        model.predict([sentence])
+
+    latencies = []
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        model.predict([sentence])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+regular_p50, regular_p99 = benchmark(fast_predict_max_examples=0)
+fast_p50, fast_p99 = benchmark(fast_predict_max_examples=32)
+
+print(f"Regular predict:   p50 {regular_p50:8.2f} ms   p99 {regular_p99:8.2f} ms")
+print(f"Fast path predict: p50 {fast_p50:8.2f} ms   p99 {fast_p99:8.2f} ms")
+
+model.tokenization_pool.close()
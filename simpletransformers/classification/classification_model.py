@@ -4,6 +4,7 @@
 
 from __future__ import absolute_import, division, print_function
 
+import functools
 import json
 import logging
 import math
@@ -13,7 +14,7 @@ import warnings
 from multiprocessing import cpu_count
 
 import numpy as np
-from scipy.stats import mode, pearsonr
+from scipy.stats import pearsonr
 from sklearn.metrics import (
     confusion_matrix,
     label_ranking_average_precision_score,
@@ -24,7 +25,15 @@ from tqdm.auto import tqdm, trange
 
 import pandas as pd
 import torch
-from simpletransformers.classification.classification_utils import InputExample, convert_examples_to_features
+from simpletransformers.classification.classification_utils import (
+    InputExample,
+    LengthBucketBatchSampler,
+    aggregate_sliding_window_predictions,
+    convert_examples_to_arrays,
+    convert_examples_to_features,
+    convert_features_to_arrays,
+    trim_batch_padding,
+)
 from simpletransformers.classification.transformer_models.albert_model import AlbertForSequenceClassification
 from simpletransformers.classification.transformer_models.bert_model import BertForSequenceClassification
 from simpletransformers.classification.transformer_models.camembert_model import CamembertForSequenceClassification
@@ -36,8 +45,18 @@ from simpletransformers.classification.transformer_models.xlm_roberta_model impo
 from simpletransformers.classification.transformer_models.xlnet_model import XLNetForSequenceClassification
 from simpletransformers.config.global_args import global_args
 from simpletransformers.custom_models.models import ElectraForSequenceClassification
+from simpletransformers.dataloader_utils import TensorBatchSampler, get_batch_sliced_dataloader
+from simpletransformers.feature_cache import (
+    FeatureStore,
+    get_cache_key,
+    get_example_digests,
+    hash_tokenizer,
+    load_feature_arrays,
+    save_feature_arrays,
+)
+from simpletransformers.tokenization_pool import TokenizationPool
 from tensorboardX import SummaryWriter
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from transformers import (
     WEIGHTS_NAME,
@@ -46,16 +65,20 @@ from transformers import (
     AlbertTokenizer,
     BertConfig,
     BertTokenizer,
+    BertTokenizerFast,
     CamembertConfig,
     CamembertTokenizer,
     DistilBertConfig,
     DistilBertTokenizer,
+    DistilBertTokenizerFast,
     ElectraConfig,
     ElectraTokenizer,
+    ElectraTokenizerFast,
     FlaubertConfig,
     FlaubertTokenizer,
     RobertaConfig,
     RobertaTokenizer,
+    RobertaTokenizerFast,
     XLMConfig,
     XLMRobertaConfig,
     XLMRobertaTokenizer,
@@ -74,6 +97,13 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+FAST_TOKENIZER_CLASSES = {
+    "bert": BertTokenizerFast,
+    "distilbert": DistilBertTokenizerFast,
+    "electra": ElectraTokenizerFast,
+    "roberta": RobertaTokenizerFast,
+}
+
 
 class ClassificationModel:
     def __init__(
@@ -118,7 +148,13 @@ class ClassificationModel:
             "sliding_window": False,
             "tie_value": 1,
             "stride": 0.8,
+            "sliding_window_aggregation": "mode",
             "regression": False,
+            "use_fast_tokenizer": False,
+            "dynamic_padding": False,
+            "length_bucketing": False,
+            "fast_predict_max_examples": 32,
+            "hidden_states_memmap_dir": None,
         }
 
         self.args.update(global_args)
@@ -161,6 +197,8 @@ class ClassificationModel:
             self.model = model_class.from_pretrained(model_name, config=self.config, **kwargs)
 
         self.results = {}
+        self.tokenization_pool = TokenizationPool()
+        self.eval_data_cache = None
 
         if not use_cuda:
             self.args["fp16"] = False
@@ -259,15 +297,23 @@ class ClassificationModel:
 
         os.makedirs(output_dir, exist_ok=True)
 
-        global_step, tr_loss = self.train(
-            train_dataset,
-            output_dir,
-            multi_label=multi_label,
-            show_running_loss=show_running_loss,
-            eval_df=eval_df,
-            verbose=verbose,
-            **kwargs,
-        )
+        if self.args["evaluate_during_training"]:
+            # The eval dataset is built once and reused by every evaluation of this train_model() call, so
+            # changes made to the eval data during training are not seen
+            self.eval_data_cache = self._get_eval_data(eval_df, verbose=verbose, silent=True)
+
+        try:
+            global_step, tr_loss = self.train(
+                train_dataset,
+                output_dir,
+                multi_label=multi_label,
+                show_running_loss=show_running_loss,
+                eval_df=eval_df,
+                verbose=verbose,
+                **kwargs,
+            )
+        finally:
+            self.eval_data_cache = None
 
         model_to_save = self.model.module if hasattr(self.model, "module") else self.model
         model_to_save.save_pretrained(output_dir)
@@ -298,8 +344,7 @@ class ClassificationModel:
         args = self.args
 
         tb_writer = SummaryWriter(logdir=args["tensorboard_dir"])
-        train_sampler = RandomSampler(train_dataset)
-        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args["train_batch_size"])
+        train_dataloader = self._get_dataloader(train_dataset, args["train_batch_size"], shuffle=True)
 
         t_total = len(train_dataloader) // args["gradient_accumulation_steps"] * args["num_train_epochs"]
 
@@ -651,42 +696,15 @@ class ClassificationModel:
 
         results = {}
 
-        if "text" in eval_df.columns and "labels" in eval_df.columns:
-            eval_examples = [
-                InputExample(i, text, None, label)
-                for i, (text, label) in enumerate(zip(eval_df["text"], eval_df["labels"]))
-            ]
-        elif "text_a" in eval_df.columns and "text_b" in eval_df.columns:
-            eval_examples = [
-                InputExample(i, text_a, text_b, label)
-                for i, (text_a, text_b, label) in enumerate(
-                    zip(eval_df["text_a"], eval_df["text_b"], eval_df["labels"])
-                )
-            ]
-        else:
-            warnings.warn(
-                "Dataframe headers not specified. Falling back to using column 0 as text and column 1 as labels."
-            )
-            eval_examples = [
-                InputExample(i, text, None, label)
-                for i, (text, label) in enumerate(zip(eval_df.iloc[:, 0], eval_df.iloc[:, 1]))
-            ]
-
-        if args["sliding_window"]:
-            eval_dataset, window_counts = self.load_and_cache_examples(
-                eval_examples, evaluate=True, verbose=verbose, silent=silent
-            )
-        else:
-            eval_dataset = self.load_and_cache_examples(eval_examples, evaluate=True, verbose=verbose, silent=silent)
+        eval_examples, eval_dataset, window_counts = self._get_eval_data(eval_df, verbose=verbose, silent=silent)
         os.makedirs(eval_output_dir, exist_ok=True)
 
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"])
+        eval_dataloader = self._get_dataloader(eval_dataset, args["eval_batch_size"])
 
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
+        preds = []
+        out_label_ids = []
         model.eval()
 
         for batch in tqdm(eval_dataloader, disable=args["silent"] or silent):
@@ -704,38 +722,22 @@ class ClassificationModel:
 
             nb_eval_steps += 1
 
-            if preds is None:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = inputs["labels"].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+            preds.append(logits.detach().cpu().numpy())
+            out_label_ids.append(inputs["labels"].detach().cpu().numpy())
 
         eval_loss = eval_loss / nb_eval_steps
+        preds = np.concatenate(preds)
+        out_label_ids = np.concatenate(out_label_ids)
+        preds, out_label_ids = self._restore_dataset_order(eval_dataloader, preds, out_label_ids)
 
         if args["sliding_window"]:
-            count = 0
-            window_ranges = []
-            for n_windows in window_counts:
-                window_ranges.append([count, count + n_windows])
-                count += n_windows
-
-            preds = [preds[window_range[0] : window_range[1]] for window_range in window_ranges]
-            out_label_ids = [
-                out_label_ids[i] for i in range(len(out_label_ids)) if i in [window[0] for window in window_ranges]
-            ]
-
-            model_outputs = preds
-
-            preds = [np.argmax(pred, axis=1) for pred in preds]
-            final_preds = []
-            for pred_row in preds:
-                mode_pred, counts = mode(pred_row)
-                if len(counts) > 1 and counts[0] == counts[1]:
-                    final_preds.append(args["tie_value"])
-                else:
-                    final_preds.append(mode_pred[0])
-            preds = np.array(final_preds)
+            window_preds = preds
+            preds, window_starts = aggregate_sliding_window_predictions(
+                window_preds, window_counts, args["sliding_window_aggregation"], args["tie_value"]
+            )
+            # Every window of an example has the label of the example
+            out_label_ids = out_label_ids[window_starts]
+            model_outputs = np.split(window_preds, window_starts[1:])
         elif not multi_label and args["regression"] is True:
             preds = np.squeeze(preds)
             model_outputs = preds
@@ -756,17 +758,62 @@ class ClassificationModel:
 
         return results, model_outputs, wrong
 
+    def _get_eval_data(self, eval_df, verbose=True, silent=False):
+        """
+        Returns the eval examples, the eval dataset, and the window counts (None without sliding windows) for eval_df.
+        While train_model() runs, the eval data it built when it started is returned instead of being built again.
+
+        Utility function for evaluate(). Not intended to be used directly.
+        """  # noqa: ignore flake8"
+
+        if self.eval_data_cache is not None:
+            return self.eval_data_cache
+
+        if "text" in eval_df.columns and "labels" in eval_df.columns:
+            eval_examples = [
+                InputExample(i, text, None, label)
+                for i, (text, label) in enumerate(zip(eval_df["text"], eval_df["labels"]))
+            ]
+        elif "text_a" in eval_df.columns and "text_b" in eval_df.columns:
+            eval_examples = [
+                InputExample(i, text_a, text_b, label)
+                for i, (text_a, text_b, label) in enumerate(
+                    zip(eval_df["text_a"], eval_df["text_b"], eval_df["labels"])
+                )
+            ]
+        else:
+            warnings.warn(
+                "Dataframe headers not specified. Falling back to using column 0 as text and column 1 as labels."
+            )
+            eval_examples = [
+                InputExample(i, text, None, label)
+                for i, (text, label) in enumerate(zip(eval_df.iloc[:, 0], eval_df.iloc[:, 1]))
+            ]
+
+        if self.args["sliding_window"]:
+            eval_dataset, window_counts = self.load_and_cache_examples(
+                eval_examples, evaluate=True, verbose=verbose, silent=silent
+            )
+        else:
+            eval_dataset = self.load_and_cache_examples(eval_examples, evaluate=True, verbose=verbose, silent=silent)
+            window_counts = None
+
+        return eval_examples, eval_dataset, window_counts
+
     def load_and_cache_examples(
         self, examples, evaluate=False, no_cache=False, multi_label=False, verbose=True, silent=False
     ):
         """
-        Converts a list of InputExample objects to a TensorDataset containing InputFeatures. Caches the InputFeatures.
+        Converts a list of InputExample objects to a TensorDataset containing InputFeatures. Caches the features as
+        memory-mapped arrays in a directory under cache_dir.
+
+        The cache is keyed by the tokenizer, the feature conversion args and the contents of the examples. When cached
+        features are used, the features of each example are also kept in a per-example feature store so that only new
+        or changed examples are converted.
 
         Utility function for train() and eval() methods. Not intended to be used directly.
         """
 
-        process_count = self.args["process_count"]
-
         tokenizer = self.tokenizer
         args = self.args
 
@@ -778,32 +825,111 @@ class ClassificationModel:
         else:
             output_mode = "classification"
 
-        os.makedirs(self.args["cache_dir"], exist_ok=True)
-
         mode = "dev" if evaluate else "train"
-        cached_features_file = os.path.join(
-            args["cache_dir"],
-            "cached_{}_{}_{}_{}_{}".format(
-                mode, args["model_type"], args["max_seq_length"], self.num_labels, len(examples),
-            ),
+        use_cached_features = not no_cache and (
+            not args["reprocess_input_data"] or (mode == "dev" and args["use_cached_eval_features"])
         )
 
-        if os.path.exists(cached_features_file) and (
-            (not args["reprocess_input_data"] and not no_cache)
-            or (mode == "dev" and args["use_cached_eval_features"] and not no_cache)
-        ):
-            features = torch.load(cached_features_file)
+        if not no_cache:
+            os.makedirs(self.args["cache_dir"], exist_ok=True)
+
+            conversion_key = get_cache_key(
+                hash_tokenizer(tokenizer),
+                args["model_type"],
+                args["max_seq_length"],
+                output_mode,
+                args["sliding_window"],
+                args["stride"],
+                args["use_fast_tokenizer"],
+            )
+            example_digests = get_example_digests((e.text_a, e.text_b, e.label) for e in examples)
+            cached_features_file = os.path.join(
+                args["cache_dir"],
+                "cached_{}_{}_{}_{}_{}".format(
+                    mode,
+                    args["model_type"],
+                    args["max_seq_length"],
+                    self.num_labels,
+                    get_cache_key(conversion_key, example_digests),
+                ),
+            )
+
+        if use_cached_features and os.path.isdir(cached_features_file):
+            feature_arrays, window_counts = load_feature_arrays(cached_features_file)
             if verbose:
                 logger.info(f" Features loaded from cache at {cached_features_file}")
         else:
-            if verbose:
-                logger.info(f" Converting to features started. Cache is not used.")
-                if args["sliding_window"]:
-                    logger.info(" Sliding window enabled")
-            features = convert_examples_to_features(
+            if use_cached_features:
+                feature_store = FeatureStore(os.path.join(args["cache_dir"], "feature_store_" + conversion_key))
+                positions = feature_store.lookup(example_digests)
+
+                # Duplicate examples only need to be converted once
+                new_examples = np.flatnonzero(positions < 0)
+                new_examples = np.sort(new_examples[np.unique(example_digests[new_examples], return_index=True)[1]])
+                if verbose:
+                    logger.info(
+                        f" Reusing features of {np.count_nonzero(positions >= 0)} examples from the feature store."
+                    )
+
+                if len(new_examples) > 0:
+                    new_feature_arrays, new_window_counts = self._convert_examples_to_feature_arrays(
+                        [examples[i] for i in new_examples], output_mode, multi_label, verbose, silent
+                    )
+                    if new_window_counts is None:
+                        new_window_counts = [1] * len(new_examples)
+                    feature_store.add(example_digests[new_examples], new_feature_arrays, new_window_counts)
+                    positions = feature_store.lookup(example_digests)
+
+                if args["feature_store_max_examples"] and len(feature_store) > args["feature_store_max_examples"]:
+                    # Only the examples of this call are kept
+                    feature_store.compact(example_digests)
+                    positions = feature_store.lookup(example_digests)
+
+                feature_arrays, window_counts = feature_store.gather(positions)
+                if not args["sliding_window"]:
+                    window_counts = None
+            else:
+                feature_arrays, window_counts = self._convert_examples_to_feature_arrays(
+                    examples, output_mode, multi_label, verbose, silent
+                )
+
+            if not no_cache:
+                save_feature_arrays(cached_features_file, feature_arrays, window_counts)
+                # Reopen the arrays memory-mapped so that the in-memory copies can be released
+                feature_arrays, window_counts = load_feature_arrays(cached_features_file)
+
+        dataset = TensorDataset(*(torch.from_numpy(array) for array in feature_arrays))
+
+        if args["sliding_window"] and evaluate:
+            return dataset, window_counts
+        else:
+            return dataset
+
+    def _convert_examples_to_feature_arrays(
+        self, examples, output_mode, multi_label=False, verbose=True, silent=False
+    ):
+        """
+        Converts a list of InputExample objects to feature arrays (input_ids, input_mask, segment_ids, label_ids).
+
+        Returns the feature arrays, and the number of sliding windows for each example if sliding_window is enabled
+        (None otherwise).
+
+        Utility function for load_and_cache_examples(). Not intended to be used directly.
+        """
+
+        tokenizer = self.tokenizer
+        args = self.args
+
+        if verbose:
+            logger.info(f" Converting to features started. Cache is not used.")
+            if args["sliding_window"]:
+                logger.info(" Sliding window enabled")
+
+        if args["use_fast_tokenizer"] and not args["sliding_window"]:
+            feature_arrays = convert_examples_to_arrays(
                 examples,
                 args["max_seq_length"],
-                tokenizer,
+                self._get_fast_tokenizer(),
                 output_mode,
                 # XLNet has a CLS token at the end
                 cls_token_at_end=bool(args["model_type"] in ["xlnet"]),
@@ -817,39 +943,46 @@ class ClassificationModel:
                 pad_on_left=bool(args["model_type"] in ["xlnet"]),
                 pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
                 pad_token_segment_id=4 if args["model_type"] in ["xlnet"] else 0,
-                process_count=process_count,
                 multi_label=multi_label,
                 silent=args["silent"] or silent,
-                use_multiprocessing=args["use_multiprocessing"],
-                sliding_window=args["sliding_window"],
-                flatten=not evaluate,
-                stride=args["stride"],
             )
-            if verbose and args["sliding_window"]:
-                logger.info(f" {len(features)} features created from {len(examples)} samples.")
-
-            if not no_cache:
-                torch.save(features, cached_features_file)
+            return feature_arrays, None
+
+        features = convert_examples_to_features(
+            examples,
+            args["max_seq_length"],
+            tokenizer,
+            output_mode,
+            # XLNet has a CLS token at the end
+            cls_token_at_end=bool(args["model_type"] in ["xlnet"]),
+            cls_token=tokenizer.cls_token,
+            cls_token_segment_id=2 if args["model_type"] in ["xlnet"] else 0,
+            sep_token=tokenizer.sep_token,
+            # RoBERTa uses an extra separator b/w pairs of sentences,
+            # cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
+            sep_token_extra=bool(args["model_type"] in ["roberta", "camembert", "xlmroberta"]),
+            # PAD on the left for XLNet
+            pad_on_left=bool(args["model_type"] in ["xlnet"]),
+            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+            pad_token_segment_id=4 if args["model_type"] in ["xlnet"] else 0,
+            process_count=args["process_count"],
+            multi_label=multi_label,
+            silent=args["silent"] or silent,
+            use_multiprocessing=args["use_multiprocessing"],
+            sliding_window=args["sliding_window"],
+            flatten=False,
+            stride=args["stride"],
+            pool=self.tokenization_pool,
+        )
 
-        if args["sliding_window"] and evaluate:
-            window_counts = [len(sample) for sample in features]
+        window_counts = None
+        if args["sliding_window"]:
+            window_counts = [len(feature_set) for feature_set in features]
             features = [feature for feature_set in features for feature in feature_set]
+            if verbose:
+                logger.info(f" {len(features)} features created from {len(examples)} samples.")
 
-        all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-
-        if output_mode == "classification":
-            all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
-        elif output_mode == "regression":
-            all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.float)
-
-        dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-
-        if args["sliding_window"] and evaluate:
-            return dataset, window_counts
-        else:
-            return dataset
+        return convert_features_to_arrays(features, output_mode), window_counts
 
     def compute_metrics(self, preds, labels, eval_examples, multi_label=False, **kwargs):
         """
@@ -921,6 +1054,14 @@ class ClassificationModel:
                 eval_examples = [InputExample(i, text[0], text[1], 0) for i, text in enumerate(to_predict)]
             else:
                 eval_examples = [InputExample(i, text, None, 0) for i, text in enumerate(to_predict)]
+
+        if (
+            len(eval_examples) <= args["fast_predict_max_examples"]
+            and not args["sliding_window"]
+            and not self.config.output_hidden_states
+        ):
+            return self._predict_in_process(eval_examples, multi_label)
+
         if args["sliding_window"]:
             eval_dataset, window_counts = self.load_and_cache_examples(eval_examples, evaluate=True, no_cache=True)
         else:
@@ -928,15 +1069,22 @@ class ClassificationModel:
                 eval_examples, evaluate=True, multi_label=multi_label, no_cache=True
             )
 
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"])
+        if self.config.output_hidden_states:
+            # Hidden states of different batches are concatenated, so every batch must be padded to the same length
+            eval_sampler = TensorBatchSampler(len(eval_dataset), args["eval_batch_size"])
+            eval_dataloader = get_batch_sliced_dataloader(eval_dataset, eval_sampler, args)
+        else:
+            eval_dataloader = self._get_dataloader(eval_dataset, args["eval_batch_size"])
 
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
+        preds = []
+        out_label_ids = []
 
         if self.config.output_hidden_states:
+            all_embedding_outputs = None
+            all_layer_hidden_states = None
+            row = 0
             for batch in tqdm(eval_dataloader, disable=args["silent"]):
                 model.eval()
                 batch = tuple(t.to(device) for t in batch)
@@ -954,18 +1102,30 @@ class ClassificationModel:
 
                 nb_eval_steps += 1
 
-                if preds is None:
-                    preds = logits.detach().cpu().numpy()
-                    out_label_ids = inputs["labels"].detach().cpu().numpy()
-                    all_layer_hidden_states = [state.detach().cpu().numpy() for state in layer_hidden_states]
-                    all_embedding_outputs = embedding_outputs.detach().cpu().numpy()
-                else:
-                    preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                    out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
-                    all_layer_hidden_states = np.append(
-                        [state.detach().cpu().numpy() for state in layer_hidden_states], axis=0
+                preds.append(logits.detach().cpu().numpy())
+                out_label_ids.append(inputs["labels"].detach().cpu().numpy())
+                embedding_outputs = embedding_outputs.detach().cpu().numpy()
+                layer_hidden_states = np.stack([state.detach().cpu().numpy() for state in layer_hidden_states])
+
+                if all_embedding_outputs is None:
+                    all_embedding_outputs = self._allocate_hidden_states_array(
+                        "embedding_outputs",
+                        (len(eval_dataset),) + embedding_outputs.shape[1:],
+                        embedding_outputs.dtype,
+                    )
+                    all_layer_hidden_states = self._allocate_hidden_states_array(
+                        "layer_hidden_states",
+                        (len(layer_hidden_states), len(eval_dataset)) + layer_hidden_states.shape[2:],
+                        layer_hidden_states.dtype,
                     )
-                    all_embedding_outputs = np.append(embedding_outputs.detach().cpu().numpy(), axis=0)
+
+                all_embedding_outputs[row : row + len(logits)] = embedding_outputs
+                all_layer_hidden_states[:, row : row + len(logits)] = layer_hidden_states
+                row += len(logits)
+
+            if args["hidden_states_memmap_dir"]:
+                all_embedding_outputs.flush()
+                all_layer_hidden_states.flush()
         else:
             for batch in tqdm(eval_dataloader, disable=args["silent"]):
                 model.eval()
@@ -983,35 +1143,20 @@ class ClassificationModel:
 
                 nb_eval_steps += 1
 
-                if preds is None:
-                    preds = logits.detach().cpu().numpy()
-                    out_label_ids = inputs["labels"].detach().cpu().numpy()
-                else:
-                    preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                    out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+                preds.append(logits.detach().cpu().numpy())
+                out_label_ids.append(inputs["labels"].detach().cpu().numpy())
 
         eval_loss = eval_loss / nb_eval_steps
+        preds = np.concatenate(preds)
+        out_label_ids = np.concatenate(out_label_ids)
+        preds, out_label_ids = self._restore_dataset_order(eval_dataloader, preds, out_label_ids)
 
         if args["sliding_window"]:
-            count = 0
-            window_ranges = []
-            for n_windows in window_counts:
-                window_ranges.append([count, count + n_windows])
-                count += n_windows
-
-            preds = [preds[window_range[0] : window_range[1]] for window_range in window_ranges]
-
-            model_outputs = preds
-
-            preds = [np.argmax(pred, axis=1) for pred in preds]
-            final_preds = []
-            for pred_row in preds:
-                mode_pred, counts = mode(pred_row)
-                if len(counts) > 1 and counts[0] == counts[1]:
-                    final_preds.append(args["tie_value"])
-                else:
-                    final_preds.append(mode_pred[0])
-            preds = np.array(final_preds)
+            window_preds = preds
+            preds, window_starts = aggregate_sliding_window_predictions(
+                window_preds, window_counts, args["sliding_window_aggregation"], args["tie_value"]
+            )
+            model_outputs = np.split(window_preds, window_starts[1:])
         elif not multi_label and args["regression"] is True:
             preds = np.squeeze(preds)
             model_outputs = preds
@@ -1034,14 +1179,299 @@ class ClassificationModel:
         else:
             return preds, model_outputs
 
+    def extract_embeddings(
+        self, to_predict, output_file=None, pooling="cls", layers=None, dtype="float32", chunksize=10000
+    ):
+        """
+        Computes a fixed size embedding for each text with the encoder of the model. Texts are tokenized and encoded
+        chunksize texts at a time and pooled on the device, so only the pooled embeddings are kept.
+
+        Args:
+            to_predict: A python list of text (str), or of text pairs ([text_a, text_b]), to be embedded.
+            output_file (optional): Path of a .npy file to write the embeddings to. The file is memory-mapped, so the embeddings of large datasets do not have to fit in memory. If an earlier call writing to the same output_file was interrupted, the embeddings already written are kept and only the remaining texts are encoded.
+            pooling (optional): How the token states of a text are pooled. "cls" (state of the classification token), "mean" (mean over tokens) or "max" (max over tokens).
+            layers (optional): Indices of the hidden layers to pool, e.g. [-1, -2, -3, -4]. The pooled vectors of the layers are concatenated. The model must be created with config {"output_hidden_states": True} to use this. Defaults to the last layer.
+            dtype (optional): dtype of the embeddings, "float32" or "float16".
+            chunksize (optional): Number of texts tokenized at a time. When writing to output_file, progress is saved after every chunk.
+
+        Returns:
+            embeddings: Numpy array (memory-mapped if output_file is given) of shape (len(to_predict), embedding_size).
+        """  # noqa: ignore flake8"
+
+        args = self.args
+        tokenizer = self.tokenizer
+        model = self.model.base_model
+
+        if pooling not in ["cls", "mean", "max"]:
+            raise ValueError("pooling must be one of 'cls', 'mean' or 'max'. Got: {}".format(pooling))
+        if layers is not None and not self.config.output_hidden_states:
+            raise ValueError(
+                "Selecting layers requires the hidden states of all layers."
+                " Create the model with config={'output_hidden_states': True} to use layers."
+            )
+
+        self._move_model_to_device()
+        model.eval()
+
+        embeddings = None
+        first_row = 0
+        progress_file = output_file + ".progress" if output_file else None
+        if output_file and os.path.isfile(output_file) and os.path.isfile(progress_file):
+            embeddings = np.load(output_file, mmap_mode="r+")
+            if len(embeddings) != len(to_predict) or embeddings.dtype != np.dtype(dtype):
+                raise ValueError(
+                    "The interrupted embeddings in {} do not match the texts and dtype of this call.".format(
+                        output_file
+                    )
+                )
+            with open(progress_file) as f:
+                first_row = json.load(f)["rows"]
+            logger.info(" Resuming from text %d of %d", first_row, len(to_predict))
+
+        pad_on_left = bool(args["model_type"] in ["xlnet"])
+
+        with tqdm(total=len(to_predict), initial=first_row, disable=args["silent"]) as progress_bar:
+            for chunk_start in range(first_row, len(to_predict), chunksize):
+                chunk = to_predict[chunk_start : chunk_start + chunksize]
+                if isinstance(chunk[0], list):
+                    examples = [InputExample(i, text[0], text[1], 0) for i, text in enumerate(chunk)]
+                else:
+                    examples = [InputExample(i, text, None, 0) for i, text in enumerate(chunk)]
+
+                input_ids, input_mask, segment_ids, _ = convert_examples_to_arrays(
+                    examples,
+                    args["max_seq_length"],
+                    self._get_fast_tokenizer() if args["use_fast_tokenizer"] else tokenizer,
+                    "classification",
+                    cls_token_at_end=bool(args["model_type"] in ["xlnet"]),
+                    cls_token=tokenizer.cls_token,
+                    cls_token_segment_id=2 if args["model_type"] in ["xlnet"] else 0,
+                    sep_token=tokenizer.sep_token,
+                    sep_token_extra=bool(args["model_type"] in ["roberta", "camembert", "xlmroberta"]),
+                    pad_on_left=pad_on_left,
+                    pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                    pad_token_segment_id=4 if args["model_type"] in ["xlnet"] else 0,
+                    silent=True,
+                )
+
+                # Batch texts of similar lengths together so that each batch can be padded to its longest text
+                lengths = input_mask.sum(axis=1)
+                order = np.argsort(-lengths, kind="stable")
+                for batch_start in range(0, len(order), args["eval_batch_size"]):
+                    batch_rows = order[batch_start : batch_start + args["eval_batch_size"]]
+                    max_length = max(int(lengths[batch_rows].max()), 1)
+                    if pad_on_left:
+                        sequence_slice = slice(args["max_seq_length"] - max_length, None)
+                    else:
+                        sequence_slice = slice(None, max_length)
+                    batch = tuple(
+                        torch.from_numpy(array[batch_rows, sequence_slice]).to(self.device)
+                        for array in (input_ids, input_mask, segment_ids)
+                    ) + (None,)
+
+                    with torch.no_grad():
+                        inputs = self._get_inputs_dict(batch)
+                        del inputs["labels"]
+                        outputs = model(**inputs)
+
+                        if layers is None:
+                            layer_states = [outputs[0]]
+                        else:
+                            hidden_states = outputs[-2] if self.config.output_attentions else outputs[-1]
+                            layer_states = [hidden_states[layer] for layer in layers]
+
+                        pooled = torch.cat(
+                            [
+                                self._pool_token_states(states, inputs["attention_mask"], pooling)
+                                for states in layer_states
+                            ],
+                            dim=1,
+                        )
+                        pooled = pooled.to(getattr(torch, dtype)).cpu().numpy()
+
+                    if embeddings is None:
+                        shape = (len(to_predict), pooled.shape[1])
+                        if output_file:
+                            embeddings = np.lib.format.open_memmap(output_file, mode="w+", dtype=dtype, shape=shape)
+                        else:
+                            embeddings = np.empty(shape, dtype=dtype)
+
+                    embeddings[chunk_start + batch_rows] = pooled
+                    progress_bar.update(len(batch_rows))
+
+                if output_file:
+                    embeddings.flush()
+                    with open(progress_file + ".tmp", "w") as f:
+                        json.dump({"rows": chunk_start + len(chunk)}, f)
+                    os.replace(progress_file + ".tmp", progress_file)
+
+        if output_file and os.path.isfile(progress_file):
+            os.remove(progress_file)
+
+        return embeddings
+
+    def _pool_token_states(self, states, attention_mask, pooling):
+        """
+        Pools token states of shape (batch_size, sequence_length, hidden_size) into one vector per sequence.
+
+        Utility function for extract_embeddings(). Not intended to be used directly.
+        """
+        if pooling == "cls":
+            # XLNet has the CLS token at the end, and pads on the left
+            return states[:, -1] if self.args["model_type"] in ["xlnet"] else states[:, 0]
+
+        mask = attention_mask.unsqueeze(-1).to(states.dtype)
+        if pooling == "mean":
+            return (states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        return states.masked_fill(mask == 0, float("-inf")).max(dim=1)[0]
+
+    def _predict_in_process(self, eval_examples, multi_label=False):
+        """
+        Low latency prediction for a small number of examples. The examples are batch encoded in this process, without
+        multiprocessing, feature caching or progress bars, and predicted with a single forward pass.
+
+        Utility function for predict(). Not intended to be used directly.
+        """
+
+        args = self.args
+        tokenizer = self.tokenizer
+        pad_on_left = bool(args["model_type"] in ["xlnet"])
+
+        input_ids, input_mask, segment_ids, _ = convert_examples_to_arrays(
+            eval_examples,
+            args["max_seq_length"],
+            self._get_fast_tokenizer() if args["use_fast_tokenizer"] else tokenizer,
+            "regression" if not multi_label and args["regression"] else "classification",
+            cls_token_at_end=bool(args["model_type"] in ["xlnet"]),
+            cls_token=tokenizer.cls_token,
+            cls_token_segment_id=2 if args["model_type"] in ["xlnet"] else 0,
+            sep_token=tokenizer.sep_token,
+            sep_token_extra=bool(args["model_type"] in ["roberta", "camembert", "xlmroberta"]),
+            pad_on_left=pad_on_left,
+            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+            pad_token_segment_id=4 if args["model_type"] in ["xlnet"] else 0,
+            multi_label=multi_label,
+            silent=True,
+        )
+
+        # Only pad up to the longest example
+        max_length = max(int(input_mask.sum(axis=1).max()), 1)
+        sequence_slice = slice(args["max_seq_length"] - max_length, None) if pad_on_left else slice(None, max_length)
+        batch = tuple(
+            torch.from_numpy(np.ascontiguousarray(array[:, sequence_slice])).to(self.device)
+            for array in (input_ids, input_mask, segment_ids)
+        ) + (None,)
+
+        self._move_model_to_device()
+        self.model.eval()
+        with torch.no_grad():
+            inputs = self._get_inputs_dict(batch)
+            del inputs["labels"]
+            logits = self.model(**inputs)[0]
+            if multi_label:
+                logits = logits.sigmoid()
+
+        model_outputs = logits.detach().cpu().numpy()
+
+        if multi_label:
+            preds = (model_outputs >= np.asarray(args["threshold"])).astype(int).tolist()
+        elif args["regression"]:
+            model_outputs = np.squeeze(model_outputs)
+            preds = model_outputs
+        else:
+            preds = np.argmax(model_outputs, axis=1)
+
+        return preds, model_outputs
+
+    def _allocate_hidden_states_array(self, name, shape, dtype):
+        """
+        Allocates an array for hidden states. If hidden_states_memmap_dir is set, the array is a memory-mapped .npy
+        file in that directory, so that the hidden states of large datasets do not have to fit in memory.
+
+        Utility function for predict(). Not intended to be used directly.
+        """
+        if self.args["hidden_states_memmap_dir"]:
+            os.makedirs(self.args["hidden_states_memmap_dir"], exist_ok=True)
+            return np.lib.format.open_memmap(
+                os.path.join(self.args["hidden_states_memmap_dir"], name + ".npy"), mode="w+", dtype=dtype, shape=shape
+            )
+        return np.empty(shape, dtype=dtype)
+
     def _threshold(self, x, threshold):
         if x >= threshold:
             return 1
         return 0
 
+    def close(self):
+        """
+        Shuts down the worker processes used to convert examples to features.
+
+        The workers are started again if the model converts examples to features after closing. The model can also be
+        used as a context manager, which closes it on exit.
+        """
+        self.tokenization_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def _move_model_to_device(self):
         self.model.to(self.device)
 
+    def _get_dataloader(self, dataset, batch_size, shuffle=False):
+        """
+        Creates a DataLoader for a TensorDataset of features, using dynamic padding and length bucketing if enabled.
+
+        Utility function for train(), evaluate() and predict(). Not intended to be used directly.
+        """
+        args = self.args
+
+        collate_fn = None
+        if args["dynamic_padding"]:
+            collate_fn = functools.partial(trim_batch_padding, pad_on_left=bool(args["model_type"] in ["xlnet"]))
+
+        if args["length_bucketing"]:
+            lengths = dataset.tensors[1].sum(dim=1).numpy()
+            batch_sampler = LengthBucketBatchSampler(lengths, batch_size, shuffle=shuffle)
+        else:
+            batch_sampler = TensorBatchSampler(len(dataset), batch_size, shuffle=shuffle)
+
+        return get_batch_sliced_dataloader(dataset, batch_sampler, args, collate_fn=collate_fn)
+
+    def _restore_dataset_order(self, dataloader, *arrays):
+        """
+        Reorders outputs collected in batch order from a length bucketed DataLoader back to the order of the dataset.
+
+        Utility function for evaluate() and predict(). Not intended to be used directly.
+        """
+        if not isinstance(dataloader.sampler, LengthBucketBatchSampler):
+            return arrays
+
+        order = np.concatenate(list(dataloader.sampler))
+        restored_arrays = []
+        for array in arrays:
+            restored = np.empty_like(array)
+            restored[order] = array
+            restored_arrays.append(restored)
+
+        return tuple(restored_arrays)
+
+    def _get_fast_tokenizer(self):
+        """
+        Returns the tokenizer used for batch feature conversion when use_fast_tokenizer is enabled.
+        This is the Rust-backed tokenizer for model types that have one, and self.tokenizer otherwise.
+        """
+        if getattr(self, "fast_tokenizer", None) is None:
+            if self.args["model_type"] in FAST_TOKENIZER_CLASSES:
+                self.fast_tokenizer = FAST_TOKENIZER_CLASSES[self.args["model_type"]].from_pretrained(
+                    self.args["model_name"], do_lower_case=self.args["do_lower_case"]
+                )
+            else:
+                self.fast_tokenizer = self.tokenizer
+        return self.fast_tokenizer
+
     def _get_inputs_dict(self, batch):
         inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3]}
 
@@ -24,6 +24,8 @@ from collections import Counter
 from io import open
 from multiprocessing import Pool, cpu_count
 
+import numpy as np
+
 try:
     import torchvision
     import torchvision.transforms as transforms
@@ -34,12 +36,14 @@ except ImportError:
     torchvision_available = False
 
 from scipy.stats import pearsonr, spearmanr
+from simpletransformers.tokenization_pool import WorkerTokenizer
 from sklearn.metrics import f1_score, matthews_corrcoef
 from tqdm.auto import tqdm
 
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+from torch.utils.data.dataloader import default_collate
 
 csv.field_size_limit(2147483647)
 
@@ -97,6 +101,7 @@ def convert_example_to_feature(
         sep_token,
         cls_token_segment_id,
         pad_on_left,
+        pad_token,
         pad_token_segment_id,
         sep_token_extra,
         multi_label,
@@ -210,6 +215,7 @@ def convert_example_to_feature_sliding_window(
         sep_token,
         cls_token_segment_id,
         pad_on_left,
+        pad_token,
         pad_token_segment_id,
         sep_token_extra,
         multi_label,
@@ -321,25 +327,28 @@ def convert_examples_to_features(
     sliding_window=False,
     flatten=False,
     stride=None,
+    pool=None,
 ):
     """ Loads a data file into a list of `InputBatch`s
         `cls_token_at_end` define the location of the CLS token:
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `pool` is an optional TokenizationPool to use instead of starting a new multiprocessing Pool
     """
 
     examples = [
         (
             example,
             max_seq_length,
-            tokenizer,
+            WorkerTokenizer() if use_multiprocessing and pool is not None else tokenizer,
             output_mode,
             cls_token_at_end,
             cls_token,
             sep_token,
             cls_token_segment_id,
             pad_on_left,
+            pad_token,
             pad_token_segment_id,
             sep_token_extra,
             multi_label,
@@ -348,7 +357,22 @@ def convert_examples_to_features(
         for example in examples
     ]
 
-    if use_multiprocessing:
+    if use_multiprocessing and pool is not None:
+        features = list(
+            tqdm(
+                pool.imap(
+                    convert_example_to_feature_sliding_window if sliding_window else convert_example_to_feature,
+                    examples,
+                    (tokenizer,),
+                    process_count,
+                ),
+                total=len(examples),
+                disable=silent,
+            )
+        )
+        if sliding_window and flatten:
+            features = [feature for feature_set in features for feature in feature_set]
+    elif use_multiprocessing:
         if sliding_window:
             with Pool(process_count) as p:
                 features = list(
@@ -382,6 +406,222 @@ def convert_examples_to_features(
     return features
 
 
+def _batch_encode(tokenizer, texts):
+    """Tokenizes a list of texts to ids in one call. Fast (Rust) tokenizers encode the whole batch in parallel."""
+    if not texts:
+        return []
+    return tokenizer.batch_encode_plus(texts, add_special_tokens=False)["input_ids"]
+
+
+def _truncated_pair_lengths(len_a, len_b, max_length):
+    """Closed form of the lengths `_truncate_seq_pair` truncates a sequence pair to."""
+    if len_a + len_b <= max_length:
+        return len_a, len_b
+    len_a = min(len_a, max(max_length - len_b, (max_length + 1) // 2))
+    return len_a, max_length - len_a
+
+
+def convert_examples_to_arrays(
+    examples,
+    max_seq_length,
+    tokenizer,
+    output_mode,
+    cls_token_at_end=False,
+    sep_token_extra=False,
+    pad_on_left=False,
+    cls_token="[CLS]",
+    sep_token="[SEP]",
+    pad_token=0,
+    sequence_a_segment_id=0,
+    sequence_b_segment_id=1,
+    cls_token_segment_id=1,
+    pad_token_segment_id=0,
+    mask_padding_with_zero=True,
+    multi_label=False,
+    silent=False,
+    chunksize=10000,
+):
+    """ Batch encodes a list of InputExamples into numpy arrays of (input_ids, input_mask, segment_ids, label_ids).
+        The layout (special tokens, truncation, padding and segment ids) is identical to `convert_example_to_feature`,
+        but text is tokenized `chunksize` examples at a time with `tokenizer.batch_encode_plus`. When `tokenizer` is a
+        fast tokenizer, this uses the Rust `tokenizers` batch encoder.
+    """
+
+    cls_token_id, sep_token_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
+    real_mask_value = 1 if mask_padding_with_zero else 0
+
+    all_input_ids = np.full((len(examples), max_seq_length), pad_token, dtype=np.int64)
+    all_input_mask = np.full((len(examples), max_seq_length), 1 - real_mask_value, dtype=np.int64)
+    all_segment_ids = np.full((len(examples), max_seq_length), pad_token_segment_id, dtype=np.int64)
+
+    for chunk_start in tqdm(range(0, len(examples), chunksize), disable=silent):
+        chunk = examples[chunk_start : chunk_start + chunksize]
+        tokens_a_batch = _batch_encode(tokenizer, [example.text_a for example in chunk])
+        pair_indices = [i for i, example in enumerate(chunk) if example.text_b]
+        tokens_b_batch = dict(zip(pair_indices, _batch_encode(tokenizer, [chunk[i].text_b for i in pair_indices])))
+
+        for i, tokens_a in enumerate(tokens_a_batch):
+            tokens_b = tokens_b_batch.get(i)
+            if i in tokens_b_batch:
+                # Account for [CLS], [SEP], [SEP] with "- 3". " -4" for RoBERTa.
+                special_tokens_count = 4 if sep_token_extra else 3
+                len_a, len_b = _truncated_pair_lengths(
+                    len(tokens_a), len(tokens_b), max_seq_length - special_tokens_count
+                )
+                tokens_a, tokens_b = tokens_a[:len_a], tokens_b[:len_b]
+            else:
+                # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
+                special_tokens_count = 3 if sep_token_extra else 2
+                tokens_a = tokens_a[: max_seq_length - special_tokens_count]
+
+            input_ids = tokens_a + [sep_token_id]
+            segment_ids = [sequence_a_segment_id] * len(input_ids)
+
+            if tokens_b:
+                if sep_token_extra:
+                    input_ids += [sep_token_id]
+                    segment_ids += [sequence_b_segment_id]
+
+                input_ids += tokens_b + [sep_token_id]
+                segment_ids += [sequence_b_segment_id] * (len(tokens_b) + 1)
+
+            if cls_token_at_end:
+                input_ids = input_ids + [cls_token_id]
+                segment_ids = segment_ids + [cls_token_segment_id]
+            else:
+                input_ids = [cls_token_id] + input_ids
+                segment_ids = [cls_token_segment_id] + segment_ids
+
+            row = chunk_start + i
+            if pad_on_left:
+                all_input_ids[row, max_seq_length - len(input_ids) :] = input_ids
+                all_input_mask[row, max_seq_length - len(input_ids) :] = real_mask_value
+                all_segment_ids[row, max_seq_length - len(input_ids) :] = segment_ids
+            else:
+                all_input_ids[row, : len(input_ids)] = input_ids
+                all_input_mask[row, : len(input_ids)] = real_mask_value
+                all_segment_ids[row, : len(input_ids)] = segment_ids
+
+    labels = [example.label for example in examples]
+    if output_mode == "regression":
+        all_label_ids = np.array(labels, dtype=np.float32)
+    else:
+        all_label_ids = np.array(labels, dtype=np.int64)
+
+    return all_input_ids, all_input_mask, all_segment_ids, all_label_ids
+
+
+def convert_features_to_arrays(features, output_mode):
+    """Converts a list of InputFeatures to numpy arrays of (input_ids, input_mask, segment_ids, label_ids)."""
+    all_input_ids = np.array([f.input_ids for f in features], dtype=np.int64)
+    all_input_mask = np.array([f.input_mask for f in features], dtype=np.int64)
+    all_segment_ids = np.array([f.segment_ids for f in features], dtype=np.int64)
+
+    if output_mode == "regression":
+        all_label_ids = np.array([f.label_id for f in features], dtype=np.float32)
+    else:
+        all_label_ids = np.array([f.label_id for f in features], dtype=np.int64)
+
+    return all_input_ids, all_input_mask, all_segment_ids, all_label_ids
+
+
+def collate_dynamically_padded_batch(batch, pad_on_left=False):
+    """
+    Collates (input_ids, input_mask, segment_ids, label_ids) features into a batch which is only padded up to the length
+    of its longest sequence, instead of max_seq_length.
+    """
+    return trim_batch_padding(default_collate(batch), pad_on_left=pad_on_left)
+
+
+def trim_batch_padding(batch, pad_on_left=False):
+    """
+    Trims the padding of a batch of (input_ids, input_mask, segment_ids, label_ids) features down to the length of its
+    longest sequence.
+    """
+    input_ids, input_mask, segment_ids, label_ids = batch
+
+    max_length = max(int(input_mask.sum(dim=1).max()), 1)
+    if pad_on_left:
+        sequence_slice = slice(input_ids.size(1) - max_length, None)
+    else:
+        sequence_slice = slice(None, max_length)
+
+    return input_ids[:, sequence_slice], input_mask[:, sequence_slice], segment_ids[:, sequence_slice], label_ids
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler which puts sequences of similar lengths in the same batch, so that dynamically padded batches contain
+    little padding.
+
+    If shuffle is True, the dataset is shuffled and split into buckets of bucket_size batches. Each bucket is sorted by
+    length and split into batches, and the batches are yielded in random order. Otherwise, the batches are formed from
+    the sequences sorted by length (longest first) and the order is deterministic.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.permutation(len(self.lengths))
+            bucket_length = self.batch_size * self.bucket_size
+            for start in range(0, len(order), bucket_length):
+                bucket = order[start : start + bucket_length]
+                order[start : start + bucket_length] = bucket[np.argsort(-self.lengths[bucket], kind="stable")]
+        else:
+            order = np.argsort(-self.lengths, kind="stable")
+
+        batches = [order[i : i + self.batch_size].tolist() for i in range(0, len(order), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def aggregate_sliding_window_predictions(window_outputs, window_counts, strategy="mode", tie_value=1):
+    """
+    Reduces the model outputs of the sliding windows of each example to one prediction per example, in time linear in
+    the number of windows. The windows of each example must be consecutive rows of window_outputs.
+
+    Args:
+        window_outputs: Numpy array of shape (n_windows, num_labels) with the model outputs of every window.
+        window_counts: Number of windows of each example.
+        strategy: "mode" (majority vote of the window predictions, tie_value on ties), "mean" (argmax of the mean of the
+            window outputs) or "max" (argmax of the max of the window outputs).
+        tie_value: Prediction used when the "mode" vote is tied.
+
+    Returns:
+        preds: Numpy array containing the prediction for each example.
+        window_starts: Index of the first window of each example.
+    """
+    window_counts = np.asarray(window_counts, dtype=np.int64)
+    window_starts = np.concatenate([[0], np.cumsum(window_counts)[:-1]]).astype(np.int64)
+
+    if strategy == "mode":
+        example_ids = np.repeat(np.arange(len(window_counts)), window_counts)
+        votes = np.zeros((len(window_counts), window_outputs.shape[1]), dtype=np.int64)
+        np.add.at(votes, (example_ids, np.argmax(window_outputs, axis=1)), 1)
+
+        preds = np.argmax(votes, axis=1)
+        tied = (votes == votes.max(axis=1, keepdims=True)).sum(axis=1) > 1
+        preds[tied] = tie_value
+    elif strategy == "mean":
+        preds = np.argmax(np.add.reduceat(window_outputs, window_starts, axis=0) / window_counts[:, None], axis=1)
+    elif strategy == "max":
+        preds = np.argmax(np.maximum.reduceat(window_outputs, window_starts, axis=0), axis=1)
+    else:
+        raise ValueError("Unknown sliding window aggregation strategy: {}".format(strategy))
+
+    return preds, window_starts
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
 
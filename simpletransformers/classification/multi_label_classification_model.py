@@ -16,6 +16,7 @@ from simpletransformers.custom_models.models import (
     XLMRobertaForMultiLabelSequenceClassification,
     XLNetForMultiLabelSequenceClassification,
 )
+from simpletransformers.tokenization_pool import TokenizationPool
 from transformers import (
     WEIGHTS_NAME,
     AlbertConfig,
@@ -92,6 +93,12 @@ class MultiLabelClassificationModel(ClassificationModel):
             "sliding_window": False,
             "tie_value": 1,
             "stride": False,
+            "sliding_window_aggregation": "mode",
+            "use_fast_tokenizer": False,
+            "dynamic_padding": False,
+            "length_bucketing": False,
+            "fast_predict_max_examples": 32,
+            "hidden_states_memmap_dir": None,
         }
 
         self.args.update(global_args)
@@ -142,6 +149,8 @@ class MultiLabelClassificationModel(ClassificationModel):
             self.model = model_class.from_pretrained(model_name, config=self.config, **kwargs)
 
         self.results = {}
+        self.tokenization_pool = TokenizationPool()
+        self.eval_data_cache = None
 
         self.tokenizer = tokenizer_class.from_pretrained(
             model_name, do_lower_case=self.args["do_lower_case"], **kwargs
@@ -34,6 +34,7 @@ from simpletransformers.classification.classification_utils import (
 )
 from simpletransformers.classification.transformer_models.mmbt_model import MMBTForClassification
 from simpletransformers.config.global_args import global_args
+from simpletransformers.dataloader_utils import get_dataloader_kwargs
 from tensorboardX import SummaryWriter
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
@@ -348,7 +349,7 @@ class MultiModalClassificationModel:
             sampler=train_sampler,
             batch_size=args["train_batch_size"],
             collate_fn=collate_fn,
-            num_workers=args["process_count"],
+            **get_dataloader_kwargs(args, default_num_workers=args["process_count"]),
         )
 
         t_total = len(train_dataloader) // args["gradient_accumulation_steps"] * args["num_train_epochs"]
@@ -736,13 +737,13 @@ class MultiModalClassificationModel:
             sampler=eval_sampler,
             batch_size=args["eval_batch_size"],
             collate_fn=collate_fn,
-            num_workers=args["process_count"],
+            **get_dataloader_kwargs(args, default_num_workers=args["process_count"]),
         )
 
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
+        preds = []
+        out_label_ids = []
         model.eval()
 
         for batch in tqdm(eval_dataloader, disable=args["silent"] or silent):
@@ -759,14 +760,12 @@ class MultiModalClassificationModel:
 
             nb_eval_steps += 1
 
-            if preds is None:
-                preds = torch.sigmoid(logits).detach().cpu().numpy()
-                out_label_ids = labels.detach().cpu().numpy()
-            else:
-                preds = np.append(preds, torch.sigmoid(logits).detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, labels.detach().cpu().numpy(), axis=0)
+            preds.append(torch.sigmoid(logits).detach().cpu().numpy())
+            out_label_ids.append(labels.detach().cpu().numpy())
 
         eval_loss = eval_loss / nb_eval_steps
+        preds = np.concatenate(preds)
+        out_label_ids = np.concatenate(out_label_ids)
         model_outputs = preds
 
         if args["regression"] is True:
@@ -936,13 +935,13 @@ class MultiModalClassificationModel:
             sampler=eval_sampler,
             batch_size=args["eval_batch_size"],
             collate_fn=collate_fn,
-            num_workers=args["process_count"],
+            **get_dataloader_kwargs(args, default_num_workers=args["process_count"]),
         )
 
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
+        preds = []
+        out_label_ids = []
 
         for batch in tqdm(eval_dataloader, disable=args["silent"]):
             batch = tuple(t.to(device) for t in batch)
@@ -958,14 +957,12 @@ class MultiModalClassificationModel:
 
             nb_eval_steps += 1
 
-            if preds is None:
-                preds = torch.sigmoid(logits).detach().cpu().numpy()
-                out_label_ids = labels.detach().cpu().numpy()
-            else:
-                preds = np.append(preds, torch.sigmoid(logits).detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, labels.detach().cpu().numpy(), axis=0)
+            preds.append(torch.sigmoid(logits).detach().cpu().numpy())
+            out_label_ids.append(labels.detach().cpu().numpy())
 
         eval_loss = eval_loss / nb_eval_steps
+        preds = np.concatenate(preds)
+        out_label_ids = np.concatenate(out_label_ids)
         model_outputs = preds
 
         if multi_label:
@@ -5,6 +5,7 @@ global_args = {
     "best_model_dir": "outputs/best_model",
     "cache_dir": "cache_dir/",
     "config": {},
+    "dataloader_num_workers": 0,
     "do_lower_case": False,
     "early_stopping_consider_epochs": False,
     "early_stopping_delta": 0,
@@ -16,6 +17,7 @@ global_args = {
     "evaluate_during_training": False,
     "evaluate_during_training_steps": 2000,
     "evaluate_during_training_verbose": False,
+    "feature_store_max_examples": None,
     "fp16": True,
     "fp16_opt_level": "O1",
     "gradient_accumulation_steps": 1,
@@ -29,6 +31,9 @@ global_args = {
     "num_train_epochs": 1,
     "output_dir": "outputs/",
     "overwrite_output_dir": False,
+    "persistent_workers": False,
+    "pin_memory": False,
+    "prefetch_factor": None,
     "process_count": cpu_count() - 2 if cpu_count() > 2 else 1,
     "reprocess_input_data": True,
     "save_eval_checkpoints": True,
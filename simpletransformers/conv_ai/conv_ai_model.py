@@ -32,6 +32,7 @@ import torch.nn.functional as F
 from simpletransformers.classification.classification_utils import InputExample, convert_examples_to_features
 from simpletransformers.config.global_args import global_args
 from simpletransformers.conv_ai.conv_ai_utils import get_dataset
+from simpletransformers.dataloader_utils import get_dataloader_kwargs
 from tensorboardX import SummaryWriter
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
@@ -650,10 +651,14 @@ class ConvAIModel:
         tensor_dataset = TensorDataset(*tensor_datasets)
         if not evaluate:
             data_sampler = RandomSampler(tensor_dataset)
-            data_loader = DataLoader(tensor_dataset, sampler=data_sampler, batch_size=args["train_batch_size"])
+            data_loader = DataLoader(
+                tensor_dataset, sampler=data_sampler, batch_size=args["train_batch_size"], **get_dataloader_kwargs(args)
+            )
         else:
             data_sampler = SequentialSampler(tensor_dataset)
-            data_loader = DataLoader(tensor_dataset, sampler=data_sampler, batch_size=args["eval_batch_size"])
+            data_loader = DataLoader(
+                tensor_dataset, sampler=data_sampler, batch_size=args["eval_batch_size"], **get_dataloader_kwargs(args)
+            )
 
         # logger.info(" Train dataset (Batch, Candidates, Seq length): {}".format(train_dataset.tensors[0].shape))
         # logger.info(" valid dataset (Batch, Candidates, Seq length): {}".format(valid_dataset.tensors[0].shape))
@@ -430,6 +430,42 @@ class ElectraForLanguageModelingModel(PreTrainedModel):
             discriminator_config = config
         self.discriminator_model = ElectraForPreTraining(discriminator_config)
         self.vocab_size = config.vocab_size
+        if kwargs.get("tie_generator_and_discriminator_embeddings", False):
+            self.tie_generator_and_discriminator_embeddings()
+        self.sampling = kwargs.get("sampling", "multinomial")
+        if self.sampling not in ("multinomial", "gumbel"):
+            raise ValueError("sampling must be 'multinomial' or 'gumbel', got {}".format(self.sampling))
+
+    def tie_generator_and_discriminator_embeddings(self):
+        """
+        Makes the generator use the embeddings (token, position and token type) of the discriminator, as in the ELECTRA
+        paper. The embeddings of both models must have the same shapes.
+        """
+        embedding_shape_attributes = ("vocab_size", "embedding_size", "max_position_embeddings", "type_vocab_size")
+        generator_shape = [getattr(self.generator_model.config, name) for name in embedding_shape_attributes]
+        discriminator_shape = [getattr(self.discriminator_model.config, name) for name in embedding_shape_attributes]
+        if generator_shape != discriminator_shape:
+            raise ValueError(
+                "The generator and discriminator embeddings can only be tied if their {} are the same."
+                " Got {} and {}.".format(", ".join(embedding_shape_attributes), generator_shape, discriminator_shape)
+            )
+
+        self.generator_model.electra.embeddings = self.discriminator_model.electra.embeddings
+        # The output layer of the generator is tied to its input token embeddings
+        self.generator_model.tie_weights()
+
+    def sample_tokens(self, logits):
+        """
+        Samples one token for each row of generator logits of shape (n_positions, vocab_size).
+
+        With "gumbel" sampling, the token is the argmax of the logits perturbed with Gumbel noise, which draws from the
+        same distribution as softmax followed by multinomial sampling without normalizing the probabilities.
+        """
+        logits = logits.detach().float()
+        if self.sampling == "gumbel":
+            gumbel_noise = -torch.empty_like(logits).exponential_().log()
+            return (logits + gumbel_noise).argmax(dim=-1)
+        return torch.multinomial(torch.softmax(logits, dim=-1), 1).view(-1)
 
     def forward(self, inputs, masked_lm_labels, attention_mask=None, token_type_ids=None):
         d_inputs = inputs.clone()
@@ -439,24 +475,18 @@ class ElectraForLanguageModelingModel(PreTrainedModel):
             inputs, masked_lm_labels=masked_lm_labels, attention_mask=attention_mask, token_type_ids=token_type_ids
         )
 
-        # get samples from masked LM.
-        sample_probs = torch.softmax(g_out[1], dim=-1, dtype=torch.float32)
-        sample_probs = sample_probs.view(-1, self.vocab_size)
-
-        sampled_tokens = torch.multinomial(sample_probs, 1).view(-1)
-        sampled_tokens = sampled_tokens.view(d_inputs.shape[0], -1)
-
         # labels have a -100 value to mask out loss from unchanged tokens.
         mask = masked_lm_labels.ne(-100)
 
+        # get samples from masked LM, only at the masked positions.
+        sampled_tokens = self.sample_tokens(g_out[1][mask])
+
         # replace the masked out tokens of the input with the generator predictions.
-        d_inputs[mask] = sampled_tokens[mask]
+        d_inputs[mask] = sampled_tokens
 
         # turn mask into new target labels.  1 (True) for corrupted, 0 otherwise.
         # if the prediction was correct, mark it as uncorrupted.
-        correct_preds = sampled_tokens == masked_lm_labels
-        d_labels = mask.long()
-        d_labels[correct_preds] = 0
+        d_labels = (mask & d_inputs.ne(masked_lm_labels)).long()
 
         # run token classification, predict whether each token was corrupted.
         d_out = self.discriminator_model(
@@ -0,0 +1,98 @@
+"""
+DataLoader settings and helpers shared by all models.
+
+The DataLoader global args (dataloader_num_workers, pin_memory, prefetch_factor and persistent_workers) are converted
+to DataLoader keyword arguments here, so that every model applies them the same way.
+
+Features held in a TensorDataset are loaded a whole batch at a time with get_batch_sliced_dataloader(), instead of
+indexing each tensor once per example and stacking the examples back together.
+"""
+
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler, TensorDataset
+
+
+def seed_worker(worker_id):
+    """
+    Seeds the python and numpy random generators of a DataLoader worker.
+
+    PyTorch seeds the torch generator of each worker with a different seed, but workers forked from the same process
+    otherwise share the python and numpy random states, and would produce the same random numbers.
+    """
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def get_dataloader_kwargs(args, default_num_workers=0):
+    """
+    Returns the DataLoader keyword arguments given by the DataLoader global args.
+
+    Args:
+        args: Model args dict.
+        default_num_workers: Number of workers used when dataloader_num_workers is 0.
+    """
+    num_workers = args["dataloader_num_workers"] or default_num_workers
+    kwargs = {"num_workers": num_workers, "pin_memory": args["pin_memory"]}
+    if num_workers > 0:
+        kwargs["worker_init_fn"] = seed_worker
+        # Only passed if set, these are not accepted by older versions of PyTorch
+        if args["prefetch_factor"] is not None:
+            kwargs["prefetch_factor"] = args["prefetch_factor"]
+        if args["persistent_workers"]:
+            kwargs["persistent_workers"] = True
+    return kwargs
+
+
+class TensorBatchSampler(Sampler):
+    """
+    Batch sampler yielding the indices of each batch as a LongTensor, in random or sequential order.
+    """
+
+    def __init__(self, num_samples, batch_size, shuffle=False, drop_last=False):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        order = torch.randperm(self.num_samples) if self.shuffle else torch.arange(self.num_samples)
+        for batch in order.split(self.batch_size):
+            if self.drop_last and len(batch) < self.batch_size:
+                return
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+class BatchSlicedTensorDataset(TensorDataset):
+    """
+    TensorDataset which can also be indexed with the indices of a whole batch (a LongTensor or a list), returning the
+    batch with a single index_select per tensor.
+    """
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            return super().__getitem__(index)
+        index = torch.as_tensor(index, dtype=torch.long)
+        return tuple(tensor.index_select(0, index) for tensor in self.tensors)
+
+
+def get_batch_sliced_dataloader(dataset, batch_sampler, args, collate_fn=None):
+    """
+    Returns a DataLoader which loads each batch of batch_sampler from the TensorDataset dataset with one index_select per
+    tensor. collate_fn, if given, is applied to each loaded batch.
+    """  # noqa: ignore flake8"
+    return DataLoader(
+        BatchSlicedTensorDataset(*dataset.tensors),
+        sampler=batch_sampler,
+        batch_size=None,
+        collate_fn=collate_fn,
+        **get_dataloader_kwargs(args),
+    )
@@ -0,0 +1,225 @@
+"""
+Utilities for caching converted features on disk.
+
+Feature caches are keyed by a hash of the tokenizer, the feature conversion args and the contents of the examples, so
+that different datasets never share a cache file. Features are saved as columnar `.npy` arrays which are
+memory-mapped when loaded.
+
+A FeatureStore additionally keeps the features of every example it has seen, keyed by the example contents, so that
+only new or changed examples have to be converted when a dataset changes.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FEATURE_ARRAY_NAMES = ("input_ids", "input_mask", "segment_ids", "label_ids")
+DIGEST_SIZE = 16
+
+
+def get_cache_key(*parts):
+    """Returns a hex digest of `parts`. bytes and numpy arrays are hashed directly, everything else by its repr."""
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = part.tobytes()
+        if not isinstance(part, bytes):
+            part = repr(part).encode("utf-8")
+        hasher.update(hashlib.blake2b(part, digest_size=DIGEST_SIZE).digest())
+    return hasher.hexdigest()
+
+
+def hash_tokenizer(tokenizer):
+    """
+    Returns a hex digest identifying a tokenizer.
+    This covers the tokenizer class, its init kwargs (hashing the contents of vocabulary files rather than their
+    paths), and any added tokens.
+    """
+    init_kwargs = []
+    for key, value in sorted(getattr(tokenizer, "init_kwargs", {}).items()):
+        if isinstance(value, str) and os.path.isfile(value):
+            with open(value, "rb") as f:
+                value = hashlib.blake2b(f.read(), digest_size=DIGEST_SIZE).hexdigest()
+        init_kwargs.append((key, value))
+
+    return get_cache_key(
+        type(tokenizer).__name__, init_kwargs, sorted(getattr(tokenizer, "added_tokens_encoder", {}).items()),
+    )
+
+
+def get_example_digests(example_contents):
+    """
+    Hashes the contents of each example.
+
+    Args:
+        example_contents: An iterable containing a tuple of the fields that define each example.
+
+    Returns:
+        A numpy array of fixed-width bytes containing one digest per example.
+    """
+    return np.array(
+        [
+            hashlib.blake2b(repr(tuple(str(field) for field in contents)).encode("utf-8"), digest_size=DIGEST_SIZE)
+            .digest()
+            for contents in example_contents
+        ],
+        dtype=f"S{DIGEST_SIZE}",
+    )
+
+
+def save_arrays(cache_path, arrays):
+    """
+    Saves a dict of named arrays as one .npy file per array in the directory cache_path.
+    The arrays are written to a temporary directory first so that an interrupted write never leaves a partial cache.
+    """
+    tmp_path = "{}.tmp-{}".format(cache_path, uuid.uuid4().hex)
+    os.makedirs(tmp_path)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), array)
+
+    if os.path.isdir(cache_path):
+        shutil.rmtree(cache_path)
+    elif os.path.exists(cache_path):
+        # Feature caches from older versions are single pickled files
+        os.remove(cache_path)
+    os.replace(tmp_path, cache_path)
+
+
+def save_feature_arrays(cache_path, feature_arrays, window_counts=None, example_digests=None):
+    """Saves feature arrays as one .npy file per column in the directory cache_path."""
+    arrays = dict(zip(FEATURE_ARRAY_NAMES, feature_arrays))
+    if window_counts is not None:
+        arrays["window_counts"] = np.array(window_counts, dtype=np.int64)
+    if example_digests is not None:
+        arrays["example_digests"] = example_digests
+    save_arrays(cache_path, arrays)
+
+
+def load_feature_arrays(cache_path):
+    """
+    Opens feature arrays saved with save_feature_arrays() as copy-on-write memory maps.
+    Nothing is read into memory until it is accessed, and the pages are shared between processes.
+
+    Returns:
+        feature_arrays: Tuple of (input_ids, input_mask, segment_ids, label_ids) arrays.
+        window_counts: Number of feature rows for each example, or None if there is one row per example.
+    """
+    feature_arrays = tuple(
+        np.load(os.path.join(cache_path, name + ".npy"), mmap_mode="c") for name in FEATURE_ARRAY_NAMES
+    )
+
+    window_counts_file = os.path.join(cache_path, "window_counts.npy")
+    window_counts = np.load(window_counts_file).tolist() if os.path.isfile(window_counts_file) else None
+
+    return feature_arrays, window_counts
+
+
+class FeatureStore:
+    """
+    Per-example feature store.
+
+    Each call to add() writes a new shard containing the feature rows of the added examples, their digests and the
+    number of rows belonging to each example. Existing shards are never rewritten, so growing a dataset only costs
+    writing the new examples. compact() and clear() bound the size of the store, which otherwise keeps every example it
+    has seen.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.shards = []
+        self.index = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+
+        if os.path.isdir(store_path):
+            for shard_name in sorted(os.listdir(store_path)):
+                shard_path = os.path.join(store_path, shard_name)
+                if shard_name.startswith("shard-") and ".tmp-" not in shard_name:
+                    self._load_shard(shard_path)
+
+    def _load_shard(self, shard_path):
+        feature_arrays, window_counts = load_feature_arrays(shard_path)
+        digests = np.load(os.path.join(shard_path, "example_digests.npy"))
+        counts = np.array(window_counts, dtype=np.int64)
+
+        first_example = len(self.counts)
+        for i, digest in enumerate(digests.tolist()):
+            self.index[digest] = first_example + i
+        self.shards.append(feature_arrays)
+        self.counts = np.concatenate([self.counts, counts])
+
+    def __len__(self):
+        return len(self.counts)
+
+    def lookup(self, example_digests):
+        """Returns the store position of each example, or -1 for examples that are not in the store."""
+        return np.array([self.index.get(digest, -1) for digest in example_digests.tolist()], dtype=np.int64)
+
+    def add(self, example_digests, feature_arrays, window_counts):
+        """Adds the features of new examples to the store. window_counts gives the number of rows of each example."""
+        os.makedirs(self.store_path, exist_ok=True)
+        shard_path = os.path.join(self.store_path, "shard-{:06d}-{}".format(len(self.shards), uuid.uuid4().hex[:8]))
+        save_feature_arrays(shard_path, feature_arrays, window_counts, example_digests)
+        self._load_shard(shard_path)
+
+    def gather(self, positions):
+        """
+        Collects the feature rows of the examples at `positions` (as returned by lookup()), in that order.
+
+        Returns:
+            feature_arrays: Tuple of (input_ids, input_mask, segment_ids, label_ids) arrays.
+            window_counts: Number of feature rows for each example.
+        """
+        counts = self.counts[positions]
+        row_starts = np.concatenate([[0], np.cumsum(self.counts)])[positions]
+        # Index of every requested row in the concatenation of all shards
+        rows = np.repeat(row_starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        shard_row_starts = np.cumsum([0] + [len(shard[0]) for shard in self.shards])
+        row_shards = np.searchsorted(shard_row_starts, rows, side="right") - 1
+
+        feature_arrays = []
+        for column in range(len(FEATURE_ARRAY_NAMES)):
+            template = self.shards[0][column]
+            gathered = np.empty((len(rows),) + template.shape[1:], dtype=template.dtype)
+            for shard_id, shard in enumerate(self.shards):
+                in_shard = row_shards == shard_id
+                if in_shard.any():
+                    gathered[in_shard] = shard[column][rows[in_shard] - shard_row_starts[shard_id]]
+            feature_arrays.append(gathered)
+
+        return tuple(feature_arrays), counts.tolist()
+
+    def compact(self, example_digests):
+        """
+        Rewrites the store as a single shard holding only the examples of `example_digests`, which must all be in the
+        store, and deletes every other shard. Used to bound the size of the store to the examples still in use.
+        """
+        example_digests = np.unique(example_digests)
+        feature_arrays, window_counts = self.gather(self.lookup(example_digests))
+
+        # The new shard is complete before the old ones are deleted, so an interrupted compaction loses nothing
+        shard_path = os.path.join(self.store_path, "shard-{:06d}-{}".format(0, uuid.uuid4().hex[:8]))
+        save_feature_arrays(shard_path, feature_arrays, window_counts, example_digests)
+        self._delete_shards(keep=os.path.basename(shard_path))
+        self._load_shard(shard_path)
+
+    def clear(self):
+        """Deletes every shard of the store."""
+        self._delete_shards()
+
+    def _delete_shards(self, keep=None):
+        self.shards = []
+        self.index = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+
+        if os.path.isdir(self.store_path):
+            for shard_name in os.listdir(self.store_path):
+                if shard_name != keep:
+                    shutil.rmtree(os.path.join(self.store_path, shard_name), ignore_errors=True)
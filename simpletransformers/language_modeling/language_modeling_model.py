@@ -3,11 +3,14 @@
 
 
 from __future__ import absolute_import, division, print_function
+import bisect
+import itertools
 import json
 import logging
 import math
 import os
 import random
+import time
 import warnings
 from multiprocessing import cpu_count
 from typing import Dict, List
@@ -25,17 +28,22 @@ import pandas as pd
 import torch
 from simpletransformers.config.global_args import global_args
 from simpletransformers.custom_models.models import ElectraForLanguageModelingModel
+from simpletransformers.dataloader_utils import get_dataloader_kwargs
 from simpletransformers.language_modeling.language_modeling_utils import (
     LineByLineTextDataset,
     SimpleDataset,
+    StreamingTextDataset,
     TextDataset,
-    mask_tokens,
+    TokenMasker,
+    get_input_files,
+    truncate_batch,
 )
+from simpletransformers.tokenization_pool import TokenizationPool
 from tensorboardX import SummaryWriter
 from tokenizers import BertWordPieceTokenizer, ByteLevelBPETokenizer
 from tokenizers.processors import BertProcessing
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
+from torch.utils.data import ConcatDataset, DataLoader, Dataset, IterableDataset, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from transformers import (
     WEIGHTS_NAME,
@@ -154,6 +162,8 @@ class LanguageModelingModel:
             self.device = "cpu"
 
         self.results = {}
+        self.tokenization_pool = TokenizationPool()
+        self.eval_data_cache = None
 
         self.args = {
             "dataset_type": "None",
@@ -162,7 +172,11 @@ class LanguageModelingModel:
             "block_size": -1,
             "mlm": True,
             "mlm_probability": 0.15,
+            "mlm_mask_in_dataloader": False,
             "max_steps": -1,
+            "block_size_schedule": None,
+            "shuffle_buffer_size": 10000,
+            "tokenization_shard_size": 16 * 1024 * 1024,
             "config_name": None,
             "tokenizer_name": None,
             "min_frequency": 2,
@@ -171,6 +185,8 @@ class LanguageModelingModel:
             "stride": 0.8,
             "generator_config": {},
             "discriminator_config": {},
+            "electra_sampling": "multinomial",
+            "tie_generator_and_discriminator_embeddings": False,
             "vocab_size": None,
         }
 
@@ -262,6 +278,8 @@ class LanguageModelingModel:
                     cache_dir=self.args["cache_dir"],
                     generator_config=self.generator_config,
                     discriminator_config=self.discriminator_config,
+                    sampling=self.args["electra_sampling"],
+                    tie_generator_and_discriminator_embeddings=self.args["tie_generator_and_discriminator_embeddings"],
                     **kwargs,
                 )
                 self.model.load_state_dict(torch.load(os.path.join(self.args["model_name"], "pytorch_model.bin")))
@@ -280,6 +298,8 @@ class LanguageModelingModel:
                     discriminator_model=discriminator_model,
                     generator_config=self.generator_config,
                     discriminator_config=self.discriminator_config,
+                    sampling=self.args["electra_sampling"],
+                    tie_generator_and_discriminator_embeddings=self.args["tie_generator_and_discriminator_embeddings"],
                 )
                 model_to_resize = (
                     self.model.generator_model.module
@@ -317,7 +337,7 @@ class LanguageModelingModel:
         Trains the model using 'train_file'
 
         Args:
-            train_file: Path to text file containing the text to train the language model on.
+            train_file: Path to text file containing the text to train the language model on. Can also be a directory or a glob pattern matching several files.
             output_dir: The directory where model files will be saved. If not given, self.args['output_dir'] will be used.
             show_running_loss (
             onal): Set to False to prevent running loss from being printed to console. Defaults to True.
@@ -355,14 +375,22 @@ class LanguageModelingModel:
 
         os.makedirs(output_dir, exist_ok=True)
 
-        global_step, tr_loss = self.train(
-            train_dataset,
-            output_dir,
-            show_running_loss=show_running_loss,
-            eval_file=eval_file,
-            verbose=verbose,
-            **kwargs,
-        )
+        if self.args["evaluate_during_training"]:
+            # The eval dataset is built once and reused by every evaluation of this train_model() call, so
+            # changes made to the eval data during training are not seen
+            self.eval_data_cache = self.load_and_cache_examples(eval_file, evaluate=True, verbose=verbose)
+
+        try:
+            global_step, tr_loss = self.train(
+                train_dataset,
+                output_dir,
+                show_running_loss=show_running_loss,
+                eval_file=eval_file,
+                verbose=verbose,
+                **kwargs,
+            )
+        finally:
+            self.eval_data_cache = None
 
         self._save_model(output_dir, model=self.model)
         if self.args["model_type"] == "electra":
@@ -388,19 +416,45 @@ class LanguageModelingModel:
         model = self.model
         args = self.args
         tokenizer = self.tokenizer
+        token_masker = TokenMasker(tokenizer, args["mlm_probability"]) if args["mlm"] else None
+        mask_in_dataloader = args["mlm"] and args["mlm_mask_in_dataloader"]
 
         def collate(examples: List[torch.Tensor]):
             if tokenizer._pad_token is None:
-                return pad_sequence(examples, batch_first=True)
-            return pad_sequence(examples, batch_first=True, padding_value=tokenizer.pad_token_id)
+                batch = pad_sequence(examples, batch_first=True)
+            else:
+                batch = pad_sequence(examples, batch_first=True, padding_value=tokenizer.pad_token_id)
+            return token_masker(batch) if mask_in_dataloader else batch
 
         tb_writer = SummaryWriter(logdir=args["tensorboard_dir"])
-        train_sampler = RandomSampler(train_dataset)
-        train_dataloader = DataLoader(
-            train_dataset, sampler=train_sampler, batch_size=args["train_batch_size"], collate_fn=collate
-        )
+        streaming = isinstance(train_dataset, IterableDataset)
+        if streaming:
+            if args["max_steps"] <= 0:
+                raise ValueError(
+                    "The length of a streaming dataset is not known in advance."
+                    " Set args['max_steps'] to the number of training steps to train on a streaming dataset."
+                )
+            # Each worker tokenizes its own part of the files
+            train_dataloader = DataLoader(
+                train_dataset,
+                batch_size=args["train_batch_size"],
+                collate_fn=collate,
+                **get_dataloader_kwargs(args, default_num_workers=args["process_count"]),
+            )
+        else:
+            train_sampler = RandomSampler(train_dataset)
+            train_dataloader = DataLoader(
+                train_dataset,
+                sampler=train_sampler,
+                batch_size=args["train_batch_size"],
+                collate_fn=collate,
+                **get_dataloader_kwargs(args),
+            )
 
-        if args["max_steps"] > 0:
+        if streaming:
+            # Passes over the data are repeated until max_steps is reached
+            t_total = args["max_steps"]
+        elif args["max_steps"] > 0:
             t_total = args["max_steps"]
             args["num_train_epochs"] = (
                 args["max_steps"] // (len(train_dataloader) // args["gradient_accumulation_steps"]) + 1
@@ -425,6 +479,17 @@ class LanguageModelingModel:
             optimizer, num_warmup_steps=args["warmup_steps"], num_training_steps=t_total
         )
 
+        # The phase is given by global_step, so the schedule continues from the right phase when resuming
+        block_size_phases = self._get_block_size_phases(t_total)
+        phase_end_steps = [end_step for end_step, _ in block_size_phases]
+        phase = None
+        phase_start_step = 0
+        phase_tokens = 0
+        phase_start_time = time.time()
+        if block_size_phases:
+            pad_token_id = tokenizer.pad_token_id if tokenizer._pad_token is not None else None
+            keep_last_token = tokenizer.build_inputs_with_special_tokens([-1])[-1] != -1
+
         if (
             args["model_name"]
             and os.path.isfile(os.path.join(args["model_name"], "optimizer.pt"))
@@ -450,7 +515,12 @@ class LanguageModelingModel:
         global_step = 0
         tr_loss, logging_loss = 0.0, 0.0
         model.zero_grad()
-        train_iterator = trange(int(args["num_train_epochs"]), desc="Epoch", disable=args["silent"], mininterval=0)
+        if streaming:
+            train_iterator = tqdm(itertools.count(), desc="Epoch", disable=args["silent"], mininterval=0)
+        else:
+            train_iterator = trange(
+                int(args["num_train_epochs"]), desc="Epoch", disable=args["silent"], mininterval=0
+            )
         epoch_number = 0
         best_eval_metric = None
         early_stopping_counter = 0
@@ -466,10 +536,14 @@ class LanguageModelingModel:
                 else:
                     checkpoint_suffix = checkpoint_suffix[-1]
                 global_step = int(checkpoint_suffix)
-                epochs_trained = global_step // (len(train_dataloader) // args["gradient_accumulation_steps"])
-                steps_trained_in_current_epoch = global_step % (
-                    len(train_dataloader) // args["gradient_accumulation_steps"]
-                )
+                if streaming:
+                    # The batches already trained on are skipped, across passes if needed
+                    steps_trained_in_current_epoch = global_step * args["gradient_accumulation_steps"]
+                else:
+                    epochs_trained = global_step // (len(train_dataloader) // args["gradient_accumulation_steps"])
+                    steps_trained_in_current_epoch = global_step % (
+                        len(train_dataloader) // args["gradient_accumulation_steps"]
+                    )
 
                 logger.info("   Continuing training from checkpoint, will skip to saved global_step")
                 logger.info("   Continuing training from epoch %d", epochs_trained)
@@ -486,19 +560,59 @@ class LanguageModelingModel:
             wandb.watch(self.model)
 
         model.train()
+
+        def end_training():
+            # The throughput of the earlier phases is logged when the next phase starts
+            if phase is not None:
+                self._log_phase_throughput(
+                    phase, block_size_phases, global_step - phase_start_step, phase_tokens, phase_start_time
+                )
+            return global_step, tr_loss / global_step
+
         for current_epoch in train_iterator:
             if epochs_trained > 0:
                 epochs_trained -= 1
                 continue
+            if streaming:
+                train_dataset.set_epoch(current_epoch)
+                epoch_has_batches = False
             # epoch_iterator = tqdm(train_dataloader, desc="Iteration")
             for step, batch in enumerate(tqdm(train_dataloader, desc="Current iteration", disable=args["silent"])):
+                if streaming:
+                    epoch_has_batches = True
                 if steps_trained_in_current_epoch > 0:
                     steps_trained_in_current_epoch -= 1
                     continue
 
-                inputs, labels = mask_tokens(batch, tokenizer, args) if args["mlm"] else (batch, batch)
-                inputs = inputs.to(self.device)
-                labels = labels.to(self.device)
+                block_size = None
+                if block_size_phases:
+                    current_phase = bisect.bisect_right(phase_end_steps, global_step)
+                    if current_phase != phase:
+                        if phase is not None:
+                            self._log_phase_throughput(
+                                phase, block_size_phases, global_step - phase_start_step, phase_tokens, phase_start_time
+                            )
+                        phase = current_phase
+                        phase_start_step = global_step
+                        phase_tokens = 0
+                        phase_start_time = time.time()
+                    if phase < len(block_size_phases):
+                        block_size = block_size_phases[phase][1]
+
+                if mask_in_dataloader:
+                    inputs, labels = (t.to(self.device) for t in batch)
+                    if block_size:
+                        inputs, labels = truncate_batch(inputs, block_size, labels, pad_token_id, keep_last_token)
+                else:
+                    batch = batch.to(self.device)
+                    if block_size:
+                        batch, _ = truncate_batch(
+                            batch, block_size, pad_token_id=pad_token_id, keep_last_token=keep_last_token
+                        )
+                    inputs, labels = token_masker(batch) if args["mlm"] else (batch, batch)
+
+                if block_size_phases:
+                    phase_tokens += inputs.numel()
 
                 outputs = model(inputs, masked_lm_labels=labels) if args["mlm"] else model(inputs, labels=labels)
                 # model outputs are always tuple in pytorch-transformers (see doc)
@@ -548,6 +662,10 @@ class LanguageModelingModel:
                         # Log metrics
                         tb_writer.add_scalar("lr", scheduler.get_lr()[0], global_step)
                         tb_writer.add_scalar("loss", (tr_loss - logging_loss) / args["logging_steps"], global_step)
+                        if block_size_phases:
+                            tb_writer.add_scalar(
+                                "tokens_per_second", phase_tokens / (time.time() - phase_start_time), global_step
+                            )
                         logging_loss = tr_loss
                         if args["wandb_project"]:
                             wandb.log(
@@ -625,7 +743,7 @@ class LanguageModelingModel:
                                             )
                                             logger.info(" Training terminated.")
                                             train_iterator.close()
-                                        return global_step, tr_loss / global_step
+                                        return end_training()
                         else:
                             if (
                                 results[args["early_stopping_metric"]] - best_eval_metric
@@ -651,10 +769,10 @@ class LanguageModelingModel:
                                             )
                                             logger.info(" Training terminated.")
                                             train_iterator.close()
-                                        return global_step, tr_loss / global_step
+                                        return end_training()
 
                 if args["max_steps"] > 0 and global_step > args["max_steps"]:
-                    return global_step, tr_loss / global_step
+                    return end_training()
 
             epoch_number += 1
             output_dir_current = os.path.join(output_dir, "checkpoint-{}-epoch-{}".format(global_step, epoch_number))
@@ -703,7 +821,7 @@ class LanguageModelingModel:
                                     logger.info(f" Patience of {args['early_stopping_patience']} steps reached")
                                     logger.info(" Training terminated.")
                                     train_iterator.close()
-                                return global_step, tr_loss / global_step
+                                return end_training()
                 else:
                     if results[args["early_stopping_metric"]] - best_eval_metric > args["early_stopping_delta"]:
                         best_eval_metric = results[args["early_stopping_metric"]]
@@ -722,12 +840,46 @@ class LanguageModelingModel:
                                     logger.info(f" Patience of {args['early_stopping_patience']} steps reached")
                                     logger.info(" Training terminated.")
                                     train_iterator.close()
-                                return global_step, tr_loss / global_step
+                                return end_training()
 
             if args["max_steps"] > 0 and global_step > args["max_steps"]:
-                return global_step, tr_loss / global_step
+                return end_training()
+
+            if streaming and not epoch_has_batches:
+                raise ValueError("The streaming dataset does not contain a single block of block_size tokens.")
+
+        return end_training()
+
+    def _get_block_size_phases(self, t_total):
+        """
+        Converts block_size_schedule to a list of (end step, block size) phases. Steps after the last phase use the full
+        block_size.
+
+        Utility function for train(). Not intended to be used directly.
+        """
+        phases = []
+        total_fraction = 0
+        for fraction, block_size in self.args["block_size_schedule"] or []:
+            if fraction <= 0 or not 0 < block_size <= self.args["block_size"]:
+                raise ValueError(
+                    "Each block_size_schedule entry must be a (fraction of steps, block size) pair with a positive"
+                    " fraction and a block size between 1 and block_size ({}). Got {}.".format(
+                        self.args["block_size"], (fraction, block_size)
+                    )
+                )
+            total_fraction += fraction
+            phases.append((math.ceil(total_fraction * t_total), block_size))
 
-        return global_step, tr_loss / global_step
+        if total_fraction > 1 + 1e-6:
+            raise ValueError("The fractions of steps in block_size_schedule add up to more than 1.")
+
+        return phases
+
+    def _log_phase_throughput(self, phase, block_size_phases, steps, tokens, start_time):
+        block_size = block_size_phases[phase][1] if phase < len(block_size_phases) else self.args["block_size"]
+        logger.info(
+            " Block size %d phase: %d steps, %.0f tokens/s", block_size, steps, tokens / (time.time() - start_time)
+        )
 
     def eval_model(self, eval_file, output_dir=None, verbose=True, silent=False, **kwargs):
         """
@@ -740,7 +892,10 @@ class LanguageModelingModel:
 
         self._move_model_to_device()
 
-        eval_dataset = self.load_and_cache_examples(eval_file, evaluate=True, verbose=verbose, silent=silent)
+        if self.eval_data_cache is not None:
+            eval_dataset = self.eval_data_cache
+        else:
+            eval_dataset = self.load_and_cache_examples(eval_file, evaluate=True, verbose=verbose, silent=silent)
         os.makedirs(output_dir, exist_ok=True)
 
         result = self.evaluate(eval_dataset, output_dir, verbose=verbose, silent=silent, **kwargs)
@@ -762,18 +917,34 @@ class LanguageModelingModel:
         args = self.args
         eval_output_dir = output_dir
         tokenizer = self.tokenizer
+        token_masker = TokenMasker(tokenizer, args["mlm_probability"]) if args["mlm"] else None
+        mask_in_dataloader = args["mlm"] and args["mlm_mask_in_dataloader"]
 
         results = {}
 
         def collate(examples: List[torch.Tensor]):
             if tokenizer._pad_token is None:
-                return pad_sequence(examples, batch_first=True)
-            return pad_sequence(examples, batch_first=True, padding_value=tokenizer.pad_token_id)
-
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(
-            eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"], collate_fn=collate
-        )
+                batch = pad_sequence(examples, batch_first=True)
+            else:
+                batch = pad_sequence(examples, batch_first=True, padding_value=tokenizer.pad_token_id)
+            return token_masker(batch) if mask_in_dataloader else batch
+
+        if isinstance(eval_dataset, IterableDataset):
+            eval_dataloader = DataLoader(
+                eval_dataset,
+                batch_size=args["eval_batch_size"],
+                collate_fn=collate,
+                **get_dataloader_kwargs(args, default_num_workers=args["process_count"]),
+            )
+        else:
+            eval_sampler = SequentialSampler(eval_dataset)
+            eval_dataloader = DataLoader(
+                eval_dataset,
+                sampler=eval_sampler,
+                batch_size=args["eval_batch_size"],
+                collate_fn=collate,
+                **get_dataloader_kwargs(args),
+            )
 
         if args["n_gpu"] > 1:
             model = torch.nn.DataParallel(model)
@@ -783,9 +954,11 @@ class LanguageModelingModel:
         model.eval()
 
         for batch in tqdm(eval_dataloader, disable=args["silent"] or silent):
-            inputs, labels = mask_tokens(batch, tokenizer, args) if args["mlm"] else (batch, batch)
-            inputs = inputs.to(self.device)
-            labels = labels.to(self.device)
+            if mask_in_dataloader:
+                inputs, labels = (t.to(self.device) for t in batch)
+            else:
+                batch = batch.to(self.device)
+                inputs, labels = token_masker(batch) if args["mlm"] else (batch, batch)
             with torch.no_grad():
                 outputs = model(inputs, masked_lm_labels=labels) if args["mlm"] else model(inputs, labels=labels)
                 lm_loss = outputs[0]
@@ -828,9 +1001,29 @@ class LanguageModelingModel:
         else:
             dataset_type = args["dataset_type"]
             if dataset_type == "text":
-                return TextDataset(tokenizer, args, file_path, mode, args["block_size"])
-            elif dataset_type == "line_by_line":
-                return LineByLineTextDataset(tokenizer, args, file_path, args["block_size"])
+                return TextDataset(tokenizer, args, file_path, mode, args["block_size"], pool=self.tokenization_pool)
+            elif dataset_type == "stream":
+                return StreamingTextDataset(
+                    tokenizer,
+                    args,
+                    file_path,
+                    args["block_size"],
+                    shuffle=not evaluate,
+                    shuffle_buffer_size=args["shuffle_buffer_size"],
+                )
+            elif dataset_type in ["line_by_line", "line_by_line_packed"]:
+                return ConcatDataset(
+                    [
+                        LineByLineTextDataset(
+                            tokenizer,
+                            args,
+                            path,
+                            args["block_size"],
+                            packing=dataset_type == "line_by_line_packed",
+                        )
+                        for path in get_input_files(file_path)
+                    ]
+                )
             else:
                 special_tokens_count = 3 if bool(args["model_type"] in ["roberta", "camembert", "xlmroberta"]) else 2
                 if self.args["max_seq_length"] > 509:
@@ -840,14 +1033,20 @@ class LanguageModelingModel:
                     self.args["block_size"] = (
                         509 if bool(args["model_type"] in ["roberta", "camembert", "xlmroberta"]) else 510
                     )
-                return SimpleDataset(
-                    tokenizer,
-                    self.args,
-                    file_path,
-                    mode,
-                    args["block_size"],
-                    special_tokens_count,
-                    sliding_window=args["sliding_window"],
+                return ConcatDataset(
+                    [
+                        SimpleDataset(
+                            tokenizer,
+                            self.args,
+                            path,
+                            mode,
+                            args["block_size"],
+                            special_tokens_count,
+                            sliding_window=args["sliding_window"],
+                            pool=self.tokenization_pool,
+                        )
+                        for path in get_input_files(file_path)
+                    ]
                 )
 
     # def predict(self, to_predict, multi_label=False):
@@ -980,8 +1179,7 @@ class LanguageModelingModel:
                 "Either provide a tokenizer or specify vocab_size."
             )
 
-        if not isinstance(train_files, list):
-            train_files = [train_files]
+        train_files = get_input_files(train_files)
 
         if not output_dir:
             output_dir = self.args["output_dir"]
@@ -1075,6 +1273,21 @@ class LanguageModelingModel:
             return 1
         return 0
 
+    def close(self):
+        """
+        Shuts down the worker processes used to convert examples to features.
+
+        The workers are started again if the model converts examples to features after closing. The model can also be
+        used as a context manager, which closes it on exit.
+        """
+        self.tokenization_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def _move_model_to_device(self):
         self.model.to(self.device)
 
@@ -1,46 +1,72 @@
+import glob
+import itertools
 import logging
+import multiprocessing
 import os
-import pickle
+import random
+import uuid
 from multiprocessing import Pool
 from typing import Tuple
 
 from tqdm.auto import tqdm
 
+import numpy as np
 import torch
 from tokenizers.implementations import ByteLevelBPETokenizer
 from tokenizers.processors import BertProcessing
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from transformers import PreTrainedTokenizer
 
+from simpletransformers.feature_cache import get_cache_key, hash_tokenizer, save_arrays
+from simpletransformers.tokenization_pool import WorkerTokenizer
+
 
 logger = logging.getLogger(__name__)
 
 
-class TextDataset(Dataset):
-    def __init__(self, tokenizer: PreTrainedTokenizer, args, file_path: str, mode, block_size=512):
-        assert os.path.isfile(file_path)
+class TokenArrayDataset(Dataset):
+    """
+    Dataset of token id sequences stored as one flat token array and the offsets of each sequence in it.
+
+    The arrays are saved to a cache directory with save_token_arrays() and memory-mapped when loaded, so opening a
+    dataset reads almost nothing into memory. Items are sliced from the token array directly into tensors.
+    """
+
+    def _load_token_arrays(self, cache_path):
+        self.tokens = np.load(os.path.join(cache_path, "tokens.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(cache_path, "offsets.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, item):
+        return torch.from_numpy(self.tokens[self.offsets[item] : self.offsets[item + 1]].astype(np.int64))
+
+
+class TextDataset(TokenArrayDataset):
+    def __init__(self, tokenizer: PreTrainedTokenizer, args, file_path, mode, block_size=512, pool=None):
+        file_paths = get_input_files(file_path)
+        for path in file_paths:
+            assert os.path.isfile(path)
 
         block_size = block_size - (tokenizer.max_len - tokenizer.max_len_single_sentence)
 
-        directory, filename = os.path.split(file_path)
+        if len(file_paths) == 1:
+            directory, filename = os.path.split(file_paths[0])
+        else:
+            filename = get_cache_key([os.path.abspath(path) for path in file_paths])
         cached_features_file = os.path.join(
             args["cache_dir"], args["model_type"] + "_cached_lm_" + str(block_size) + "_" + filename
         )
 
-        if os.path.exists(cached_features_file) and (
+        if os.path.isdir(cached_features_file) and (
             (not args["reprocess_input_data"] and not args["no_cache"])
             or (mode == "dev" and args["use_cached_eval_features"] and not args["no_cache"])
         ):
             logger.info(" Loading features from cached file %s", cached_features_file)
-            with open(cached_features_file, "rb") as handle:
-                self.examples = pickle.load(handle)
         else:
             logger.info(" Creating features from dataset file at %s", args["cache_dir"])
 
-            self.examples = []
-            with open(file_path, encoding="utf-8") as f:
-                text = f.read()
-
             # tokenizer = ByteLevelBPETokenizer(
             #     "outputs/vocab.json",
             #     "outputs/merges.txt",
@@ -55,20 +81,15 @@ class TextDataset(Dataset):
             # logger.info(" Encoded")
             # self.examples = [tokenized_text[i : i + block_size] for i in tqdm(range(0, len(tokenized_text) - block_size + 1, block_size))] # noqa
 
-            tokenized_text = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
-            tokenized_text_split = [
-                tokenized_text[i : i + block_size]
-                for i in tqdm(range(0, len(tokenized_text) - block_size + 1, block_size))
-            ]
-
-            with Pool(args["process_count"]) as p:
-                self.examples = list(
-                    tqdm(
-                        p.imap(tokenizer.build_inputs_with_special_tokens, tokenized_text_split, chunksize=500),
-                        total=len(tokenized_text_split),
-                        # disable=silent,
-                    )
+            # Blocks do not span files
+            file_blocks = [
+                build_token_blocks(
+                    tokenizer, np.concatenate([np.load(shard_path) for shard_path in shard_paths]), block_size
                 )
+                for shard_paths in tokenize_corpus(tokenizer, args, file_paths, pool=pool)
+            ]
+            tokens = np.concatenate([blocks for blocks, block_lengths in file_blocks])
+            offsets = get_offsets(np.concatenate([block_lengths for blocks, block_lengths in file_blocks]))
 
             # for i in range(0, len(tokenized_text) - block_size + 1, block_size):  # Truncate in block of block_size
             #     self.examples.append(tokenizer.build_inputs_with_special_tokens(tokenized_text[i : i + block_size]))
@@ -77,18 +98,13 @@ class TextDataset(Dataset):
             # can change this behavior by adding (model specific) padding.
 
             logger.info(" Saving features into cached file %s", cached_features_file)
-            with open(cached_features_file, "wb") as handle:
-                pickle.dump(self.examples, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-    def __len__(self):
-        return len(self.examples)
+            save_token_arrays(cached_features_file, tokens, offsets)
 
-    def __getitem__(self, item):
-        return torch.tensor(self.examples[item], dtype=torch.long)
+        self._load_token_arrays(cached_features_file)
 
 
 class LineByLineTextDataset(Dataset):
-    def __init__(self, tokenizer: PreTrainedTokenizer, args, file_path: str, block_size=512):
+    def __init__(self, tokenizer: PreTrainedTokenizer, args, file_path: str, block_size=512, packing=False):
         assert os.path.isfile(file_path)
         # Here, we do not cache the features, operating under the assumption
         # that we will soon use fast multithreaded tokenizers from the
@@ -110,6 +126,21 @@ class LineByLineTextDataset(Dataset):
 
         # self.examples = tokenizer.batch_encode_plus(lines, add_special_tokens=True, max_length=block_size)["input_ids"] # noqa
 
+        if packing:
+            n_tokens = sum(len(example) for example in self.examples)
+            unpacked_efficiency = n_tokens / max(len(self.examples), 1) / block_size
+            self.examples = pack_sequences(self.examples, block_size)
+            # Fraction of non-pad tokens if every sequence is padded to block_size. Counted after packing, since
+            # packing drops the <s> token of every sequence appended to a packed sequence.
+            self.packing_efficiency = sum(map(len, self.examples)) / (max(len(self.examples), 1) * block_size)
+            logger.info(
+                " Packed %d lines into %d sequences. Packing efficiency: %.1f%% (%.1f%% without packing)",
+                len(lines),
+                len(self.examples),
+                self.packing_efficiency * 100,
+                unpacked_efficiency * 100,
+            )
+
     def __len__(self):
         return len(self.examples)
 
@@ -117,6 +148,259 @@ class LineByLineTextDataset(Dataset):
         return torch.tensor(self.examples[i], dtype=torch.long)
 
 
+class StreamingTextDataset(IterableDataset):
+    """
+    Iterable dataset reading, tokenizing and packing text files lazily, for corpora that do not fit in memory.
+
+    Lines are tokenized as they are read and their tokens are packed into blocks of block_size tokens (special tokens
+    included), like TextDataset. When the dataset is iterated by several DataLoader workers, each worker reads and
+    tokenizes its own byte range of every file. Blocks are shuffled through a buffer of shuffle_buffer_size blocks, so
+    memory use does not depend on the size of the corpus. The dataset has no length.
+    """
+
+    def __init__(
+        self, tokenizer: PreTrainedTokenizer, args, file_path, block_size=512, shuffle=True, shuffle_buffer_size=10000
+    ):
+        self.file_paths = get_input_files(file_path)
+        for path in self.file_paths:
+            assert os.path.isfile(path)
+
+        self.tokenizer = tokenizer
+        self.block_size = block_size - (tokenizer.max_len - tokenizer.max_len_single_sentence)
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = args["manual_seed"] if args["manual_seed"] is not None else 0
+        # Shared with the DataLoader workers, which keep their own copy of the dataset when they are persistent
+        self._epoch = multiprocessing.Value("i", 0, lock=False)
+
+    @property
+    def epoch(self):
+        return self._epoch.value
+
+    def set_epoch(self, epoch):
+        """Sets the epoch used to seed the shuffling, so that every pass over the data is shuffled differently."""
+        self._epoch.value = epoch
+
+    def _read_lines(self, worker_id, num_workers):
+        for file_path in self.file_paths:
+            file_size = os.path.getsize(file_path)
+            start = file_size * worker_id // num_workers
+            end = file_size * (worker_id + 1) // num_workers
+            with open(file_path, "rb") as f:
+                # A line belongs to the worker whose byte range contains its first byte
+                if start > 0:
+                    f.seek(start - 1)
+                    f.readline()
+                while f.tell() < end:
+                    line = f.readline()
+                    if not line:
+                        break
+                    line = line.decode("utf-8").strip()
+                    if line:
+                        yield line
+
+    def _pack_blocks(self, lines):
+        tokenizer = self.tokenizer
+        tokens = []
+        for line in lines:
+            tokens.extend(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(line)))
+            if len(tokens) >= self.block_size:
+                n_full = len(tokens) - len(tokens) % self.block_size
+                for i in range(0, n_full, self.block_size):
+                    yield tokenizer.build_inputs_with_special_tokens(tokens[i : i + self.block_size])
+                tokens = tokens[n_full:]
+        # As in TextDataset, the last truncated block is dropped
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+
+        blocks = self._pack_blocks(self._read_lines(worker_id, num_workers))
+        if not self.shuffle:
+            for block in blocks:
+                yield torch.tensor(block, dtype=torch.long)
+            return
+
+        rng = random.Random(hash((self.seed, self.epoch, worker_id)))
+        buffer = []
+        for block in blocks:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(block)
+                continue
+            i = rng.randrange(len(buffer))
+            yield torch.tensor(buffer[i], dtype=torch.long)
+            buffer[i] = block
+        rng.shuffle(buffer)
+        for block in buffer:
+            yield torch.tensor(block, dtype=torch.long)
+
+
+def pack_sequences(sequences, block_size):
+    """
+    Greedily concatenates consecutive sequences into sequences of at most block_size tokens.
+
+    Each sequence is expected to start with a <s> token and end with a </s> token. The <s> token of every sequence
+    after the first one in a packed sequence is dropped, so that sequences are separated by a single </s> token.
+    """
+    packed = []
+    current = []
+    for sequence in sequences:
+        if current and len(current) + len(sequence) - 1 <= block_size:
+            current.extend(sequence[1:])
+        else:
+            if current:
+                packed.append(current)
+            current = list(sequence)
+    if current:
+        packed.append(current)
+    return packed
+
+
+def get_input_files(file_path):
+    """
+    Returns the sorted list of files given by file_path.
+    file_path can be the path to a file, a directory (all files in it), a glob pattern, or a list of these.
+    """
+    if not isinstance(file_path, str):
+        return [path for item in file_path for path in get_input_files(item)]
+    if os.path.isdir(file_path):
+        return sorted(
+            os.path.join(file_path, name)
+            for name in os.listdir(file_path)
+            if os.path.isfile(os.path.join(file_path, name)) and not name.startswith(".")
+        )
+    if glob.has_magic(file_path):
+        file_paths = sorted(path for path in glob.glob(file_path) if os.path.isfile(path))
+        if not file_paths:
+            raise ValueError("No files match {}".format(file_path))
+        return file_paths
+    return [file_path]
+
+
+def get_line_aligned_shards(file_path, shard_size):
+    """Splits a file into byte ranges of about shard_size bytes, each ending at the end of a line."""
+    file_size = os.path.getsize(file_path)
+    boundaries = [0]
+    with open(file_path, "rb") as f:
+        while boundaries[-1] < file_size:
+            f.seek(min(boundaries[-1] + shard_size, file_size) - 1)
+            f.readline()
+            boundaries.append(f.tell())
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def tokenize_shard(data):
+    tokenizer, file_path, start, end, output_path = data
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    token_ids = np.array(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text)), dtype=np.int64)
+
+    # Written under a temporary name first, an existing shard file is always complete
+    tmp_path = "{}.tmp-{}".format(output_path, uuid.uuid4().hex)
+    with open(tmp_path, "wb") as f:
+        np.save(f, token_ids)
+    os.replace(tmp_path, output_path)
+    return len(token_ids)
+
+
+def tokenize_corpus(tokenizer, args, file_paths, pool=None):
+    """
+    Tokenizes text files in line aligned shards of args["tokenization_shard_size"] bytes, in parallel.
+
+    The token ids of each shard are saved to their own .npy file in cache_dir. Shards already tokenized by a previous,
+    possibly interrupted, run with the same file and tokenizer are not tokenized again.
+
+    Returns:
+        A list containing the list of shard .npy files of each file, in order.
+    """
+    tokenizer_key = hash_tokenizer(tokenizer)
+    use_pool = args["use_multiprocessing"] and pool is not None
+    row_tokenizer = WorkerTokenizer() if use_pool else tokenizer
+
+    all_shard_paths = []
+    pending = []
+    for file_path in file_paths:
+        file_stat = os.stat(file_path)
+        shard_dir = os.path.join(
+            args["cache_dir"],
+            "tokenized_shards",
+            get_cache_key(
+                os.path.abspath(file_path),
+                file_stat.st_size,
+                file_stat.st_mtime_ns,
+                tokenizer_key,
+                args["tokenization_shard_size"],
+            ),
+        )
+        os.makedirs(shard_dir, exist_ok=True)
+
+        shard_paths = []
+        for i, (start, end) in enumerate(get_line_aligned_shards(file_path, args["tokenization_shard_size"])):
+            shard_path = os.path.join(shard_dir, "{:06d}.npy".format(i))
+            shard_paths.append(shard_path)
+            if not os.path.exists(shard_path):
+                pending.append((row_tokenizer, file_path, start, end, shard_path))
+        all_shard_paths.append(shard_paths)
+
+    n_shards = sum(len(shard_paths) for shard_paths in all_shard_paths)
+    if len(pending) < n_shards:
+        logger.info(" Reusing %d previously tokenized shards", n_shards - len(pending))
+    if pending:
+        logger.info(" Tokenizing %d shards", len(pending))
+        if use_pool:
+            results = pool.imap(tokenize_shard, pending, (tokenizer,), args["process_count"], chunksize=1)
+        else:
+            results = map(tokenize_shard, pending)
+        for _ in tqdm(results, total=len(pending), disable=args["silent"]):
+            pass
+
+    return all_shard_paths
+
+
+def get_offsets(lengths):
+    """Returns the offsets of sequences of the given lengths in a flat array, with the total length appended."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def save_token_arrays(cache_path, tokens, offsets):
+    """
+    Saves token id sequences, given as a flat token array and their offsets, to the directory cache_path.
+    Token ids are stored as uint16 if they all fit, int32 otherwise.
+    """
+    token_dtype = np.uint16 if len(tokens) == 0 or tokens.max() < 2 ** 16 else np.int32
+    save_arrays(cache_path, {"tokens": tokens.astype(token_dtype), "offsets": offsets})
+
+
+def build_token_blocks(tokenizer, token_ids, block_size):
+    """
+    Splits a token id array into blocks of block_size tokens with special tokens added. The last partial block is
+    dropped.
+
+    Returns:
+        A flat array of the tokens of all blocks, and the length of each block.
+    """
+    n_blocks = len(token_ids) // block_size
+    blocks = token_ids[: n_blocks * block_size].reshape(n_blocks, block_size)
+
+    # The special tokens are found by building the inputs of a single placeholder token
+    template = tokenizer.build_inputs_with_special_tokens([-1])
+    if template.count(-1) == 1:
+        position = template.index(-1)
+        prefix = np.tile(np.array(template[:position], dtype=token_ids.dtype), (n_blocks, 1))
+        suffix = np.tile(np.array(template[position + 1 :], dtype=token_ids.dtype), (n_blocks, 1))
+        blocks = np.concatenate([prefix, blocks, suffix], axis=1)
+        return blocks.ravel(), np.full(n_blocks, blocks.shape[1], dtype=np.int64)
+
+    blocks = [tokenizer.build_inputs_with_special_tokens(block.tolist()) for block in blocks]
+    return (
+        np.fromiter(itertools.chain.from_iterable(blocks), dtype=np.int64),
+        np.fromiter(map(len, blocks), dtype=np.int64, count=len(blocks)),
+    )
+
+
 def encode(data):
     tokenizer, line = data
     return tokenizer.convert_tokens_to_ids(tokenizer.tokenize(line))
@@ -157,8 +441,18 @@ def encode_sliding_window(data):
     return features
 
 
-class SimpleDataset(Dataset):
-    def __init__(self, tokenizer, args, file_path, mode, block_size=512, special_tokens_count=2, sliding_window=False):
+class SimpleDataset(TokenArrayDataset):
+    def __init__(
+        self,
+        tokenizer,
+        args,
+        file_path,
+        mode,
+        block_size=512,
+        special_tokens_count=2,
+        sliding_window=False,
+        pool=None,
+    ):
         assert os.path.isfile(file_path)
         block_size = block_size - special_tokens_count
         directory, filename = os.path.split(file_path)
@@ -166,28 +460,36 @@ class SimpleDataset(Dataset):
             args["cache_dir"], args["model_type"] + "_cached_lm_" + str(block_size) + "_" + filename
         )
 
-        if os.path.exists(cached_features_file) and (
+        if os.path.isdir(cached_features_file) and (
             (not args["reprocess_input_data"] and not args["no_cache"])
             or (mode == "dev" and args["use_cached_eval_features"] and not args["no_cache"])
         ):
             logger.info(" Loading features from cached file %s", cached_features_file)
-            with open(cached_features_file, "rb") as handle:
-                self.examples = pickle.load(handle)
         else:
             logger.info(" Creating features from dataset file at %s", args["cache_dir"])
 
+            use_pool = args["use_multiprocessing"] and pool is not None
+            row_tokenizer = WorkerTokenizer() if use_pool else tokenizer
+
             if sliding_window:
                 no_padding = True if args["model_type"] in ["gpt2", "openai-gpt"] else False
                 with open(file_path, encoding="utf-8") as f:
                     lines = [
-                        (tokenizer, line, args["max_seq_length"], special_tokens_count, args["stride"], no_padding)
+                        (row_tokenizer, line, args["max_seq_length"], special_tokens_count, args["stride"], no_padding)
                         for line in f.read().splitlines()
                         if (len(line) > 0 and not line.isspace())
                     ]
 
-                if args["use_multiprocessing"]:
+                if use_pool:
+                    encoded = list(
+                        tqdm(
+                            pool.imap(encode_sliding_window, lines, (tokenizer,), args["process_count"], chunksize=50),
+                            total=len(lines),
+                        )
+                    )
+                elif args["use_multiprocessing"]:
                     with Pool(args["process_count"]) as p:
-                        self.examples = list(
+                        encoded = list(
                             tqdm(
                                 p.imap(encode_sliding_window, lines, chunksize=50),
                                 total=len(lines),
@@ -195,18 +497,26 @@ class SimpleDataset(Dataset):
                             )
                         )
                 else:
-                    self.examples = [encode_sliding_window(line) for line in lines]
+                    encoded = [encode_sliding_window(line) for line in lines]
 
-                self.examples = [example for example_set in self.examples for example in example_set]
+                examples = [example for example_set in encoded for example in example_set]
+                tokens = np.fromiter(itertools.chain.from_iterable(examples), dtype=np.int64)
+                offsets = get_offsets(np.fromiter(map(len, examples), dtype=np.int64, count=len(examples)))
             else:
                 with open(file_path, encoding="utf-8") as f:
                     lines = [
-                        (tokenizer, line) for line in f.read().splitlines() if (len(line) > 0 and not line.isspace())
+                        (row_tokenizer, line)
+                        for line in f.read().splitlines()
+                        if (len(line) > 0 and not line.isspace())
                     ]
 
-                if args["use_multiprocessing"]:
+                if use_pool:
+                    encoded = list(
+                        tqdm(pool.imap(encode, lines, (tokenizer,), args["process_count"]), total=len(lines))
+                    )
+                elif args["use_multiprocessing"]:
                     with Pool(args["process_count"]) as p:
-                        self.examples = list(
+                        encoded = list(
                             tqdm(
                                 p.imap(encode, lines, chunksize=500),
                                 total=len(lines),
@@ -214,23 +524,46 @@ class SimpleDataset(Dataset):
                             )
                         )
                 else:
-                    self.examples = [encode(line) for line in lines]
+                    encoded = [encode(line) for line in lines]
 
-                self.examples = [token for tokens in self.examples for token in tokens]
-                self.examples = [
-                    tokenizer.build_inputs_with_special_tokens(self.examples[i : i + block_size])
-                    for i in tqdm(range(0, len(self.examples) - block_size + 1, block_size))
-                ]
+                tokens, block_lengths = build_token_blocks(
+                    tokenizer, np.fromiter(itertools.chain.from_iterable(encoded), dtype=np.int64), block_size
+                )
+                offsets = get_offsets(block_lengths)
 
             logger.info(" Saving features into cached file %s", cached_features_file)
-            with open(cached_features_file, "wb") as handle:
-                pickle.dump(self.examples, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            save_token_arrays(cached_features_file, tokens, offsets)
 
-    def __len__(self):
-        return len(self.examples)
+        self._load_token_arrays(cached_features_file)
 
-    def __getitem__(self, item):
-        return torch.tensor(self.examples[item], dtype=torch.long)
+
+def truncate_batch(inputs, block_size, labels=None, pad_token_id=None, keep_last_token=False):
+    """
+    Truncates a right padded batch of sequences (and their labels) to at most block_size tokens.
+
+    If keep_last_token is True, the last token of each truncated sequence (usually a special token like [SEP] or </s>)
+    is kept in place of the token at position block_size - 1.
+    """
+    if inputs.shape[1] <= block_size:
+        return inputs, labels
+
+    positions = torch.arange(block_size, device=inputs.device).expand(inputs.shape[0], -1)
+    if keep_last_token:
+        if pad_token_id is None:
+            lengths = torch.full((inputs.shape[0],), inputs.shape[1], dtype=torch.long, device=inputs.device)
+        else:
+            is_token = inputs.ne(pad_token_id)
+            if labels is not None:
+                # A masked position may have been replaced with the padding token id
+                is_token = is_token | labels.ne(-100)
+            lengths = is_token.sum(dim=1)
+        positions = positions.clone()
+        positions[:, -1] = torch.where(lengths > block_size, lengths - 1, positions[:, -1])
+
+    inputs = inputs.gather(1, positions)
+    if labels is not None:
+        labels = labels.gather(1, positions)
+    return inputs, labels
 
 
 def mask_tokens(inputs: torch.Tensor, tokenizer: PreTrainedTokenizer, args) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -267,3 +600,57 @@ def mask_tokens(inputs: torch.Tensor, tokenizer: PreTrainedTokenizer, args) -> T
 
     # The rest of the time (10% of the time) we keep the masked input tokens unchanged
     return inputs, labels
+
+
+class TokenMasker:
+    """
+    Prepares masked token inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
+
+    Same masking as mask_tokens(), but vectorized. Special tokens are looked up in a precomputed boolean tensor indexed
+    by token id instead of with the tokenizer, so a whole batch is masked in a few tensor operations on the device the
+    batch is on. A TokenMasker can also be used in the collate function of a DataLoader to mask in its workers.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, mlm_probability=0.15):
+        if tokenizer.mask_token is None:
+            raise ValueError(
+                "This tokenizer does not have a mask token which is necessary for masked language modeling."
+                "Set 'mlm' to False in args if you want to use this tokenizer."
+            )
+
+        self.mlm_probability = mlm_probability
+        self.mask_token_id = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
+        self.vocab_size = len(tokenizer)
+
+        # Padding is never masked, as in mask_tokens()
+        special_tokens_mask = tokenizer.get_special_tokens_mask(
+            list(range(self.vocab_size)), already_has_special_tokens=True
+        )
+        self.special_tokens_lookup = torch.tensor(special_tokens_mask, dtype=torch.bool)
+        if tokenizer._pad_token is not None:
+            self.special_tokens_lookup[tokenizer.pad_token_id] = True
+        self._device_lookups = {}
+
+    def __call__(self, inputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        if inputs.device not in self._device_lookups:
+            self._device_lookups[inputs.device] = self.special_tokens_lookup.to(inputs.device)
+        special_tokens = self._device_lookups[inputs.device][inputs]
+
+        masked_indices = (torch.rand(inputs.shape, device=inputs.device) < self.mlm_probability) & ~special_tokens
+        labels = inputs.masked_fill(~masked_indices, -100)  # We only compute loss on masked tokens
+
+        # 80% MASK, 10% random word, 10% unchanged
+        replacement = torch.rand(inputs.shape, device=inputs.device)
+        inputs = inputs.masked_fill(masked_indices & (replacement < 0.8), self.mask_token_id)
+
+        indices_random = masked_indices & (replacement >= 0.8) & (replacement < 0.9)
+        random_words = torch.randint(self.vocab_size, inputs.shape, dtype=inputs.dtype, device=inputs.device)
+        inputs = torch.where(indices_random, random_words, inputs)
+
+        return inputs, labels
+
+    def __getstate__(self):
+        # Device copies of the lookup are not sent to DataLoader workers
+        state = self.__dict__.copy()
+        state["_device_lookups"] = {}
+        return state
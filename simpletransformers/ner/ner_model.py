@@ -16,6 +16,15 @@ from tqdm.auto import tqdm, trange
 import pandas as pd
 import torch
 from simpletransformers.config.global_args import global_args
+from simpletransformers.dataloader_utils import TensorBatchSampler, get_batch_sliced_dataloader
+from simpletransformers.feature_cache import (
+    FeatureStore,
+    get_cache_key,
+    get_example_digests,
+    hash_tokenizer,
+    load_feature_arrays,
+    save_feature_arrays,
+)
 from simpletransformers.ner.ner_utils import (
     InputExample,
     convert_examples_to_features,
@@ -23,9 +32,10 @@ from simpletransformers.ner.ner_utils import (
     get_labels,
     read_examples_from_file,
 )
+from simpletransformers.tokenization_pool import TokenizationPool
 from tensorboardX import SummaryWriter
 from torch.nn import CrossEntropyLoss
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import TensorDataset
 from transformers import (
     WEIGHTS_NAME,
     AdamW,
@@ -155,6 +165,8 @@ class NERModel:
             self.device = "cpu"
 
         self.results = {}
+        self.tokenization_pool = TokenizationPool()
+        self.eval_data_cache = None
 
         self.tokenizer = tokenizer_class.from_pretrained(
             model_name, do_lower_case=self.args["do_lower_case"], **kwargs
@@ -232,9 +244,17 @@ class NERModel:
 
         os.makedirs(output_dir, exist_ok=True)
 
-        global_step, tr_loss = self.train(
-            train_dataset, output_dir, show_running_loss=show_running_loss, eval_data=eval_data, **kwargs
-        )
+        if self.args["evaluate_during_training"]:
+            # The eval dataset is built once and reused by every evaluation of this train_model() call, so
+            # changes made to the eval data during training are not seen
+            self.eval_data_cache = self.load_and_cache_examples(eval_data, evaluate=True)
+
+        try:
+            global_step, tr_loss = self.train(
+                train_dataset, output_dir, show_running_loss=show_running_loss, eval_data=eval_data, **kwargs
+            )
+        finally:
+            self.eval_data_cache = None
 
         model_to_save = self.model.module if hasattr(self.model, "module") else self.model
         model_to_save.save_pretrained(output_dir)
@@ -255,8 +275,8 @@ class NERModel:
         args = self.args
 
         tb_writer = SummaryWriter(logdir=args["tensorboard_dir"])
-        train_sampler = RandomSampler(train_dataset)
-        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args["train_batch_size"])
+        train_sampler = TensorBatchSampler(len(train_dataset), args["train_batch_size"], shuffle=True)
+        train_dataloader = get_batch_sliced_dataloader(train_dataset, train_sampler, args)
 
         t_total = len(train_dataloader) // args["gradient_accumulation_steps"] * args["num_train_epochs"]
 
@@ -586,7 +606,10 @@ class NERModel:
 
         self._move_model_to_device()
 
-        eval_dataset = self.load_and_cache_examples(eval_data, evaluate=True)
+        if self.eval_data_cache is not None:
+            eval_dataset = self.eval_data_cache
+        else:
+            eval_dataset = self.load_and_cache_examples(eval_data, evaluate=True)
 
         result, model_outputs, preds_list = self.evaluate(
             eval_dataset, output_dir, verbose=verbose, silent=silent, **kwargs
@@ -613,13 +636,12 @@ class NERModel:
 
         results = {}
 
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"])
+        eval_sampler = TensorBatchSampler(len(eval_dataset), args["eval_batch_size"], shuffle=False)
+        eval_dataloader = get_batch_sliced_dataloader(eval_dataset, eval_sampler, args)
 
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
+        preds = []
         model.eval()
 
         for batch in tqdm(eval_dataloader, disable=args["silent"] or silent):
@@ -641,14 +663,12 @@ class NERModel:
 
             nb_eval_steps += 1
 
-            if preds is None:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = inputs["labels"].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+            preds.append(logits.detach().cpu().numpy())
 
         eval_loss = eval_loss / nb_eval_steps
+        preds = np.concatenate(preds)
+        # The batches are not shuffled, so the labels are in the same order as the dataset
+        out_label_ids = eval_dataset.tensors[3].numpy()
         model_outputs = preds
         preds = np.argmax(preds, axis=2)
 
@@ -723,13 +743,12 @@ class NERModel:
 
         eval_dataset = self.load_and_cache_examples(None, to_predict=predict_examples)
 
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"])
+        eval_sampler = TensorBatchSampler(len(eval_dataset), args["eval_batch_size"], shuffle=False)
+        eval_dataloader = get_batch_sliced_dataloader(eval_dataset, eval_sampler, args)
 
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
+        preds = []
         model.eval()
 
         for batch in tqdm(eval_dataloader, disable=args["silent"]):
@@ -751,20 +770,12 @@ class NERModel:
 
             nb_eval_steps += 1
 
-            if preds is None:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = inputs["labels"].detach().cpu().numpy()
-                out_input_ids = inputs["input_ids"].detach().cpu().numpy()
-                out_attention_mask = inputs["attention_mask"].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
-                out_input_ids = np.append(out_input_ids, inputs["input_ids"].detach().cpu().numpy(), axis=0)
-                out_attention_mask = np.append(
-                    out_attention_mask, inputs["attention_mask"].detach().cpu().numpy(), axis=0,
-                )
+            preds.append(logits.detach().cpu().numpy())
 
         eval_loss = eval_loss / nb_eval_steps
+        preds = np.concatenate(preds)
+        # The batches are not shuffled, so the features are in the same order as the dataset
+        out_input_ids, out_attention_mask, _, out_label_ids = (tensor.numpy() for tensor in eval_dataset.tensors)
         token_logits = preds
         preds = np.argmax(preds, axis=2)
 
@@ -830,7 +841,8 @@ class NERModel:
 
     def load_and_cache_examples(self, data, evaluate=False, no_cache=False, to_predict=None):
         """
-        Reads data_file and generates a TensorDataset containing InputFeatures. Caches the InputFeatures.
+        Reads data_file and generates a TensorDataset containing InputFeatures. Caches the features as memory-mapped
+        arrays keyed by the tokenizer, the conversion args and the contents of the examples.
         Utility function for train() and eval() methods. Not intended to be used directly.
 
         Args:
@@ -841,8 +853,6 @@ class NERModel:
 
         """  # noqa: ignore flake8"
 
-        process_count = self.args["process_count"]
-
         tokenizer = self.tokenizer
         args = self.args
 
@@ -860,58 +870,126 @@ class NERModel:
             examples = to_predict
             no_cache = True
 
-        cached_features_file = os.path.join(
-            args["cache_dir"],
-            "cached_{}_{}_{}_{}_{}".format(
-                mode, args["model_type"], args["max_seq_length"], self.num_labels, len(examples),
-            ),
+        use_cached_features = not no_cache and (
+            not args["reprocess_input_data"] or (mode == "dev" and args["use_cached_eval_features"])
         )
+
         if not no_cache:
             os.makedirs(self.args["cache_dir"], exist_ok=True)
 
-        if os.path.exists(cached_features_file) and (
-            (not args["reprocess_input_data"] and not no_cache)
-            or (mode == "dev" and args["use_cached_eval_features"] and not no_cache)
-        ):
-            features = torch.load(cached_features_file)
-            logger.info(f" Features loaded from cache at {cached_features_file}")
-        else:
-            logger.info(f" Converting to features started.")
-            features = convert_examples_to_features(
-                examples,
+            conversion_key = get_cache_key(
+                hash_tokenizer(tokenizer),
+                args["model_type"],
+                args["max_seq_length"],
                 self.labels,
-                self.args["max_seq_length"],
-                self.tokenizer,
-                # XLNet has a CLS token at the end
-                cls_token_at_end=bool(args["model_type"] in ["xlnet"]),
-                cls_token=tokenizer.cls_token,
-                cls_token_segment_id=2 if args["model_type"] in ["xlnet"] else 0,
-                sep_token=tokenizer.sep_token,
-                # RoBERTa uses an extra separator b/w pairs of sentences,
-                # cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
-                sep_token_extra=bool(args["model_type"] in ["roberta"]),
-                # PAD on the left for XLNet
-                pad_on_left=bool(args["model_type"] in ["xlnet"]),
-                pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-                pad_token_segment_id=4 if args["model_type"] in ["xlnet"] else 0,
-                pad_token_label_id=self.pad_token_label_id,
-                process_count=process_count,
-                silent=args["silent"],
-                use_multiprocessing=args["use_multiprocessing"],
+                self.pad_token_label_id,
+            )
+            example_digests = get_example_digests((e.words, e.labels) for e in examples)
+            cached_features_file = os.path.join(
+                args["cache_dir"],
+                "cached_{}_{}_{}_{}_{}".format(
+                    mode,
+                    args["model_type"],
+                    args["max_seq_length"],
+                    self.num_labels,
+                    get_cache_key(conversion_key, example_digests),
+                ),
             )
 
-            if not no_cache:
-                torch.save(features, cached_features_file)
+        if use_cached_features and os.path.isdir(cached_features_file):
+            feature_arrays, _ = load_feature_arrays(cached_features_file)
+            logger.info(f" Features loaded from cache at {cached_features_file}")
+        else:
+            if use_cached_features:
+                feature_store = FeatureStore(os.path.join(args["cache_dir"], "feature_store_" + conversion_key))
+                positions = feature_store.lookup(example_digests)
+
+                # Duplicate examples only need to be converted once
+                new_examples = np.flatnonzero(positions < 0)
+                new_examples = np.sort(new_examples[np.unique(example_digests[new_examples], return_index=True)[1]])
+                logger.info(f" Reusing features of {np.count_nonzero(positions >= 0)} examples from the feature store.")
+
+                if len(new_examples) > 0:
+                    feature_store.add(
+                        example_digests[new_examples],
+                        self._convert_examples_to_feature_arrays([examples[i] for i in new_examples]),
+                        [1] * len(new_examples),
+                    )
+                    positions = feature_store.lookup(example_digests)
+
+                if args["feature_store_max_examples"] and len(feature_store) > args["feature_store_max_examples"]:
+                    # Only the examples of this call are kept
+                    feature_store.compact(example_digests)
+                    positions = feature_store.lookup(example_digests)
+
+                feature_arrays, _ = feature_store.gather(positions)
+            else:
+                feature_arrays = self._convert_examples_to_feature_arrays(examples)
 
-        all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_ids for f in features], dtype=torch.long)
+            if not no_cache:
+                save_feature_arrays(cached_features_file, feature_arrays)
+                feature_arrays, _ = load_feature_arrays(cached_features_file)
 
-        dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        dataset = TensorDataset(*(torch.from_numpy(array) for array in feature_arrays))
 
         return dataset
 
+    def _convert_examples_to_feature_arrays(self, examples):
+        """
+        Converts a list of InputExample objects to feature arrays (input_ids, input_mask, segment_ids, label_ids).
+        Utility function for load_and_cache_examples(). Not intended to be used directly.
+        """
+
+        tokenizer = self.tokenizer
+        args = self.args
+
+        logger.info(f" Converting to features started.")
+        features = convert_examples_to_features(
+            examples,
+            self.labels,
+            self.args["max_seq_length"],
+            self.tokenizer,
+            # XLNet has a CLS token at the end
+            cls_token_at_end=bool(args["model_type"] in ["xlnet"]),
+            cls_token=tokenizer.cls_token,
+            cls_token_segment_id=2 if args["model_type"] in ["xlnet"] else 0,
+            sep_token=tokenizer.sep_token,
+            # RoBERTa uses an extra separator b/w pairs of sentences,
+            # cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
+            sep_token_extra=bool(args["model_type"] in ["roberta"]),
+            # PAD on the left for XLNet
+            pad_on_left=bool(args["model_type"] in ["xlnet"]),
+            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+            pad_token_segment_id=4 if args["model_type"] in ["xlnet"] else 0,
+            pad_token_label_id=self.pad_token_label_id,
+            process_count=args["process_count"],
+            silent=args["silent"],
+            use_multiprocessing=args["use_multiprocessing"],
+            pool=self.tokenization_pool,
+        )
+
+        return (
+            np.array([f.input_ids for f in features], dtype=np.int64).reshape(-1, args["max_seq_length"]),
+            np.array([f.input_mask for f in features], dtype=np.int64).reshape(-1, args["max_seq_length"]),
+            np.array([f.segment_ids for f in features], dtype=np.int64).reshape(-1, args["max_seq_length"]),
+            np.array([f.label_ids for f in features], dtype=np.int64).reshape(-1, args["max_seq_length"]),
+        )
+
+    def close(self):
+        """
+        Shuts down the worker processes used to convert examples to features.
+
+        The workers are started again if the model converts examples to features after closing. The model can also be
+        used as a context manager, which closes it on exit.
+        """
+        self.tokenization_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def _move_model_to_device(self):
         self.model.to(self.device)
 
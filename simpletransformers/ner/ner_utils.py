@@ -25,6 +25,7 @@ from multiprocessing import Pool, cpu_count
 from tqdm.auto import tqdm
 
 import pandas as pd
+from simpletransformers.tokenization_pool import WorkerTokenizer
 
 
 class InputExample(object):
@@ -203,12 +204,14 @@ def convert_examples_to_features(
     chunksize=500,
     silent=False,
     use_multiprocessing=True,
+    pool=None,
 ):
     """ Loads a data file into a list of `InputBatch`s
         `cls_token_at_end` define the location of the CLS token:
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `pool` is an optional TokenizationPool to use instead of starting a new multiprocessing Pool
     """
 
     label_map = {label: i for i, label in enumerate(label_list)}
@@ -218,7 +221,7 @@ def convert_examples_to_features(
             example,
             label_map,
             max_seq_length,
-            tokenizer,
+            WorkerTokenizer() if use_multiprocessing and pool is not None else tokenizer,
             cls_token_at_end,
             cls_token,
             cls_token_segment_id,
@@ -234,7 +237,15 @@ def convert_examples_to_features(
         for example in examples
     ]
 
-    if use_multiprocessing:
+    if use_multiprocessing and pool is not None:
+        features = list(
+            tqdm(
+                pool.imap(convert_example_to_feature, examples, (tokenizer,), process_count, chunksize=chunksize),
+                total=len(examples),
+                disable=silent,
+            )
+        )
+    elif use_multiprocessing:
         with Pool(process_count) as p:
             features = list(
                 tqdm(
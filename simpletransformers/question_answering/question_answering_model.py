@@ -22,20 +22,22 @@ import pandas as pd
 import torch
 from simpletransformers.config.global_args import global_args
 from simpletransformers.custom_models.models import ElectraForQuestionAnswering
+from simpletransformers.dataloader_utils import TensorBatchSampler, get_batch_sliced_dataloader
+from simpletransformers.feature_cache import get_cache_key, get_example_digests, hash_tokenizer
 from simpletransformers.question_answering.question_answering_utils import (
-    RawResult,
+    RawResultArrays,
     RawResultExtended,
     build_examples,
     convert_examples_to_features,
     get_best_predictions,
     get_best_predictions_extended,
     get_examples,
-    to_list,
     write_predictions,
     write_predictions_extended,
 )
+from simpletransformers.tokenization_pool import TokenizationPool
 from tensorboardX import SummaryWriter
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from transformers import (
     WEIGHTS_NAME,
@@ -49,11 +51,14 @@ from transformers import (
     BertConfig,
     BertForQuestionAnswering,
     BertTokenizer,
+    BertTokenizerFast,
     DistilBertConfig,
     DistilBertForQuestionAnswering,
     DistilBertTokenizer,
+    DistilBertTokenizerFast,
     ElectraConfig,
     ElectraTokenizer,
+    ElectraTokenizerFast,
     RobertaConfig,
     RobertaForQuestionAnswering,
     RobertaTokenizer,
@@ -76,6 +81,13 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Only WordPiece tokenizers, which give the same tokens for a whole context as for each of its words
+FAST_TOKENIZER_CLASSES = {
+    "bert": BertTokenizerFast,
+    "distilbert": DistilBertTokenizerFast,
+    "electra": ElectraTokenizerFast,
+}
+
 
 class QuestionAnsweringModel:
     def __init__(self, model_type, model_name, args=None, use_cuda=True, cuda_device=-1, **kwargs):
@@ -116,6 +128,7 @@ class QuestionAnsweringModel:
             "n_best_size": 20,
             "max_answer_length": 100,
             "null_score_diff_threshold": 0.0,
+            "use_fast_tokenizer": False,
             "wandb_project": False,
             "wandb_kwargs": {},
         }
@@ -155,6 +168,8 @@ class QuestionAnsweringModel:
             self.device = "cpu"
 
         self.results = {}
+        self.tokenization_pool = TokenizationPool()
+        self.eval_data_cache = None
 
         self.tokenizer = tokenizer_class.from_pretrained(
             model_name, do_lower_case=self.args["do_lower_case"], **kwargs
@@ -169,7 +184,8 @@ class QuestionAnsweringModel:
 
     def load_and_cache_examples(self, examples, evaluate=False, no_cache=False, output_examples=False):
         """
-        Converts a list of examples to a TensorDataset containing InputFeatures. Caches the InputFeatures.
+        Converts a list of examples to a TensorDataset containing InputFeatures. Caches the InputFeatures, keyed by the
+        tokenizer, the conversion args and the contents of the examples.
 
         Utility function for train() and eval() methods. Not intended to be used directly.
         """
@@ -185,9 +201,21 @@ class QuestionAnsweringModel:
         examples = get_examples(examples, is_training=not evaluate)
 
         mode = "dev" if evaluate else "train"
+        cache_key = get_cache_key(
+            hash_tokenizer(tokenizer),
+            args["model_type"],
+            args["max_seq_length"],
+            args["doc_stride"],
+            args["max_query_length"],
+            not evaluate,
+            args["use_fast_tokenizer"],
+            get_example_digests(
+                (e.qas_id, e.question_text, e.doc_tokens, e.orig_answer_text, e.start_position, e.is_impossible)
+                for e in examples
+            ),
+        )
         cached_features_file = os.path.join(
-            args["cache_dir"],
-            "cached_{}_{}_{}_{}".format(mode, args["model_type"], args["max_seq_length"], len(examples)),
+            args["cache_dir"], "cached_{}_{}_{}_{}".format(mode, args["model_type"], args["max_seq_length"], cache_key),
         )
 
         if os.path.exists(cached_features_file) and (
@@ -199,7 +227,7 @@ class QuestionAnsweringModel:
             logger.info(f" Converting to features started.")
             features = convert_examples_to_features(
                 examples=examples,
-                tokenizer=tokenizer,
+                tokenizer=self._get_fast_tokenizer() if args["use_fast_tokenizer"] else tokenizer,
                 max_seq_length=args["max_seq_length"],
                 doc_stride=args["doc_stride"],
                 max_query_length=args["max_query_length"],
@@ -208,7 +236,10 @@ class QuestionAnsweringModel:
                 pad_token_segment_id=3 if args["model_type"] in ["xlnet"] else 0,
                 cls_token_at_end=True if args["model_type"] in ["xlnet"] else False,
                 sequence_a_is_doc=True if args["model_type"] in ["xlnet"] else False,
+                process_count=args["process_count"],
                 silent=args["silent"],
+                use_multiprocessing=args["use_multiprocessing"],
+                pool=self.tokenization_pool,
             )
 
             if not no_cache:
@@ -293,9 +324,17 @@ class QuestionAnsweringModel:
 
         os.makedirs(output_dir, exist_ok=True)
 
-        global_step, tr_loss = self.train(
-            train_dataset, output_dir, show_running_loss=show_running_loss, eval_data=eval_data, **kwargs
-        )
+        if self.args["evaluate_during_training"]:
+            # The eval dataset is built once and reused by every evaluation of this train_model() call, so
+            # changes made to the eval data during training are not seen
+            self.eval_data_cache = self._get_eval_data(eval_data)
+
+        try:
+            global_step, tr_loss = self.train(
+                train_dataset, output_dir, show_running_loss=show_running_loss, eval_data=eval_data, **kwargs
+            )
+        finally:
+            self.eval_data_cache = None
 
         model_to_save = self.model.module if hasattr(self.model, "module") else self.model
         model_to_save.save_pretrained(output_dir)
@@ -316,8 +355,8 @@ class QuestionAnsweringModel:
         args = self.args
 
         tb_writer = SummaryWriter(logdir=args["tensorboard_dir"])
-        train_sampler = RandomSampler(train_dataset)
-        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args["train_batch_size"])
+        train_sampler = TensorBatchSampler(len(train_dataset), args["train_batch_size"], shuffle=True)
+        train_dataloader = get_batch_sliced_dataloader(train_dataset, train_sampler, args)
 
         t_total = len(train_dataloader) // args["gradient_accumulation_steps"] * args["num_train_epochs"]
 
@@ -643,7 +682,9 @@ class QuestionAnsweringModel:
             eval_data, output_dir, verbose_logging=verbose
         )
 
-        if isinstance(eval_data, str):
+        if self.eval_data_cache is not None:
+            truth = self.eval_data_cache[0]
+        elif isinstance(eval_data, str):
             with open(eval_data, "r", encoding=self.args["encoding"]) as f:
                 truth = json.load(f)
         else:
@@ -670,24 +711,16 @@ class QuestionAnsweringModel:
         model = self.model
         args = self.args
 
-        if isinstance(eval_data, str):
-            with open(eval_data, "r", encoding=self.args["encoding"]) as f:
-                eval_examples = json.load(f)
-        else:
-            eval_examples = eval_data
-
-        eval_dataset, examples, features = self.load_and_cache_examples(
-            eval_examples, evaluate=True, output_examples=True
-        )
+        _, eval_dataset, examples, features = self._get_eval_data(eval_data)
 
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"])
+        eval_sampler = TensorBatchSampler(len(eval_dataset), args["eval_batch_size"], shuffle=False)
+        eval_dataloader = get_batch_sliced_dataloader(eval_dataset, eval_sampler, args)
 
         eval_loss = 0.0
         nb_eval_steps = 0
         model.eval()
 
-        all_results = []
+        all_results = self._get_empty_results(features)
         for batch in tqdm(eval_dataloader, disable=args["silent"]):
             batch = tuple(t.to(device) for t in batch)
 
@@ -709,26 +742,7 @@ class QuestionAnsweringModel:
                 outputs = model(**inputs)
                 eval_loss += outputs[0].mean().item()
 
-                for i, example_index in enumerate(example_indices):
-                    eval_feature = features[example_index.item()]
-                    unique_id = int(eval_feature.unique_id)
-                    if args["model_type"] in ["xlnet", "xlm"]:
-                        # XLNet uses a more complex post-processing procedure
-                        result = RawResultExtended(
-                            unique_id=unique_id,
-                            start_top_log_probs=to_list(outputs[0][i]),
-                            start_top_index=to_list(outputs[1][i]),
-                            end_top_log_probs=to_list(outputs[2][i]),
-                            end_top_index=to_list(outputs[3][i]),
-                            cls_logits=to_list(outputs[4][i]),
-                        )
-                    else:
-                        result = RawResult(
-                            unique_id=unique_id,
-                            start_logits=to_list(outputs[0][i]),
-                            end_logits=to_list(outputs[1][i]),
-                        )
-                    all_results.append(result)
+                self._add_batch_results(all_results, outputs, example_indices, features)
 
             nb_eval_steps += 1
 
@@ -773,10 +787,34 @@ class QuestionAnsweringModel:
                 verbose_logging,
                 True,
                 args["null_score_diff_threshold"],
+                process_count=args["process_count"] if args["use_multiprocessing"] else None,
             )
 
         return all_predictions, all_nbest_json, scores_diff_json, eval_loss
 
+    def _get_eval_data(self, eval_data):
+        """
+        Returns the eval examples, the eval dataset, the SQuAD examples, and the features for eval_data.
+        While train_model() runs, the eval data it built when it started is returned instead of being built again.
+
+        Utility function for evaluate(). Not intended to be used directly.
+        """  # noqa: ignore flake8"
+
+        if self.eval_data_cache is not None:
+            return self.eval_data_cache
+
+        if isinstance(eval_data, str):
+            with open(eval_data, "r", encoding=self.args["encoding"]) as f:
+                eval_examples = json.load(f)
+        else:
+            eval_examples = eval_data
+
+        eval_dataset, examples, features = self.load_and_cache_examples(
+            eval_examples, evaluate=True, output_examples=True
+        )
+
+        return eval_examples, eval_dataset, examples, features
+
     def predict(self, to_predict, n_best_size=None):
         """
         Performs predictions on a list of python dicts containing contexts and qas.
@@ -812,12 +850,12 @@ class QuestionAnsweringModel:
             eval_examples, evaluate=True, output_examples=True, no_cache=True
         )
 
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"])
+        eval_sampler = TensorBatchSampler(len(eval_dataset), args["eval_batch_size"], shuffle=False)
+        eval_dataloader = get_batch_sliced_dataloader(eval_dataset, eval_sampler, args)
 
         model.eval()
 
-        all_results = []
+        all_results = self._get_empty_results(features)
         for batch in tqdm(eval_dataloader, disable=args["silent"]):
             batch = tuple(t.to(device) for t in batch)
 
@@ -838,26 +876,7 @@ class QuestionAnsweringModel:
 
                 outputs = model(**inputs)
 
-                for i, example_index in enumerate(example_indices):
-                    eval_feature = features[example_index.item()]
-                    unique_id = int(eval_feature.unique_id)
-                    if args["model_type"] in ["xlnet", "xlm"]:
-                        # XLNet uses a more complex post-processing procedure
-                        result = RawResultExtended(
-                            unique_id=unique_id,
-                            start_top_log_probs=to_list(outputs[0][i]),
-                            start_top_index=to_list(outputs[1][i]),
-                            end_top_log_probs=to_list(outputs[2][i]),
-                            end_top_index=to_list(outputs[3][i]),
-                            cls_logits=to_list(outputs[4][i]),
-                        )
-                    else:
-                        result = RawResult(
-                            unique_id=unique_id,
-                            start_logits=to_list(outputs[0][i]),
-                            end_logits=to_list(outputs[1][i]),
-                        )
-                    all_results.append(result)
+                self._add_batch_results(all_results, outputs, example_indices, features)
 
         if args["model_type"] in ["xlnet", "xlm"]:
             answers = get_best_predictions_extended(
@@ -874,11 +893,62 @@ class QuestionAnsweringModel:
             )
         else:
             answers = get_best_predictions(
-                examples, features, all_results, n_best_size, args["max_answer_length"], False, False, True, False,
+                examples,
+                features,
+                all_results,
+                n_best_size,
+                args["max_answer_length"],
+                False,
+                False,
+                True,
+                False,
+                process_count=args["process_count"] if args["use_multiprocessing"] else None,
             )
 
         return answers
 
+    def _get_empty_results(self, features):
+        """
+        Returns the container for the model outputs of all features. This is a RawResultArrays with preallocated
+        logits arrays, or an empty list of RawResultExtended for XLNet and XLM.
+
+        Utility function for evaluate() and predict(). Not intended to be used directly.
+        """
+        if self.args["model_type"] in ["xlnet", "xlm"]:
+            return []
+
+        return RawResultArrays(
+            start_logits=np.empty((len(features), self.args["max_seq_length"]), dtype=np.float32),
+            end_logits=np.empty((len(features), self.args["max_seq_length"]), dtype=np.float32),
+        )
+
+    def _add_batch_results(self, all_results, outputs, example_indices, features):
+        """
+        Adds the model outputs of a batch to all_results. The outputs are copied to the host once per batch.
+
+        Utility function for evaluate() and predict(). Not intended to be used directly.
+        """
+        example_indices = example_indices.cpu().numpy()
+
+        if isinstance(all_results, RawResultArrays):
+            batch_logits = torch.stack(outputs[:2]).float().cpu().numpy()
+            all_results.start_logits[example_indices] = batch_logits[0]
+            all_results.end_logits[example_indices] = batch_logits[1]
+        else:
+            # XLNet uses a more complex post-processing procedure
+            batch_outputs = [output.cpu().tolist() for output in outputs[:5]]
+            for i, example_index in enumerate(example_indices.tolist()):
+                all_results.append(
+                    RawResultExtended(
+                        unique_id=int(features[example_index].unique_id),
+                        start_top_log_probs=batch_outputs[0][i],
+                        start_top_index=batch_outputs[1][i],
+                        end_top_log_probs=batch_outputs[2][i],
+                        end_top_index=batch_outputs[3][i],
+                        cls_logits=batch_outputs[4][i],
+                    )
+                )
+
     def calculate_results(self, truth, predictions, **kwargs):
         truth_dict = {}
         questions_dict = {}
@@ -934,12 +1004,41 @@ class QuestionAnsweringModel:
 
         return result, texts
 
+    def close(self):
+        """
+        Shuts down the worker processes used to convert examples to features.
+
+        The workers are started again if the model converts examples to features after closing. The model can also be
+        used as a context manager, which closes it on exit.
+        """
+        self.tokenization_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def _move_model_to_device(self):
         self.model.to(self.device)
 
     def _get_last_metrics(self, metric_values):
         return {metric: values[-1] for metric, values in metric_values.items()}
 
+    def _get_fast_tokenizer(self):
+        """
+        Returns the tokenizer used for feature conversion when use_fast_tokenizer is enabled.
+        This is the Rust-backed tokenizer for model types that have one, and self.tokenizer otherwise.
+        """
+        if getattr(self, "fast_tokenizer", None) is None:
+            if self.args["model_type"] in FAST_TOKENIZER_CLASSES:
+                self.fast_tokenizer = FAST_TOKENIZER_CLASSES[self.args["model_type"]].from_pretrained(
+                    self.args["model_name"], do_lower_case=self.args["do_lower_case"]
+                )
+            else:
+                self.fast_tokenizer = self.tokenizer
+        return self.fast_tokenizer
+
     def _get_inputs_dict(self, batch):
         inputs = {
             "input_ids": batch[0],
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function
 
 import collections
+import itertools
 import json
 import logging
 import math
@@ -8,15 +9,20 @@ import os
 import re
 import string
 from io import open
+from multiprocessing import Pool, cpu_count
 from pprint import pprint
 
 from tqdm import tqdm, trange
 
+import numpy as np
 import torch
 from tensorboardX import SummaryWriter
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
 from transformers import AdamW, get_linear_schedule_with_warmup
 from transformers.tokenization_bert import BasicTokenizer, whitespace_tokenize
+from transformers.tokenization_utils import PreTrainedTokenizerFast
+
+from simpletransformers.tokenization_pool import WorkerTokenizer
 
 logger = logging.getLogger(__name__)
 
@@ -86,6 +92,7 @@ class InputFeatures(object):
         start_position=None,
         end_position=None,
         is_impossible=None,
+        token_to_char_span=None,
     ):
         self.unique_id = unique_id
         self.example_index = example_index
@@ -102,6 +109,8 @@ class InputFeatures(object):
         self.start_position = start_position
         self.end_position = end_position
         self.is_impossible = is_impossible
+        # Character span of each context token in " ".join(doc_tokens), only set when converted with a fast tokenizer
+        self.token_to_char_span = token_to_char_span
 
 
 def get_examples(examples_to_process, is_training=True, version_2_with_negative=True):
@@ -180,61 +189,170 @@ def get_examples(examples_to_process, is_training=True, version_2_with_negative=
     return examples
 
 
-def convert_examples_to_features(
-    examples,
-    tokenizer,
-    max_seq_length,
-    doc_stride,
-    max_query_length,
-    is_training,
-    cls_token_at_end=False,
-    cls_token="[CLS]",
-    sep_token="[SEP]",
-    pad_token=0,
-    sequence_a_segment_id=0,
-    sequence_b_segment_id=1,
-    cls_token_segment_id=0,
-    pad_token_segment_id=0,
-    mask_padding_with_zero=True,
-    sequence_a_is_doc=False,
-    silent=False,
-):
-    """Loads a data file into a list of `InputBatch`s."""
+DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
 
-    unique_id = 1000000000
-    # cnt_pos, cnt_neg = 0, 0
-    # max_N, max_M = 1024, 1024
-    # f = np.zeros((max_N, max_M), dtype=np.float32)
 
-    features = []
-    for (example_index, example) in enumerate(tqdm(examples, disable=silent)):
+def _get_doc_spans(num_doc_tokens, max_tokens_for_doc, doc_stride):
+    """
+    Returns the doc spans covering a context of num_doc_tokens tokens, and for each span whether each of its tokens has
+    its maximum context in that span.
+    """
+    # We can have documents that are longer than the maximum sequence length.
+    # To deal with this we do a sliding window approach, where we take chunks
+    # of the up to our max length with a stride of `doc_stride`.
+    doc_spans = []
+    start_offset = 0
+    while start_offset < num_doc_tokens:
+        length = num_doc_tokens - start_offset
+        if length > max_tokens_for_doc:
+            length = max_tokens_for_doc
+        doc_spans.append(DocSpan(start=start_offset, length=length))
+        if start_offset + length == num_doc_tokens:
+            break
+        start_offset += min(length, doc_stride)
 
-        # if example_index % 100 == 0:
-        #     logger.info('Converting %s/%s pos %s neg %s', example_index, len(examples), cnt_pos, cnt_neg)
+    span_is_max_context = [
+        [_check_is_max_context(doc_spans, doc_span_index, doc_span.start + i) for i in range(doc_span.length)]
+        for doc_span_index, doc_span in enumerate(doc_spans)
+    ]
+    return doc_spans, span_is_max_context
 
-        query_tokens = tokenizer.tokenize(example.question_text)
 
-        if len(query_tokens) > max_query_length:
-            query_tokens = query_tokens[0:max_query_length]
+def _encode_contexts(tokenizer, contexts):
+    """
+    Tokenizes the contexts (lists of doc_tokens) with a fast tokenizer, in one parallel call. Returns the token ids and
+    the character offsets of the tokens in " ".join(doc_tokens) for each context.
+    """
+    if not contexts:
+        return []
+    encodings = tokenizer.batch_encode_plus(
+        [" ".join(doc_tokens) for doc_tokens in contexts], add_special_tokens=False, return_offsets_mapping=True
+    )
+    return list(zip(encodings["input_ids"], encodings["offset_mapping"]))
+
+
+def _get_word_starts(doc_tokens):
+    """Returns the character offset of each word of doc_tokens in " ".join(doc_tokens)."""
+    word_lengths = np.array([len(word) for word in doc_tokens], dtype=np.int64)
+    return np.cumsum(word_lengths + 1) - word_lengths - 1
+
+
+def _align_context_tokens(doc_tokens, context_encoding, tokenizer):
+    """
+    Maps the tokens of a context encoded by _encode_contexts() to the words of doc_tokens with their character offsets,
+    instead of tokenizing each word separately. Also returns the character spans of the tokens and the character
+    offsets of the words.
+    """
+    token_ids, offsets = context_encoding
+    token_char_spans = [tuple(offset) for offset in offsets]
+    word_starts = _get_word_starts(doc_tokens)
+    token_starts = np.array([start for start, _ in token_char_spans], dtype=np.int64)
+
+    # A token belongs to the last word starting at or before it, and a word starts at its first token
+    tok_to_orig_index = (np.searchsorted(word_starts, token_starts, side="right") - 1).tolist()
+    orig_to_tok_index = np.searchsorted(token_starts, word_starts, side="left").tolist()
+    all_doc_tokens = tokenizer.convert_ids_to_tokens(token_ids)
+
+    return all_doc_tokens, tok_to_orig_index, orig_to_tok_index, token_char_spans, word_starts
+
+
+def _get_answer_token_span(example, word_starts, token_starts, token_ends):
+    """
+    Returns the first and last context tokens overlapping the answer of example, from the character offsets of the
+    words and of the tokens in " ".join(doc_tokens). Returns None if the answer text is not found in its words, or
+    covers no token.
+    """
+    answer_text = " ".join(example.orig_answer_text.split())
+    answer_offset = " ".join(example.doc_tokens[example.start_position : (example.end_position + 1)]).find(answer_text)
+    if answer_offset == -1:
+        return None
 
+    answer_start = word_starts[example.start_position] + answer_offset
+    answer_end = answer_start + len(answer_text)
+
+    # The first token ending after the answer start, and the last token starting before the answer end
+    tok_start_position = int(np.searchsorted(token_ends, answer_start, side="right"))
+    tok_end_position = int(np.searchsorted(token_starts, answer_end, side="left")) - 1
+    if tok_start_position > tok_end_position:
+        return None
+    return tok_start_position, tok_end_position
+
+
+def convert_context_examples_to_features(context_row):
+    """
+    Converts the examples (questions) of a single context to the features of their doc spans. The context is tokenized
+    once, and its doc spans computed once per question length, for all of its questions. The features are returned
+    without a unique_id, which is assigned by convert_examples_to_features() once the features of all contexts are
+    collected in order.
+
+    With a fast tokenizer, the context is given already encoded with its character offsets (context_encoding). The
+    tokens are aligned to the words, and the answers to the tokens, with these offsets.
+    """
+    (
+        first_example_index,
+        examples,
+        context_encoding,
+        tokenizer,
+        max_seq_length,
+        doc_stride,
+        max_query_length,
+        is_training,
+        cls_token_at_end,
+        cls_token,
+        sep_token,
+        pad_token,
+        sequence_a_segment_id,
+        sequence_b_segment_id,
+        cls_token_segment_id,
+        pad_token_segment_id,
+        mask_padding_with_zero,
+        sequence_a_is_doc,
+    ) = context_row
+
+    # All the examples share the doc_tokens of the context
+    doc_tokens = examples[0].doc_tokens
+    if context_encoding is not None:
+        all_doc_tokens, tok_to_orig_index, orig_to_tok_index, token_char_spans, word_starts = _align_context_tokens(
+            doc_tokens, context_encoding, tokenizer
+        )
+        token_starts = np.array([start for start, _ in token_char_spans], dtype=np.int64)
+        token_ends = np.array([end for _, end in token_char_spans], dtype=np.int64)
+    else:
+        token_char_spans = None
         tok_to_orig_index = []
         orig_to_tok_index = []
         all_doc_tokens = []
-        for (i, token) in enumerate(example.doc_tokens):
+        for (i, token) in enumerate(doc_tokens):
             orig_to_tok_index.append(len(all_doc_tokens))
             sub_tokens = tokenizer.tokenize(token)
             for sub_token in sub_tokens:
                 tok_to_orig_index.append(i)
                 all_doc_tokens.append(sub_token)
 
+    # Doc spans only depend on the number of tokens left for the context, i.e. on the length of the question
+    span_layouts = {}
+
+    features = []
+    for (example_offset, example) in enumerate(examples):
+        example_index = first_example_index + example_offset
+        query_tokens = tokenizer.tokenize(example.question_text)
+
+        if len(query_tokens) > max_query_length:
+            query_tokens = query_tokens[0:max_query_length]
+
         tok_start_position = None
         tok_end_position = None
         if is_training and example.is_impossible:
             tok_start_position = -1
             tok_end_position = -1
-        if is_training and not example.is_impossible:
+        answer_token_span = None
+        if is_training and not example.is_impossible and token_char_spans is not None:
+            answer_token_span = _get_answer_token_span(example, word_starts, token_starts, token_ends)
+        if answer_token_span is not None:
+            (tok_start_position, tok_end_position) = answer_token_span
+        elif is_training and not example.is_impossible:
             tok_start_position = orig_to_tok_index[example.start_position]
-            if example.end_position < len(example.doc_tokens) - 1:
+            if example.end_position < len(doc_tokens) - 1:
                 tok_end_position = orig_to_tok_index[example.end_position + 1] - 1
             else:
                 tok_end_position = len(all_doc_tokens) - 1
@@ -245,25 +363,15 @@ def convert_examples_to_features(
         # The -3 accounts for [CLS], [SEP] and [SEP]
         max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
 
-        # We can have documents that are longer than the maximum sequence length.
-        # To deal with this we do a sliding window approach, where we take chunks
-        # of the up to our max length with a stride of `doc_stride`.
-        _DocSpan = collections.namedtuple("DocSpan", ["start", "length"])  # pylint: disable=invalid-name
-        doc_spans = []
-        start_offset = 0
-        while start_offset < len(all_doc_tokens):
-            length = len(all_doc_tokens) - start_offset
-            if length > max_tokens_for_doc:
-                length = max_tokens_for_doc
-            doc_spans.append(_DocSpan(start=start_offset, length=length))
-            if start_offset + length == len(all_doc_tokens):
-                break
-            start_offset += min(length, doc_stride)
+        if max_tokens_for_doc not in span_layouts:
+            span_layouts[max_tokens_for_doc] = _get_doc_spans(len(all_doc_tokens), max_tokens_for_doc, doc_stride)
+        doc_spans, span_is_max_context = span_layouts[max_tokens_for_doc]
 
         for (doc_span_index, doc_span) in enumerate(doc_spans):
             tokens = []
             token_to_orig_map = {}
             token_is_max_context = {}
+            token_to_char_span = {} if token_char_spans is not None else None
             segment_ids = []
 
             # p_mask: mask with 1 for token than cannot be in the answer (0 for token which can be in an answer)
@@ -294,9 +402,10 @@ def convert_examples_to_features(
             for i in range(doc_span.length):
                 split_token_index = doc_span.start + i
                 token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
+                if token_char_spans is not None:
+                    token_to_char_span[len(tokens)] = token_char_spans[split_token_index]
 
-                is_max_context = _check_is_max_context(doc_spans, doc_span_index, split_token_index)
-                token_is_max_context[len(tokens)] = is_max_context
+                token_is_max_context[len(tokens)] = span_is_max_context[doc_span_index][i]
                 tokens.append(all_doc_tokens[split_token_index])
                 if not sequence_a_is_doc:
                     segment_ids.append(sequence_b_segment_id)
@@ -371,32 +480,9 @@ def convert_examples_to_features(
                 start_position = cls_index
                 end_position = cls_index
 
-            # if example_index < 20:
-            #     logger.info("*** Example ***")
-            #     logger.info("unique_id: %s" % (unique_id))
-            #     logger.info("example_index: %s" % (example_index))
-            #     logger.info("doc_span_index: %s" % (doc_span_index))
-            #     logger.info("tokens: %s" % " ".join(tokens))
-            #     logger.info(
-            #         "token_to_orig_map: %s" % " ".join(["%d:%d" % (x, y) for (x, y) in token_to_orig_map.items()])
-            #     )
-            #     logger.info(
-            #         "token_is_max_context: %s"
-            #         % " ".join(["%d:%s" % (x, y) for (x, y) in token_is_max_context.items()])
-            #     )
-            #     logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            #     logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-            #     logger.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-            #     if is_training and span_is_impossible:
-            #         logger.info("impossible example")
-            #     if is_training and not span_is_impossible:
-            #         answer_text = " ".join(tokens[start_position : (end_position + 1)])
-            #         logger.info("start_position: %d" % (start_position))
-            #         logger.info("end_position: %d" % (end_position))
-            #         logger.info("answer: %s" % (answer_text))
             features.append(
                 InputFeatures(
-                    unique_id=unique_id,
+                    unique_id=None,
                     example_index=example_index,
                     doc_span_index=doc_span_index,
                     tokens=tokens,
@@ -411,9 +497,123 @@ def convert_examples_to_features(
                     start_position=start_position,
                     end_position=end_position,
                     is_impossible=span_is_impossible,
+                    token_to_char_span=token_to_char_span,
+                )
+            )
+
+    return features
+
+
+def convert_examples_to_features(
+    examples,
+    tokenizer,
+    max_seq_length,
+    doc_stride,
+    max_query_length,
+    is_training,
+    cls_token_at_end=False,
+    cls_token="[CLS]",
+    sep_token="[SEP]",
+    pad_token=0,
+    sequence_a_segment_id=0,
+    sequence_b_segment_id=1,
+    cls_token_segment_id=0,
+    pad_token_segment_id=0,
+    mask_padding_with_zero=True,
+    sequence_a_is_doc=False,
+    process_count=max(1, cpu_count() - 2),
+    chunksize=500,
+    silent=False,
+    use_multiprocessing=False,
+    pool=None,
+):
+    """
+    Loads a data file into a list of `InputBatch`s.
+        Examples are converted in `process_count` processes if `use_multiprocessing` is set (in this process by
+        default). The features, and their `unique_id`s, are the same as with the conversion in a single process.
+        Each context is tokenized once for all of the consecutive examples (questions) sharing its `doc_tokens`.
+        `pool` is an optional TokenizationPool to use instead of starting a new multiprocessing Pool
+        With a fast tokenizer (PreTrainedTokenizerFast), all contexts are encoded in one parallel call instead, and
+        tokens and answers are aligned with character offsets. `use_multiprocessing` is not used in this case.
+    """
+
+    # get_examples() gives the questions of a context consecutively, sharing the same doc_tokens
+    contexts = []
+    for example_index, example in enumerate(examples):
+        if contexts and example.doc_tokens is contexts[-1][1][-1].doc_tokens:
+            contexts[-1][1].append(example)
+        else:
+            contexts.append((example_index, [example]))
+
+    if isinstance(tokenizer, PreTrainedTokenizerFast):
+        context_encodings = _encode_contexts(tokenizer, [examples[0].doc_tokens for _, examples in contexts])
+        use_multiprocessing = False
+    else:
+        context_encodings = [None] * len(contexts)
+
+    context_rows = [
+        (
+            first_example_index,
+            context_examples,
+            context_encoding,
+            WorkerTokenizer() if use_multiprocessing and pool is not None else tokenizer,
+            max_seq_length,
+            doc_stride,
+            max_query_length,
+            is_training,
+            cls_token_at_end,
+            cls_token,
+            sep_token,
+            pad_token,
+            sequence_a_segment_id,
+            sequence_b_segment_id,
+            cls_token_segment_id,
+            pad_token_segment_id,
+            mask_padding_with_zero,
+            sequence_a_is_doc,
+        )
+        for (first_example_index, context_examples), context_encoding in zip(contexts, context_encodings)
+    ]
+
+    # Smaller chunks for small datasets, so that every process gets some of the contexts
+    process_count = max(1, process_count)
+    chunksize = max(1, min(chunksize, math.ceil(len(context_rows) / process_count)))
+
+    if use_multiprocessing and pool is not None:
+        context_features = list(
+            tqdm(
+                pool.imap(
+                    convert_context_examples_to_features,
+                    context_rows,
+                    (tokenizer,),
+                    process_count,
+                    chunksize=chunksize,
+                ),
+                total=len(context_rows),
+                disable=silent,
+            )
+        )
+    elif use_multiprocessing:
+        with Pool(process_count) as p:
+            context_features = list(
+                tqdm(
+                    p.imap(convert_context_examples_to_features, context_rows, chunksize=chunksize),
+                    total=len(context_rows),
+                    disable=silent,
                 )
             )
-            unique_id += 1
+    else:
+        context_features = [
+            convert_context_examples_to_features(context_row) for context_row in tqdm(context_rows, disable=silent)
+        ]
+
+    # Unique ids are numbered in example order, as the features are created in a single process
+    features = []
+    unique_id = 1000000000
+    for feature in itertools.chain.from_iterable(context_features):
+        feature.unique_id = unique_id
+        features.append(feature)
+        unique_id += 1
 
     return features
 
@@ -493,114 +693,150 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
 
 RawResult = collections.namedtuple("RawResult", ["unique_id", "start_logits", "end_logits"])
 
+# Start and end logits of all features, as (num_features, max_seq_length) arrays with one row per feature, in the
+# order of the features
+RawResultArrays = collections.namedtuple("RawResultArrays", ["start_logits", "end_logits"])
 
-def write_predictions(
-    all_examples,
-    all_features,
-    all_results,
-    n_best_size,
-    max_answer_length,
-    do_lower_case,
-    output_prediction_file,
-    output_nbest_file,
-    output_null_log_odds_file,
-    verbose_logging,
-    version_2_with_negative,
-    null_score_diff_threshold,
-):
-    """Write final predictions to the json file and log-odds of null if needed."""
-    # logger.info("Writing predictions to: %s" % (output_prediction_file))
-    # logger.info("Writing nbest to: %s" % (output_nbest_file))
 
-    example_index_to_features = collections.defaultdict(list)
-    for feature in all_features:
-        example_index_to_features[feature.example_index].append(feature)
+_PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
+    "PrelimPrediction", ["feature_index", "start_index", "end_index", "start_logit", "end_logit"],
+)
 
-    unique_id_to_result = {}
-    for result in all_results:
-        unique_id_to_result[result.unique_id] = result
+_NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
+    "NbestPrediction", ["text", "start_logit", "end_logit"]
+)
 
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction", ["feature_index", "start_index", "end_index", "start_logit", "end_logit"],
+
+def _get_valid_spans(feature, start_logits, end_logits, n_best_size, max_answer_length):
+    """
+    Returns the start indexes, end indexes and scores (sum of start and end logits) of the valid answer spans of a
+    feature, among the n_best_size best start and end logits. Spans are ordered by start index rank, then by end index
+    rank.
+    """
+    start_indexes = _get_best_indexes(start_logits, n_best_size)
+    end_indexes = _get_best_indexes(end_logits, n_best_size)
+
+    # We could hypothetically create invalid predictions, e.g., predict
+    # that the start of the span is in the question. We throw out all
+    # invalid predictions.
+    num_tokens = len(feature.tokens)
+    is_valid_start = np.array(
+        [
+            index < num_tokens
+            and index in feature.token_to_orig_map
+            and feature.token_is_max_context.get(index, False)
+            for index in start_indexes.tolist()
+        ],
+        dtype=bool,
     )
+    is_valid_end = np.array(
+        [index < num_tokens and index in feature.token_to_orig_map for index in end_indexes.tolist()], dtype=bool
+    )
+    lengths = end_indexes[None, :] - start_indexes[:, None] + 1
+    is_valid = is_valid_start[:, None] & is_valid_end[None, :] & (lengths >= 1) & (lengths <= max_answer_length)
 
-    all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    scores_diff_json = collections.OrderedDict()
+    # Scores of every (start, end) pair of the top-k start and end indexes, of which only the valid ones are kept
+    scores = start_logits[start_indexes][:, None] + end_logits[end_indexes][None, :]
+    start_ranks, end_ranks = np.nonzero(is_valid)
+    return start_indexes[start_ranks], end_indexes[end_ranks], scores[start_ranks, end_ranks]
 
-    for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example_index]
 
-        prelim_predictions = []
-        # keep track of the minimum score of null start+end of position 0
-        score_null = 1000000  # large and positive
-        min_null_feature_index = 0  # the paragraph slice with min null score
-        null_start_logit = 0  # the start logit at the slice with min null score
-        null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            # if we could have irrelevant answers, get the min score of irrelevant
-            if version_2_with_negative:
-                feature_null_score = result.start_logits[0] + result.end_logits[0]
-                if feature_null_score < score_null:
-                    score_null = feature_null_score
-                    min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index],
-                        )
-                    )
+def _get_example_predictions(example_row):
+    """
+    Returns the prediction, the n-best predictions and the null score difference (None without negative examples)
+    of a single example. start_logits and end_logits have one row for each of the features of the example.
+    """
+    (
+        example,
+        features,
+        start_logits,
+        end_logits,
+        n_best_size,
+        max_answer_length,
+        do_lower_case,
+        verbose_logging,
+        version_2_with_negative,
+        null_score_diff_threshold,
+    ) = example_row
+
+    start_logits = np.asarray(start_logits, dtype=np.float64)
+    end_logits = np.asarray(end_logits, dtype=np.float64)
+
+    # Candidate spans of all features, scored with the sum of their start and end logits
+    feature_indexes = []
+    start_indexes = []
+    end_indexes = []
+    span_start_logits = []
+    span_end_logits = []
+    span_scores = []
+    # keep track of the minimum score of null start+end of position 0
+    score_null = 1000000  # large and positive
+    min_null_feature_index = 0  # the paragraph slice with min null score
+    null_start_logit = 0  # the start logit at the slice with min null score
+    null_end_logit = 0  # the end logit at the slice with min null score
+    for (feature_index, feature) in enumerate(features):
+        # if we could have irrelevant answers, get the min score of irrelevant
         if version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit,
-                )
+            feature_null_score = start_logits[feature_index, 0].item() + end_logits[feature_index, 0].item()
+            if feature_null_score < score_null:
+                score_null = feature_null_score
+                min_null_feature_index = feature_index
+                null_start_logit = start_logits[feature_index, 0].item()
+                null_end_logit = end_logits[feature_index, 0].item()
+
+        feature_start_indexes, feature_end_indexes, feature_scores = _get_valid_spans(
+            feature, start_logits[feature_index], end_logits[feature_index], n_best_size, max_answer_length
+        )
+        feature_indexes.append(np.full(len(feature_start_indexes), feature_index))
+        start_indexes.append(feature_start_indexes)
+        end_indexes.append(feature_end_indexes)
+        span_start_logits.append(start_logits[feature_index, feature_start_indexes])
+        span_end_logits.append(end_logits[feature_index, feature_end_indexes])
+        span_scores.append(feature_scores)
+
+    prelim_predictions = [
+        _PrelimPrediction(*prediction)
+        for prediction in zip(
+            np.concatenate(feature_indexes or [[]]).astype(int).tolist(),
+            np.concatenate(start_indexes or [[]]).astype(int).tolist(),
+            np.concatenate(end_indexes or [[]]).astype(int).tolist(),
+            np.concatenate(span_start_logits or [[]]).tolist(),
+            np.concatenate(span_end_logits or [[]]).tolist(),
+        )
+    ]
+    if version_2_with_negative:
+        prelim_predictions.append(
+            _PrelimPrediction(
+                feature_index=min_null_feature_index,
+                start_index=0,
+                end_index=0,
+                start_logit=null_start_logit,
+                end_logit=null_end_logit,
             )
-        prelim_predictions = sorted(prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True,)
-
-        _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "NbestPrediction", ["text", "start_logit", "end_logit"]
         )
-
-        seen_predictions = {}
-        nbest = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
-                break
-            if pred.start_index > 0:  # this is a non-null prediction
-                feature = features[pred.feature_index]
+        span_scores.append([null_start_logit + null_end_logit])
+
+    # A stable sort of the negated scores keeps equally scored predictions in order, like sorted(reverse=True)
+    scores = np.concatenate(span_scores or [[]]).astype(np.float64)
+    order = np.argsort(-scores, kind="stable")
+
+    seen_predictions = {}
+    nbest = []
+    context_text = None
+    for pred_index in order.tolist():
+        pred = prelim_predictions[pred_index]
+        if len(nbest) >= n_best_size:
+            break
+        if pred.start_index > 0:  # this is a non-null prediction
+            feature = features[pred.feature_index]
+            if getattr(feature, "token_to_char_span", None) is not None:
+                # The answer text is the context text between the character offsets of its first and last tokens
+                if context_text is None:
+                    context_text = " ".join(example.doc_tokens)
+                final_text = context_text[
+                    feature.token_to_char_span[pred.start_index][0] : feature.token_to_char_span[pred.end_index][1]
+                ]
+            else:
                 tok_tokens = feature.tokens[pred.start_index : (pred.end_index + 1)]
                 orig_doc_start = feature.token_to_orig_map[pred.start_index]
                 orig_doc_end = feature.token_to_orig_map[pred.end_index]
@@ -617,64 +853,162 @@ def write_predictions(
                 orig_text = " ".join(orig_tokens)
 
                 final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
-                if final_text in seen_predictions:
-                    continue
+            if final_text in seen_predictions:
+                continue
 
-                seen_predictions[final_text] = True
-            else:
-                final_text = ""
-                seen_predictions[final_text] = True
+            seen_predictions[final_text] = True
+        else:
+            final_text = ""
+            seen_predictions[final_text] = True
 
-            nbest.append(_NbestPrediction(text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit,))
-        # if we didn't include the empty option in the n-best, include it
-        if version_2_with_negative:
-            if "" not in seen_predictions:
-                nbest.append(_NbestPrediction(text="", start_logit=null_start_logit, end_logit=null_end_logit))
+        nbest.append(_NbestPrediction(text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit,))
+    # if we didn't include the empty option in the n-best, include it
+    if version_2_with_negative:
+        if "" not in seen_predictions:
+            nbest.append(_NbestPrediction(text="", start_logit=null_start_logit, end_logit=null_end_logit))
+
+        # In very rare edge cases we could only have single null prediction.
+        # So we just create a nonce prediction in this case to avoid failure.
+        if len(nbest) == 1:
+            nbest.insert(0, _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+
+    # In very rare edge cases we could have no valid predictions. So we
+    # just create a nonce prediction in this case to avoid failure.
+    if not nbest:
+        nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+
+    assert len(nbest) >= 1
+
+    total_scores = []
+    best_non_null_entry = None
+    for entry in nbest:
+        total_scores.append(entry.start_logit + entry.end_logit)
+        if not best_non_null_entry:
+            if entry.text:
+                best_non_null_entry = entry
 
-            # In very rare edge cases we could only have single null prediction.
-            # So we just create a nonce prediction in this case to avoid failure.
-            if len(nbest) == 1:
-                nbest.insert(0, _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+    probs = _compute_softmax(total_scores)
 
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a nonce prediction in this case to avoid failure.
-        if not nbest:
-            nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+    nbest_json = []
+    for (i, entry) in enumerate(nbest):
+        output = collections.OrderedDict()
+        output["text"] = entry.text
+        output["probability"] = probs[i]
+        output["start_logit"] = entry.start_logit
+        output["end_logit"] = entry.end_logit
+        nbest_json.append(output)
 
-        assert len(nbest) >= 1
+    assert len(nbest_json) >= 1
 
-        total_scores = []
-        best_non_null_entry = None
-        for entry in nbest:
-            total_scores.append(entry.start_logit + entry.end_logit)
-            if not best_non_null_entry:
-                if entry.text:
-                    best_non_null_entry = entry
+    if not version_2_with_negative:
+        return nbest_json[0]["text"], nbest_json, None
 
-        probs = _compute_softmax(total_scores)
+    # predict "" iff the null score - the score of best non-null > threshold
+    score_diff = score_null - best_non_null_entry.start_logit - (best_non_null_entry.end_logit)
+    if score_diff > null_score_diff_threshold:
+        return "", nbest_json, score_diff
+    return best_non_null_entry.text, nbest_json, score_diff
 
-        nbest_json = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["start_logit"] = entry.start_logit
-            output["end_logit"] = entry.end_logit
-            nbest_json.append(output)
 
-        assert len(nbest_json) >= 1
+def _get_all_predictions(
+    all_examples,
+    all_features,
+    all_results,
+    n_best_size,
+    max_answer_length,
+    do_lower_case,
+    verbose_logging,
+    version_2_with_negative,
+    null_score_diff_threshold,
+    process_count=None,
+    chunksize=500,
+):
+    """
+    Returns the predictions, the n-best predictions and the null score differences of all examples.
+        `all_results` is either a RawResultArrays, or a list of RawResults.
+        If `process_count` is more than 1, and there are more than `chunksize` examples, the examples are processed in
+        `process_count` processes.
+    """  # noqa: ignore flake8"
+
+    if not isinstance(all_results, RawResultArrays):
+        unique_id_to_result = {}
+        for result in all_results:
+            unique_id_to_result[result.unique_id] = result
+        all_results = RawResultArrays(
+            start_logits=np.array([unique_id_to_result[f.unique_id].start_logits for f in all_features], np.float64),
+            end_logits=np.array([unique_id_to_result[f.unique_id].end_logits for f in all_features], np.float64),
+        )
 
-        if not version_2_with_negative:
-            all_predictions[example.qas_id] = nbest_json[0]["text"]
-        else:
-            # predict "" iff the null score - the score of best non-null > threshold
-            score_diff = score_null - best_non_null_entry.start_logit - (best_non_null_entry.end_logit)
-            scores_diff_json[example.qas_id] = score_diff
-            if score_diff > null_score_diff_threshold:
-                all_predictions[example.qas_id] = ""
-            else:
-                all_predictions[example.qas_id] = best_non_null_entry.text
+    # Rows of the logits arrays are indexed by the position of their feature in all_features
+    example_index_to_feature_indexes = collections.defaultdict(list)
+    for (feature_index, feature) in enumerate(all_features):
+        example_index_to_feature_indexes[feature.example_index].append(feature_index)
+
+    example_rows = [
+        (
+            example,
+            [all_features[feature_index] for feature_index in example_index_to_feature_indexes[example_index]],
+            all_results.start_logits[example_index_to_feature_indexes[example_index]],
+            all_results.end_logits[example_index_to_feature_indexes[example_index]],
+            n_best_size,
+            max_answer_length,
+            do_lower_case,
+            verbose_logging,
+            version_2_with_negative,
+            null_score_diff_threshold,
+        )
+        for (example_index, example) in enumerate(all_examples)
+    ]
+
+    if process_count and process_count > 1 and len(example_rows) > chunksize:
+        with Pool(process_count) as p:
+            example_predictions = p.map(_get_example_predictions, example_rows, chunksize=chunksize)
+    else:
+        example_predictions = [_get_example_predictions(example_row) for example_row in example_rows]
+
+    all_predictions = collections.OrderedDict()
+    all_nbest_json = collections.OrderedDict()
+    scores_diff_json = collections.OrderedDict()
+    for example, (prediction, nbest_json, score_diff) in zip(all_examples, example_predictions):
+        all_predictions[example.qas_id] = prediction
         all_nbest_json[example.qas_id] = nbest_json
+        if version_2_with_negative:
+            scores_diff_json[example.qas_id] = score_diff
+
+    return all_predictions, all_nbest_json, scores_diff_json
+
+
+def write_predictions(
+    all_examples,
+    all_features,
+    all_results,
+    n_best_size,
+    max_answer_length,
+    do_lower_case,
+    output_prediction_file,
+    output_nbest_file,
+    output_null_log_odds_file,
+    verbose_logging,
+    version_2_with_negative,
+    null_score_diff_threshold,
+    process_count=None,
+):
+    """Write final predictions to the json file and log-odds of null if needed."""
+    # logger.info("Writing predictions to: %s" % (output_prediction_file))
+    # logger.info("Writing nbest to: %s" % (output_nbest_file))
+
+    all_predictions, all_nbest_json, scores_diff_json = _get_all_predictions(
+        all_examples,
+        all_features,
+        all_results,
+        n_best_size,
+        max_answer_length,
+        do_lower_case,
+        verbose_logging,
+        version_2_with_negative,
+        null_score_diff_threshold,
+        process_count=process_count,
+    )
 
     with open(output_prediction_file, "w") as writer:
         writer.write(json.dumps(all_predictions, indent=4) + "\n")
@@ -903,172 +1237,22 @@ def get_best_predictions(
     verbose_logging,
     version_2_with_negative,
     null_score_diff_threshold,
+    process_count=None,
 ):
 
-    example_index_to_features = collections.defaultdict(list)
-    for feature in all_features:
-        example_index_to_features[feature.example_index].append(feature)
-
-    unique_id_to_result = {}
-    for result in all_results:
-        unique_id_to_result[result.unique_id] = result
-
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction", ["feature_index", "start_index", "end_index", "start_logit", "end_logit"],
+    _, all_nbest_json, _ = _get_all_predictions(
+        all_examples,
+        all_features,
+        all_results,
+        n_best_size,
+        max_answer_length,
+        do_lower_case,
+        verbose_logging,
+        version_2_with_negative,
+        null_score_diff_threshold,
+        process_count=process_count,
     )
 
-    all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    scores_diff_json = collections.OrderedDict()
-
-    for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example_index]
-
-        prelim_predictions = []
-        # keep track of the minimum score of null start+end of position 0
-        score_null = 1000000  # large and positive
-        min_null_feature_index = 0  # the paragraph slice with min null score
-        null_start_logit = 0  # the start logit at the slice with min null score
-        null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            # if we could have irrelevant answers, get the min score of irrelevant
-            if version_2_with_negative:
-                feature_null_score = result.start_logits[0] + result.end_logits[0]
-                if feature_null_score < score_null:
-                    score_null = feature_null_score
-                    min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index],
-                        )
-                    )
-        if version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit,
-                )
-            )
-        prelim_predictions = sorted(prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True,)
-
-        _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "NbestPrediction", ["text", "start_logit", "end_logit"]
-        )
-
-        seen_predictions = {}
-        nbest = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
-                break
-            if pred.start_index > 0:  # this is a non-null prediction
-                feature = features[pred.feature_index]
-                tok_tokens = feature.tokens[pred.start_index : (pred.end_index + 1)]
-                orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                orig_doc_end = feature.token_to_orig_map[pred.end_index]
-                orig_tokens = example.doc_tokens[orig_doc_start : (orig_doc_end + 1)]
-                tok_text = " ".join(tok_tokens)
-
-                # De-tokenize WordPieces that have been split off.
-                tok_text = tok_text.replace(" ##", "")
-                tok_text = tok_text.replace("##", "")
-
-                # Clean whitespace
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-
-                final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
-                if final_text in seen_predictions:
-                    continue
-
-                seen_predictions[final_text] = True
-            else:
-                final_text = ""
-                seen_predictions[final_text] = True
-
-            nbest.append(_NbestPrediction(text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit,))
-        # if we didn't include the empty option in the n-best, include it
-        if version_2_with_negative:
-            if "" not in seen_predictions:
-                nbest.append(_NbestPrediction(text="", start_logit=null_start_logit, end_logit=null_end_logit))
-
-            # In very rare edge cases we could only have single null prediction.
-            # So we just create a nonce prediction in this case to avoid failure.
-            if len(nbest) == 1:
-                nbest.insert(0, _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
-
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a nonce prediction in this case to avoid failure.
-        if not nbest:
-            nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
-
-        assert len(nbest) >= 1
-
-        total_scores = []
-        best_non_null_entry = None
-        for entry in nbest:
-            total_scores.append(entry.start_logit + entry.end_logit)
-            if not best_non_null_entry:
-                if entry.text:
-                    best_non_null_entry = entry
-
-        probs = _compute_softmax(total_scores)
-
-        nbest_json = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["start_logit"] = entry.start_logit
-            output["end_logit"] = entry.end_logit
-            nbest_json.append(output)
-
-        assert len(nbest_json) >= 1
-
-        if not version_2_with_negative:
-            all_predictions[example.qas_id] = nbest_json[0]["text"]
-        else:
-            # predict "" iff the null score - the score of best non-null > threshold
-            score_diff = score_null - best_non_null_entry.start_logit - (best_non_null_entry.end_logit)
-            scores_diff_json[example.qas_id] = score_diff
-            if score_diff > null_score_diff_threshold:
-                all_predictions[example.qas_id] = ""
-            else:
-                all_predictions[example.qas_id] = best_non_null_entry.text
-        all_nbest_json[example.qas_id] = nbest_json
-
     all_best = [{"id": id, "answer": answers[0]["text"]} for id, answers in all_nbest_json.items()]
     return all_best
 
@@ -1463,14 +1647,8 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
 
 def _get_best_indexes(logits, n_best_size):
     """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+    # A stable sort of the negated logits keeps the lower index first for equal logits, like sorted(reverse=True)
+    return np.argsort(-np.asarray(logits, dtype=np.float64), kind="stable")[:n_best_size]
 
 
 def _compute_softmax(scores):
@@ -13,7 +13,9 @@ from tqdm.auto import tqdm, trange
 import pandas as pd
 import torch
 from simpletransformers.config.global_args import global_args
+from simpletransformers.dataloader_utils import get_dataloader_kwargs
 from simpletransformers.seq2seq.seq2seq_utils import Seq2SeqDataset, SimpleSummarizationDataset
+from simpletransformers.tokenization_pool import TokenizationPool
 from tensorboardX import SummaryWriter
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
@@ -160,6 +162,7 @@ class Seq2SeqModel:
             self.device = "cpu"
 
         self.results = {}
+        self.tokenization_pool = TokenizationPool()
 
         if not use_cuda:
             self.args["fp16"] = False
@@ -307,7 +310,9 @@ class Seq2SeqModel:
 
         tb_writer = SummaryWriter(logdir=args["tensorboard_dir"])
         train_sampler = RandomSampler(train_dataset)
-        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args["train_batch_size"])
+        train_dataloader = DataLoader(
+            train_dataset, sampler=train_sampler, batch_size=args["train_batch_size"], **get_dataloader_kwargs(args)
+        )
 
         if args["max_steps"] > 0:
             t_total = args["max_steps"]
@@ -692,7 +697,9 @@ class Seq2SeqModel:
         results = {}
 
         eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"])
+        eval_dataloader = DataLoader(
+            eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"], **get_dataloader_kwargs(args)
+        )
 
         if args["n_gpu"] > 1:
             model = torch.nn.DataParallel(model)
@@ -820,9 +827,11 @@ class Seq2SeqModel:
             return CustomDataset(encoder_tokenizer, decoder_tokenizer, args, data, mode)
         else:
             if args["model_type"] in ["bart", "marian"]:
-                return SimpleSummarizationDataset(encoder_tokenizer, self.args, data, mode)
+                return SimpleSummarizationDataset(encoder_tokenizer, self.args, data, mode, pool=self.tokenization_pool)
             else:
-                return Seq2SeqDataset(encoder_tokenizer, decoder_tokenizer, self.args, data, mode,)
+                return Seq2SeqDataset(
+                    encoder_tokenizer, decoder_tokenizer, self.args, data, mode, pool=self.tokenization_pool
+                )
 
     def _create_training_progress_scores(self, **kwargs):
         extra_metrics = {key: [] for key in kwargs}
@@ -886,6 +895,21 @@ class Seq2SeqModel:
                 for key in sorted(results.keys()):
                     writer.write("{} = {}\n".format(key, str(results[key])))
 
+    def close(self):
+        """
+        Shuts down the worker processes used to convert examples to features.
+
+        The workers are started again if the model converts examples to features after closing. The model can also be
+        used as a context manager, which closes it on exit.
+        """
+        self.tokenization_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def _move_model_to_device(self):
         self.model.to(self.device)
 
@@ -13,6 +13,8 @@ from tokenizers.processors import BertProcessing
 from torch.utils.data import Dataset
 from transformers import PreTrainedTokenizer
 
+from simpletransformers.tokenization_pool import WorkerTokenizer
+
 logger = logging.getLogger(__name__)
 
 
@@ -40,7 +42,7 @@ def preprocess_data(data):
 
 
 class Seq2SeqDataset(Dataset):
-    def __init__(self, encoder_tokenizer, decoder_tokenizer, args, data, mode):
+    def __init__(self, encoder_tokenizer, decoder_tokenizer, args, data, mode, pool=None):
         cached_features_file = os.path.join(
             args["cache_dir"], args["model_name"] + "_cached_" + str(args["max_seq_length"]) + str(len(data))
         )
@@ -55,12 +57,27 @@ class Seq2SeqDataset(Dataset):
         else:
             logger.info(" Creating features from dataset file at %s", args["cache_dir"])
 
+        use_pool = args["use_multiprocessing"] and pool is not None
         data = [
-            (input_text, target_text, encoder_tokenizer, decoder_tokenizer, args)
+            (
+                input_text,
+                target_text,
+                WorkerTokenizer(0) if use_pool else encoder_tokenizer,
+                WorkerTokenizer(1) if use_pool else decoder_tokenizer,
+                args,
+            )
             for input_text, target_text in zip(data["input_text"], data["target_text"])
         ]
 
-        if args["use_multiprocessing"]:
+        if use_pool:
+            self.examples = list(
+                tqdm(
+                    pool.imap(preprocess_data, data, (encoder_tokenizer, decoder_tokenizer), args["process_count"]),
+                    total=len(data),
+                    disable=args["silent"],
+                )
+            )
+        elif args["use_multiprocessing"]:
             with Pool(args["process_count"]) as p:
                 self.examples = list(
                     tqdm(p.imap(preprocess_data, data, chunksize=500), total=len(data), disable=args["silent"],)
@@ -98,7 +115,7 @@ def preprocess_data_bart(data):
 
 
 class SimpleSummarizationDataset(Dataset):
-    def __init__(self, tokenizer, args, data, mode):
+    def __init__(self, tokenizer, args, data, mode, pool=None):
         self.tokenizer = tokenizer
 
         cached_features_file = os.path.join(
@@ -115,12 +132,21 @@ class SimpleSummarizationDataset(Dataset):
         else:
             logger.info(" Creating features from dataset file at %s", args["cache_dir"])
 
+        use_pool = args["use_multiprocessing"] and pool is not None
         data = [
-            (input_text, target_text, tokenizer, args)
+            (input_text, target_text, WorkerTokenizer() if use_pool else tokenizer, args)
             for input_text, target_text in zip(data["input_text"], data["target_text"])
         ]
 
-        if args["use_multiprocessing"]:
+        if use_pool:
+            self.examples = list(
+                tqdm(
+                    pool.imap(preprocess_data_bart, data, (tokenizer,), args["process_count"]),
+                    total=len(data),
+                    disable=args["silent"],
+                )
+            )
+        elif args["use_multiprocessing"]:
             with Pool(args["process_count"]) as p:
                 self.examples = list(
                     tqdm(p.imap(preprocess_data_bart, data, chunksize=500), total=len(data), disable=args["silent"],)
@@ -13,7 +13,9 @@ from tqdm.auto import tqdm, trange
 import pandas as pd
 import torch
 from simpletransformers.config.global_args import global_args
+from simpletransformers.dataloader_utils import get_dataloader_kwargs
 from simpletransformers.t5.t5_utils import T5Dataset
+from simpletransformers.tokenization_pool import TokenizationPool
 from tensorboardX import SummaryWriter
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
@@ -99,6 +101,7 @@ class T5Model:
             self.device = "cpu"
 
         self.results = {}
+        self.tokenization_pool = TokenizationPool()
 
         self.config = T5Config.from_pretrained(model_name, **self.args["config"])
 
@@ -197,7 +200,9 @@ class T5Model:
 
         tb_writer = SummaryWriter(logdir=args["tensorboard_dir"])
         train_sampler = RandomSampler(train_dataset)
-        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args["train_batch_size"])
+        train_dataloader = DataLoader(
+            train_dataset, sampler=train_sampler, batch_size=args["train_batch_size"], **get_dataloader_kwargs(args)
+        )
 
         if args["max_steps"] > 0:
             t_total = args["max_steps"]
@@ -575,7 +580,9 @@ class T5Model:
         results = {}
 
         eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"])
+        eval_dataloader = DataLoader(
+            eval_dataset, sampler=eval_sampler, batch_size=args["eval_batch_size"], **get_dataloader_kwargs(args)
+        )
 
         if args["n_gpu"] > 1:
             model = torch.nn.DataParallel(model)
@@ -674,6 +681,21 @@ class T5Model:
 
         return results
 
+    def close(self):
+        """
+        Shuts down the worker processes used to convert examples to features.
+
+        The workers are started again if the model converts examples to features after closing. The model can also be
+        used as a context manager, which closes it on exit.
+        """
+        self.tokenization_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def _move_model_to_device(self):
         self.model.to(self.device)
 
@@ -706,7 +728,7 @@ class T5Model:
             CustomDataset = args["dataset_class"]
             return CustomDataset(tokenizer, args, data, mode)
         else:
-            return T5Dataset(tokenizer, self.args, data, mode,)
+            return T5Dataset(tokenizer, self.args, data, mode, pool=self.tokenization_pool)
 
         return T5Dataset
 
@@ -13,6 +13,8 @@ from tokenizers.processors import BertProcessing
 from torch.utils.data import Dataset
 from transformers import PreTrainedTokenizer
 
+from simpletransformers.tokenization_pool import WorkerTokenizer
+
 logger = logging.getLogger(__name__)
 
 
@@ -43,7 +45,7 @@ def preprocess_data(data):
 
 
 class T5Dataset(Dataset):
-    def __init__(self, tokenizer, args, data, mode):
+    def __init__(self, tokenizer, args, data, mode, pool=None):
         cached_features_file = os.path.join(
             args["cache_dir"], args["model_name"] + "_cached_" + str(args["max_seq_length"]) + str(len(data))
         )
@@ -58,12 +60,21 @@ class T5Dataset(Dataset):
         else:
             logger.info(" Creating features from dataset file at %s", args["cache_dir"])
 
+        use_pool = args["use_multiprocessing"] and pool is not None
         data = [
-            (prefix, input_text, target_text, tokenizer, args)
+            (prefix, input_text, target_text, WorkerTokenizer() if use_pool else tokenizer, args)
             for prefix, input_text, target_text in zip(data["prefix"], data["input_text"], data["target_text"])
         ]
 
-        if args["use_multiprocessing"]:
+        if use_pool:
+            self.examples = list(
+                tqdm(
+                    pool.imap(preprocess_data, data, (tokenizer,), args["process_count"]),
+                    total=len(data),
+                    disable=args["silent"],
+                )
+            )
+        elif args["use_multiprocessing"]:
             with Pool(args["process_count"]) as p:
                 self.examples = list(
                     tqdm(p.imap(preprocess_data, data, chunksize=500), total=len(data), disable=args["silent"],)
@@ -0,0 +1,93 @@
+"""
+A persistent multiprocessing pool for converting examples to features.
+
+The pool is created lazily and reused across calls. Tokenizers are sent to each worker once, when the worker starts,
+instead of being pickled along with the examples of every task. Tasks refer to these tokenizers with WorkerTokenizer
+placeholders.
+"""
+
+import functools
+import logging
+import weakref
+from multiprocessing import Pool
+
+logger = logging.getLogger(__name__)
+
+_worker_tokenizers = ()
+
+
+class WorkerTokenizer:
+    """Placeholder for the tokenizer at `index` in the tokenizers of a TokenizationPool worker."""
+
+    def __init__(self, index=0):
+        self.index = index
+
+
+def _init_worker(tokenizers):
+    global _worker_tokenizers
+    _worker_tokenizers = tokenizers
+
+
+def _run_in_worker(func, row):
+    return func(
+        tuple(_worker_tokenizers[item.index] if isinstance(item, WorkerTokenizer) else item for item in row)
+    )
+
+
+def _shutdown(pool):
+    pool.close()
+    pool.join()
+
+
+class TokenizationPool:
+    """
+    Lazily created worker pool owned by a model, reused by every feature conversion of the model.
+
+    The workers are started on the first call to imap(), and are restarted only if different tokenizers or a different
+    process_count are used. Call close() to shut the workers down. Open pools are also shut down at interpreter exit.
+    """
+
+    def __init__(self):
+        self._pool = None
+        self._pool_key = None
+        self._finalizer = None
+
+    def imap(self, func, rows, tokenizers, process_count, chunksize=500):
+        """
+        Applies func to each row in the worker processes, yielding the results in order.
+
+        Args:
+            func: Module level function taking a single tuple.
+            rows: Iterable of tuples. Any WorkerTokenizer(i) in a tuple is replaced by tokenizers[i] before calling func.
+            tokenizers: Tuple of the tokenizers referenced by the rows.
+            process_count: Number of worker processes.
+            chunksize: Number of rows sent to a worker at a time.
+        """  # noqa: ignore flake8"
+        # len() changes when tokens are added to a tokenizer in place
+        pool_key = (process_count, tuple((id(tokenizer), len(tokenizer)) for tokenizer in tokenizers))
+        if self._pool is None or pool_key != self._pool_key:
+            self.close()
+            logger.info(" Starting tokenization pool with %d processes", process_count)
+            self._pool = Pool(process_count, initializer=_init_worker, initargs=(tuple(tokenizers),))
+            self._pool_key = pool_key
+            self._finalizer = weakref.finalize(self, _shutdown, self._pool)
+
+        return self._pool.imap(functools.partial(_run_in_worker, func), rows, chunksize=chunksize)
+
+    def close(self):
+        """Shuts down the worker processes. The pool is started again if it is used after closing."""
+        if self._finalizer is not None:
+            self._finalizer()
+        self._pool = None
+        self._pool_key = None
+        self._finalizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        # Worker processes cannot be pickled or copied, a copied model starts its own pool
+        return {"_pool": None, "_pool_key": None, "_finalizer": None}
@@ -1,6 +1,59 @@
+import json
+import os
+
+import numpy as np
 import pandas as pd
 import pytest
 from simpletransformers.classification import ClassificationModel, MultiLabelClassificationModel
+from simpletransformers.classification.classification_utils import (
+    InputExample,
+    LengthBucketBatchSampler,
+    aggregate_sliding_window_predictions,
+    convert_examples_to_arrays,
+    convert_examples_to_features,
+)
+from simpletransformers.feature_cache import FeatureStore
+from transformers import (
+    BertConfig,
+    BertForSequenceClassification,
+    BertTokenizer,
+    BertTokenizerFast,
+    RobertaTokenizer,
+    RobertaTokenizerFast,
+)
+
+TINY_VOCAB = "example sentence belonging to class a much longer the first second pair with thing".split()
+
+
+@pytest.fixture(scope="module")
+def tiny_bert_dir(tmp_path_factory):
+    # Randomly initialized one layer BERT, saved locally so that tests do not download a pretrained model
+    model_dir = tmp_path_factory.mktemp("tiny_bert")
+    with open(str(model_dir / "vocab.txt"), "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + TINY_VOCAB))
+    config = BertConfig(
+        vocab_size=5 + len(TINY_VOCAB),
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=128,
+        num_labels=3,
+    )
+    BertForSequenceClassification(config).save_pretrained(str(model_dir))
+    BertTokenizer(str(model_dir / "vocab.txt")).save_pretrained(str(model_dir))
+    return str(model_dir)
+
+
+def get_tiny_model(model_dir, tmp_path, model_class=ClassificationModel, **kwargs):
+    args = {
+        "use_multiprocessing": False,
+        "cache_dir": str(tmp_path / "cache_dir"),
+        "output_dir": str(tmp_path / "outputs"),
+        "silent": True,
+    }
+    args.update(kwargs)
+    return model_class("bert", model_dir, num_labels=3, use_cuda=False, args=args)
 
 
 @pytest.mark.parametrize(
@@ -139,3 +192,360 @@ def test_multilabel_classification(model_type, model_name):
     result, model_outputs, wrong_predictions = model.eval_model(eval_df)
 
     predictions, raw_outputs = model.predict(["This thing is entirely different from the other thing. "])
+
+
+@pytest.mark.parametrize(
+    "tokenizer_class, fast_tokenizer_class, model_name, sep_token_extra",
+    [
+        (BertTokenizer, BertTokenizerFast, "bert-base-uncased", False),
+        (RobertaTokenizer, RobertaTokenizerFast, "roberta-base", True),
+    ],
+)
+def test_fast_tokenizer_feature_conversion(tokenizer_class, fast_tokenizer_class, model_name, sep_token_extra):
+    tokenizer = tokenizer_class.from_pretrained(model_name)
+    fast_tokenizer = fast_tokenizer_class.from_pretrained(model_name)
+    examples = [
+        InputExample(0, "Example sentence belonging to class 1", None, 1),
+        InputExample(1, "A much longer example sentence " * 10, None, 0),
+        InputExample(2, "Example sentence pair", "with a second sequence that goes on " * 5, 1),
+        InputExample(3, "The first sequence of this pair is the longer one " * 5, "Short second", 0),
+    ]
+    conversion_args = {
+        "max_seq_length": 32,
+        "output_mode": "classification",
+        "cls_token": tokenizer.cls_token,
+        "sep_token": tokenizer.sep_token,
+        "sep_token_extra": sep_token_extra,
+        "pad_token": tokenizer.pad_token_id,
+        "cls_token_segment_id": 0,
+        "silent": True,
+    }
+
+    features = convert_examples_to_features(
+        examples, tokenizer=tokenizer, use_multiprocessing=False, **conversion_args
+    )
+    input_ids, input_mask, segment_ids, label_ids = convert_examples_to_arrays(
+        examples, tokenizer=fast_tokenizer, **conversion_args
+    )
+
+    expected_mask = np.array([f.input_mask for f in features])
+    np.testing.assert_array_equal(input_mask, expected_mask)
+    np.testing.assert_array_equal(segment_ids, np.array([f.segment_ids for f in features]))
+    np.testing.assert_array_equal(label_ids, np.array([f.label_id for f in features]))
+    # Both conversions pad input_ids with the tokenizer's pad_token_id
+    np.testing.assert_array_equal(input_ids, np.array([f.input_ids for f in features]))
+    assert (input_ids[input_mask == 0] == tokenizer.pad_token_id).all()
+
+
+@pytest.mark.parametrize("sliding_window", [False, True])
+def test_feature_conversion_pad_token(tmp_path, sliding_window):
+    # A vocabulary where the padding token is not id 0
+    with open(str(tmp_path / "vocab.txt"), "w") as f:
+        f.write("\n".join(["[UNK]", "[CLS]", "[SEP]", "[PAD]", "[MASK]"] + TINY_VOCAB))
+    tokenizer = BertTokenizer.from_pretrained(str(tmp_path))
+    examples = [InputExample(0, "example sentence", None, 1), InputExample(1, "the first pair " * 5, None, 0)]
+    conversion_args = {
+        "max_seq_length": 12,
+        "output_mode": "classification",
+        "cls_token": tokenizer.cls_token,
+        "sep_token": tokenizer.sep_token,
+        "pad_token": tokenizer.pad_token_id,
+        "cls_token_segment_id": 0,
+        "silent": True,
+    }
+
+    features = convert_examples_to_features(
+        examples,
+        tokenizer=tokenizer,
+        use_multiprocessing=False,
+        sliding_window=sliding_window,
+        stride=0.5,
+        flatten=True,
+        **conversion_args,
+    )
+
+    input_ids = np.array([f.input_ids for f in features])
+    input_mask = np.array([f.input_mask for f in features])
+    assert tokenizer.pad_token_id == 3
+    assert (input_mask == 0).any()
+    assert (input_ids[input_mask == 0] == tokenizer.pad_token_id).all()
+    if not sliding_window:
+        array_input_ids = convert_examples_to_arrays(examples, tokenizer=tokenizer, **conversion_args)[0]
+        np.testing.assert_array_equal(array_input_ids, input_ids)
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_length_bucket_batch_sampler(shuffle):
+    lengths = np.random.RandomState(0).randint(1, 128, size=1000)
+    sampler = LengthBucketBatchSampler(lengths, batch_size=16, shuffle=shuffle, bucket_size=4)
+
+    batches = list(sampler)
+
+    assert len(batches) == len(sampler)
+    assert all(len(batch) <= 16 for batch in batches)
+    assert sorted(i for batch in batches for i in batch) == list(range(1000))
+    # Each batch is a slice of its length-sorted bucket
+    for batch in batches:
+        assert (np.diff(lengths[batch]) <= 0).all()
+    if not shuffle:
+        order = np.concatenate(batches)
+        assert (np.diff(lengths[order]) <= 0).all()
+
+
+def test_length_bucketing_predict_order(tiny_bert_dir, tmp_path):
+    to_predict = [
+        "example",
+        "a much longer example sentence belonging to the first class " * 3,
+        "the second pair",
+        "thing " * 20,
+        "example sentence",
+    ] * 7
+
+    model = get_tiny_model(tiny_bert_dir, tmp_path, eval_batch_size=4, fast_predict_max_examples=0)
+    predictions, raw_outputs = model.predict(to_predict)
+
+    bucketed_model = get_tiny_model(
+        tiny_bert_dir, tmp_path, eval_batch_size=4, length_bucketing=True, dynamic_padding=True
+    )
+    bucketed_predictions, bucketed_raw_outputs = bucketed_model.predict(to_predict)
+
+    # Outputs are returned in the order of the inputs, not the order of the length bucketed batches
+    np.testing.assert_allclose(bucketed_raw_outputs, raw_outputs, atol=1e-5)
+    np.testing.assert_array_equal(bucketed_predictions, predictions)
+
+
+def test_tokenization_pool_reuse_and_close(tiny_bert_dir, tmp_path):
+    to_predict = ["example sentence", "the first pair", "thing " * 10]
+    expected_predictions, expected_outputs = get_tiny_model(tiny_bert_dir, tmp_path).predict(to_predict)
+
+    # Small predict() calls only use the workers when the low latency path is disabled
+    pool_args = {"use_multiprocessing": True, "process_count": 2, "fast_predict_max_examples": 0}
+    with get_tiny_model(tiny_bert_dir, tmp_path, **pool_args) as model:
+        predictions, raw_outputs = model.predict(to_predict)
+        pool = model.tokenization_pool._pool
+        assert pool is not None
+
+        # Later conversions reuse the workers
+        model.predict(to_predict)
+        assert model.tokenization_pool._pool is pool
+
+    assert model.tokenization_pool._pool is None
+    np.testing.assert_array_equal(predictions, expected_predictions)
+    np.testing.assert_allclose(raw_outputs, expected_outputs, atol=1e-6)
+
+
+def test_fast_predict(tiny_bert_dir, tmp_path):
+    to_predict = ["example sentence belonging to class a", "the second pair", "thing " * 30]
+
+    model = get_tiny_model(tiny_bert_dir, tmp_path, fast_predict_max_examples=0)
+    predictions, raw_outputs = model.predict(to_predict)
+    fast_model = get_tiny_model(tiny_bert_dir, tmp_path)
+    assert fast_model.args["fast_predict_max_examples"] == 32
+    fast_predictions, fast_raw_outputs = fast_model.predict(to_predict)
+
+    np.testing.assert_array_equal(fast_predictions, predictions)
+    np.testing.assert_allclose(fast_raw_outputs, raw_outputs, atol=1e-5)
+
+
+def test_predict_hidden_states(tiny_bert_dir, tmp_path):
+    to_predict = ["example sentence", "the second pair", "thing " * 10, "a much longer example sentence", "class a"]
+    hidden_states_args = {"eval_batch_size": 2, "max_seq_length": 16, "config": {"output_hidden_states": True}}
+
+    model = get_tiny_model(tiny_bert_dir, tmp_path, **hidden_states_args)
+    predictions, raw_outputs, embedding_outputs, layer_hidden_states = model.predict(to_predict)
+    assert embedding_outputs.shape == (5, 16, 16)
+    assert layer_hidden_states.shape == (1, 5, 16, 16)
+
+    # The outputs of every batch are written to the rows of their texts
+    for i, text in enumerate(to_predict):
+        text_predictions, text_raw_outputs, text_embedding_outputs, text_layer_hidden_states = model.predict([text])
+        assert text_predictions[0] == predictions[i]
+        np.testing.assert_allclose(text_raw_outputs[0], raw_outputs[i], atol=1e-5)
+        np.testing.assert_allclose(text_embedding_outputs[0], embedding_outputs[i], atol=1e-5)
+        np.testing.assert_allclose(text_layer_hidden_states[:, 0], layer_hidden_states[:, i], atol=1e-5)
+
+    memmap_dir = tmp_path / "hidden_states"
+    memmap_model = get_tiny_model(
+        tiny_bert_dir, tmp_path, hidden_states_memmap_dir=str(memmap_dir), **hidden_states_args
+    )
+    _, _, memmap_embedding_outputs, memmap_layer_hidden_states = memmap_model.predict(to_predict)
+    assert isinstance(memmap_embedding_outputs, np.memmap)
+    np.testing.assert_array_equal(np.load(str(memmap_dir / "embedding_outputs.npy")), embedding_outputs)
+    np.testing.assert_array_equal(np.load(str(memmap_dir / "layer_hidden_states.npy")), layer_hidden_states)
+
+
+@pytest.mark.parametrize("pooling", ["cls", "mean", "max"])
+def test_extract_embeddings(tiny_bert_dir, tmp_path, pooling):
+    to_predict = ["example sentence", "the second pair", "thing " * 10, "a much longer example sentence", "class a"]
+    model = get_tiny_model(
+        tiny_bert_dir, tmp_path, eval_batch_size=2, max_seq_length=16, config={"output_hidden_states": True}
+    )
+    _, _, embedding_outputs, layer_hidden_states = model.predict(to_predict)
+    lengths = [min(len(model.tokenizer.tokenize(text)), 14) + 2 for text in to_predict]
+
+    def pool(states):
+        if pooling == "cls":
+            return np.stack([text_states[0] for text_states in states])
+        if pooling == "mean":
+            return np.stack([text_states[:length].mean(axis=0) for text_states, length in zip(states, lengths)])
+        return np.stack([text_states[:length].max(axis=0) for text_states, length in zip(states, lengths)])
+
+    # Texts are batched by length and padded to the longest text of their batch, which does not change their states
+    embeddings = model.extract_embeddings(to_predict, pooling=pooling, chunksize=3)
+    np.testing.assert_allclose(embeddings, pool(layer_hidden_states[-1]), atol=1e-5)
+
+    embeddings = model.extract_embeddings(to_predict, pooling=pooling, layers=[-1, 0], chunksize=3)
+    expected = np.concatenate([pool(layer_hidden_states[-1]), pool(embedding_outputs)], axis=1)
+    np.testing.assert_allclose(embeddings, expected, atol=1e-5)
+
+
+def test_extract_embeddings_output_file(tiny_bert_dir, tmp_path):
+    to_predict = ["example sentence", "the second pair", "thing " * 10, "a much longer example sentence", "class a"]
+    model = get_tiny_model(tiny_bert_dir, tmp_path, eval_batch_size=2)
+    expected = model.extract_embeddings(to_predict, dtype="float16")
+
+    output_file = str(tmp_path / "embeddings.npy")
+    embeddings = model.extract_embeddings(to_predict, output_file=output_file, dtype="float16", chunksize=2)
+    assert isinstance(embeddings, np.memmap)
+    assert embeddings.dtype == np.float16
+    np.testing.assert_array_equal(np.load(output_file), expected)
+    assert not os.path.exists(output_file + ".progress")
+
+    # An interrupted job resumes after the last completed chunk, and keeps the embeddings written before it
+    embeddings[:2] = 1
+    embeddings[2:] = 0
+    embeddings.flush()
+    with open(output_file + ".progress", "w") as f:
+        json.dump({"rows": 2}, f)
+    model.extract_embeddings(to_predict, output_file=output_file, dtype="float16", chunksize=2)
+    assert (np.load(output_file)[:2] == 1).all()
+    np.testing.assert_array_equal(np.load(output_file)[2:], expected[2:])
+    assert not os.path.exists(output_file + ".progress")
+
+    with open(output_file + ".progress", "w") as f:
+        json.dump({"rows": 2}, f)
+    with pytest.raises(ValueError):
+        model.extract_embeddings(to_predict[:4], output_file=output_file, dtype="float16")
+
+
+@pytest.mark.parametrize("model_class", [ClassificationModel, MultiLabelClassificationModel])
+def test_eval_data_reused_during_training(tiny_bert_dir, tmp_path, monkeypatch, model_class):
+    if model_class is MultiLabelClassificationModel:
+        labels = [[1, 0, 0], [0, 1, 1], [0, 0, 1]]
+    else:
+        labels = [0, 1, 2]
+    train_df = pd.DataFrame(list(zip(["example sentence", "the second pair", "thing"], labels)) * 4)
+    eval_df = pd.DataFrame(list(zip(["example sentence", "the first pair", "class a"], labels)))
+    model = get_tiny_model(
+        tiny_bert_dir,
+        tmp_path,
+        model_class=model_class,
+        train_batch_size=3,
+        num_train_epochs=2,
+        evaluate_during_training=True,
+        evaluate_during_training_steps=2,
+        best_model_dir=str(tmp_path / "best_model"),
+        tensorboard_dir=str(tmp_path / "runs"),
+        save_eval_checkpoints=False,
+        save_model_every_epoch=False,
+    )
+
+    eval_conversions = []
+    load_and_cache_examples = model.load_and_cache_examples
+
+    def count_eval_conversions(examples, evaluate=False, **kwargs):
+        if evaluate:
+            eval_conversions.append(len(examples))
+        return load_and_cache_examples(examples, evaluate=evaluate, **kwargs)
+
+    monkeypatch.setattr(model, "load_and_cache_examples", count_eval_conversions)
+
+    model.train_model(train_df, eval_df=eval_df)
+
+    # Four evaluations during training (every 2 of 8 steps) and two at the end of the epochs, with one conversion
+    training_progress_scores = pd.read_csv(str(tmp_path / "outputs" / "training_progress_scores.csv"))
+    assert len(training_progress_scores) == 6
+    assert eval_conversions == [3]
+    assert model.eval_data_cache is None
+
+    # Outside of training, eval data is converted again
+    model.eval_model(eval_df)
+    assert eval_conversions == [3, 3]
+
+
+def test_feature_store_max_examples(tiny_bert_dir, tmp_path):
+    model = get_tiny_model(tiny_bert_dir, tmp_path, reprocess_input_data=False, feature_store_max_examples=4)
+    texts = ["example sentence", "the first pair", "class a", "thing", "the second pair", "a much longer example"]
+
+    def convert(indices):
+        examples = [InputExample(i, texts[i], None, i % 3) for i in indices]
+        return model.load_and_cache_examples(examples, evaluate=True)
+
+    expected_dataset = convert([0, 1, 2, 3, 4, 5])
+    feature_store_dir = [name for name in os.listdir(str(tmp_path / "cache_dir")) if name.startswith("feature_store")]
+    feature_store = FeatureStore(str(tmp_path / "cache_dir" / feature_store_dir[0]))
+    # More examples than the limit are kept while they are in use, then the store is compacted to the next call
+    assert len(feature_store) == 6
+
+    dataset = convert([5, 1, 5])
+    assert len(FeatureStore(feature_store.store_path)) == 2
+    for tensor, expected_tensor in zip(dataset.tensors, expected_dataset.tensors):
+        np.testing.assert_array_equal(tensor.numpy(), expected_tensor[[5, 1, 5]].numpy())
+
+    convert([0, 1])
+    assert len(FeatureStore(feature_store.store_path)) == 3
+
+
+def test_sliding_window_aggregation():
+    window_outputs = np.array(
+        [
+            # Example 0: windows predict 1, 0, 1
+            [0.1, 0.9, 0.0],
+            [0.8, 0.1, 0.1],
+            [0.2, 0.7, 0.1],
+            # Example 1: windows predict 0, 2 (tied vote)
+            [0.6, 0.3, 0.1],
+            [0.0, 0.1, 0.9],
+            # Example 2: one window with tied outputs
+            [0.4, 0.4, 0.2],
+        ]
+    )
+    window_counts = [3, 2, 1]
+
+    preds, window_starts = aggregate_sliding_window_predictions(window_outputs, window_counts, "mode", tie_value=1)
+    np.testing.assert_array_equal(window_starts, [0, 3, 5])
+    np.testing.assert_array_equal(preds, [1, 1, 0])
+
+    preds, _ = aggregate_sliding_window_predictions(window_outputs, window_counts, "mode", tie_value=2)
+    np.testing.assert_array_equal(preds, [1, 2, 0])
+
+    # Tied mean and max outputs resolve to the lowest label, like np.argmax
+    preds, _ = aggregate_sliding_window_predictions(window_outputs, window_counts, "mean")
+    np.testing.assert_array_equal(preds, [1, 2, 0])
+    preds, _ = aggregate_sliding_window_predictions(window_outputs, window_counts, "max")
+    np.testing.assert_array_equal(preds, [1, 2, 0])
+
+    with pytest.raises(ValueError):
+        aggregate_sliding_window_predictions(window_outputs, window_counts, "median")
+
+
+@pytest.mark.parametrize("strategy", ["mode", "mean", "max"])
+def test_sliding_window_aggregation_matches_per_example_loop(strategy):
+    rng = np.random.RandomState(0)
+    window_counts = rng.randint(1, 6, size=200)
+    # Few distinct values, so that votes and outputs are often tied
+    window_outputs = rng.randint(3, size=(window_counts.sum(), 4)).astype(np.float32)
+
+    preds, window_starts = aggregate_sliding_window_predictions(window_outputs, window_counts, strategy, tie_value=3)
+
+    expected = []
+    for example_outputs in np.split(window_outputs, np.cumsum(window_counts)[:-1]):
+        if strategy == "mode":
+            votes = np.bincount(np.argmax(example_outputs, axis=1), minlength=4)
+            expected.append(3 if (votes == votes.max()).sum() > 1 else np.argmax(votes))
+        elif strategy == "mean":
+            expected.append(np.argmax(example_outputs.mean(axis=0)))
+        else:
+            expected.append(np.argmax(example_outputs.max(axis=0)))
+    np.testing.assert_array_equal(preds, expected)
+    np.testing.assert_array_equal(window_starts, np.cumsum(window_counts) - window_counts)
@@ -0,0 +1,131 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+from simpletransformers.classification.classification_utils import trim_batch_padding
+from simpletransformers.config.global_args import global_args
+from simpletransformers.dataloader_utils import (
+    BatchSlicedTensorDataset,
+    TensorBatchSampler,
+    get_batch_sliced_dataloader,
+    get_dataloader_kwargs,
+    seed_worker,
+)
+from torch.utils.data import DataLoader, Dataset, TensorDataset
+
+
+class RandomNumbersDataset(Dataset):
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        return torch.tensor([random.random(), np.random.rand(), torch.rand(1).item()])
+
+
+def get_feature_dataset(n_examples=37, max_seq_length=16):
+    # (input_ids, input_mask, segment_ids, label_ids) features, right padded to max_seq_length
+    lengths = torch.randint(1, max_seq_length + 1, (n_examples,))
+    input_mask = (torch.arange(max_seq_length) < lengths[:, None]).long()
+    return TensorDataset(
+        torch.randint(1, 1000, (n_examples, max_seq_length)) * input_mask,
+        input_mask,
+        torch.zeros(n_examples, max_seq_length, dtype=torch.long),
+        torch.randint(3, (n_examples,)),
+    )
+
+
+def get_args(**kwargs):
+    args = dict(global_args)
+    args.update(kwargs)
+    return args
+
+
+def test_dataloader_kwargs():
+    assert get_dataloader_kwargs(get_args()) == {"num_workers": 0, "pin_memory": False}
+
+    # Worker args are only passed when there are workers
+    args = get_args(pin_memory=True, prefetch_factor=4, persistent_workers=True)
+    assert get_dataloader_kwargs(args) == {"num_workers": 0, "pin_memory": True}
+
+    kwargs = get_dataloader_kwargs(args, default_num_workers=2)
+    assert kwargs["num_workers"] == 2
+    assert kwargs["prefetch_factor"] == 4
+    assert kwargs["persistent_workers"]
+
+    kwargs = get_dataloader_kwargs(get_args(dataloader_num_workers=3), default_num_workers=2)
+    assert kwargs["num_workers"] == 3
+    assert "prefetch_factor" not in kwargs
+    assert "persistent_workers" not in kwargs
+
+
+def test_seed_worker():
+    def draw(worker_seed):
+        # PyTorch seeds the torch generator of each worker before worker_init_fn is called
+        torch.manual_seed(worker_seed)
+        seed_worker(0)
+        return random.random(), np.random.rand()
+
+    assert draw(123) == draw(123)
+    assert draw(123)[0] != draw(124)[0]
+    assert draw(123)[1] != draw(124)[1]
+
+
+@pytest.mark.parametrize("persistent_workers", [False, True])
+def test_dataloader_workers_random_state(persistent_workers):
+    args = get_args(dataloader_num_workers=2, persistent_workers=persistent_workers)
+    dataloader = DataLoader(RandomNumbersDataset(), batch_size=1, **get_dataloader_kwargs(args))
+
+    # Each worker draws different python, numpy and torch random numbers
+    numbers = torch.cat(list(dataloader))
+    assert len(set(numbers[:, 0].tolist())) == 4
+    assert len(set(numbers[:, 1].tolist())) == 4
+    assert len(set(numbers[:, 2].tolist())) == 4
+
+
+def test_batch_sliced_tensor_dataset():
+    dataset = get_feature_dataset()
+    batch_sliced_dataset = BatchSlicedTensorDataset(*dataset.tensors)
+    indices = [5, 0, 36, 5]
+
+    for index in [indices, torch.tensor(indices)]:
+        batch = batch_sliced_dataset[index]
+        expected = [torch.stack([dataset[i][column] for i in indices]) for column in range(4)]
+        assert all(torch.equal(tensor, expected_tensor) for tensor, expected_tensor in zip(batch, expected))
+
+    assert all(torch.equal(a, b) for a, b in zip(batch_sliced_dataset[3], dataset[3]))
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_tensor_batch_sampler(drop_last):
+    sampler = TensorBatchSampler(37, 8, drop_last=drop_last)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == (4 if drop_last else 5)
+    assert torch.cat(batches).tolist() == list(range(32 if drop_last else 37))
+
+    torch.manual_seed(0)
+    shuffled_batches = list(TensorBatchSampler(37, 8, shuffle=True, drop_last=drop_last))
+    assert [len(batch) for batch in shuffled_batches] == [len(batch) for batch in batches]
+    assert torch.cat(shuffled_batches).tolist() != torch.cat(batches).tolist()
+    if not drop_last:
+        assert sorted(torch.cat(shuffled_batches).tolist()) == list(range(37))
+
+
+@pytest.mark.parametrize("num_workers", [0, 1])
+def test_batch_sliced_dataloader(num_workers):
+    dataset = get_feature_dataset()
+    args = get_args(dataloader_num_workers=num_workers)
+
+    batches = list(get_batch_sliced_dataloader(dataset, TensorBatchSampler(len(dataset), 8), args))
+    expected_batches = list(DataLoader(dataset, batch_size=8))
+
+    assert len(batches) == len(expected_batches)
+    for batch, expected_batch in zip(batches, expected_batches):
+        assert all(torch.equal(tensor, expected_tensor) for tensor, expected_tensor in zip(batch, expected_batch))
+
+    # collate_fn is applied to each whole batch
+    trimmed_batches = get_batch_sliced_dataloader(
+        dataset, TensorBatchSampler(len(dataset), 8), args, collate_fn=trim_batch_padding
+    )
+    for batch, expected_batch in zip(trimmed_batches, expected_batches):
+        assert all(torch.equal(a, b) for a, b in zip(batch, trim_batch_padding(expected_batch)))
@@ -0,0 +1,171 @@
+import os
+import pickle
+
+import numpy as np
+from simpletransformers.feature_cache import (
+    FeatureStore,
+    get_cache_key,
+    get_example_digests,
+    hash_tokenizer,
+    load_feature_arrays,
+    save_feature_arrays,
+)
+from transformers import BertTokenizer
+
+
+def make_feature_arrays(n_rows, max_seq_length=8, seed=0):
+    rng = np.random.RandomState(seed)
+    return (
+        rng.randint(1000, size=(n_rows, max_seq_length)).astype(np.int64),
+        np.ones((n_rows, max_seq_length), dtype=np.int64),
+        np.zeros((n_rows, max_seq_length), dtype=np.int64),
+        rng.randint(3, size=n_rows).astype(np.int64),
+    )
+
+
+def write_vocab(tokenizer_dir, words):
+    tokenizer_dir.mkdir()
+    with open(str(tokenizer_dir / "vocab.txt"), "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words))
+    return str(tokenizer_dir)
+
+
+def test_feature_arrays_round_trip(tmp_path):
+    cache_path = str(tmp_path / "cached_train_bert_8_3_key")
+    feature_arrays = make_feature_arrays(5)
+
+    save_feature_arrays(cache_path, feature_arrays)
+    loaded_arrays, window_counts = load_feature_arrays(cache_path)
+
+    assert window_counts is None
+    for array, loaded in zip(feature_arrays, loaded_arrays):
+        assert isinstance(loaded, np.memmap)
+        np.testing.assert_array_equal(array, loaded)
+
+    # Memory maps are copy-on-write, so writing to them leaves the cache unchanged
+    loaded_arrays[0][:] = -1
+    np.testing.assert_array_equal(load_feature_arrays(cache_path)[0][0], feature_arrays[0])
+
+
+def test_feature_arrays_window_counts(tmp_path):
+    cache_path = str(tmp_path / "cached_dev_bert_8_3_key")
+    feature_arrays = make_feature_arrays(6)
+
+    save_feature_arrays(cache_path, feature_arrays, window_counts=[1, 3, 2])
+    loaded_arrays, window_counts = load_feature_arrays(cache_path)
+
+    assert window_counts == [1, 3, 2]
+    np.testing.assert_array_equal(feature_arrays[3], loaded_arrays[3])
+
+
+def test_feature_arrays_replace_old_cache(tmp_path):
+    cache_path = str(tmp_path / "cached_train_bert_8_3_key")
+    # Caches from older versions are a single pickled file
+    with open(cache_path, "wb") as f:
+        pickle.dump([], f)
+
+    save_feature_arrays(cache_path, make_feature_arrays(2))
+    save_feature_arrays(cache_path, make_feature_arrays(4, seed=1))
+
+    assert os.path.isdir(cache_path)
+    assert os.listdir(str(tmp_path)) == ["cached_train_bert_8_3_key"]
+    np.testing.assert_array_equal(load_feature_arrays(cache_path)[0][0], make_feature_arrays(4, seed=1)[0])
+
+
+def test_cache_key():
+    assert get_cache_key("bert", 128, np.arange(3)) == get_cache_key("bert", 128, np.arange(3))
+    assert get_cache_key("bert", 128, np.arange(3)) != get_cache_key("bert", 128, np.arange(4))
+    assert get_cache_key("bert", 128) != get_cache_key("bert", 256)
+    # Parts are hashed separately, so they cannot run into each other
+    assert get_cache_key("ab", "c") != get_cache_key("a", "bc")
+
+
+def test_cache_key_tokenizer_change(tmp_path):
+    tokenizer_dir = write_vocab(tmp_path / "tokenizer", ["the", "quick", "brown", "fox"])
+    tokenizer_hash = hash_tokenizer(BertTokenizer.from_pretrained(tokenizer_dir))
+
+    # Vocabulary files are hashed by their contents, not their paths
+    other_tokenizer_dir = write_vocab(tmp_path / "other_tokenizer", ["the", "quick", "brown", "fox"])
+    assert hash_tokenizer(BertTokenizer.from_pretrained(other_tokenizer_dir)) == tokenizer_hash
+
+    assert hash_tokenizer(BertTokenizer.from_pretrained(tokenizer_dir, do_lower_case=False)) != tokenizer_hash
+
+    changed_tokenizer_dir = write_vocab(tmp_path / "changed_tokenizer", ["the", "quick", "brown", "dog"])
+    assert hash_tokenizer(BertTokenizer.from_pretrained(changed_tokenizer_dir)) != tokenizer_hash
+
+    tokenizer = BertTokenizer.from_pretrained(tokenizer_dir)
+    tokenizer.add_tokens(["jumps"])
+    assert hash_tokenizer(tokenizer) != tokenizer_hash
+
+
+def test_cache_key_example_change():
+    examples = [("the quick", None, 0), ("brown fox", None, 1)]
+    cache_key = get_cache_key(get_example_digests(examples))
+
+    assert get_cache_key(get_example_digests(list(examples))) == cache_key
+    assert get_cache_key(get_example_digests([("the quick", None, 0), ("brown fox", None, 0)])) != cache_key
+    assert get_cache_key(get_example_digests([("the quick", None, 0), ("brown dog", None, 1)])) != cache_key
+    assert get_cache_key(get_example_digests(examples[::-1])) != cache_key
+    assert get_cache_key(get_example_digests(examples + examples[:1])) != cache_key
+
+
+def test_feature_store_round_trip(tmp_path):
+    store_path = str(tmp_path / "feature_store")
+    digests = get_example_digests([(str(i),) for i in range(6)])
+    # Example i has i % 3 + 1 feature rows
+    window_counts = [i % 3 + 1 for i in range(6)]
+    feature_arrays = make_feature_arrays(sum(window_counts))
+    example_rows = np.split(np.arange(sum(window_counts)), np.cumsum(window_counts)[:-1])
+
+    feature_store = FeatureStore(store_path)
+    assert (feature_store.lookup(digests) == -1).all()
+
+    first_rows = np.concatenate(example_rows[:4])
+    feature_store.add(digests[:4], tuple(array[first_rows] for array in feature_arrays), window_counts[:4])
+    last_rows = np.concatenate(example_rows[4:])
+    FeatureStore(store_path).add(digests[4:], tuple(array[last_rows] for array in feature_arrays), window_counts[4:])
+
+    # Reopened from disk, with one shard per add()
+    feature_store = FeatureStore(store_path)
+    assert len(feature_store.shards) == 2
+
+    order = [5, 0, 3, 3, 1]
+    positions = feature_store.lookup(digests[order])
+    assert (positions >= 0).all()
+
+    gathered_arrays, gathered_counts = feature_store.gather(positions)
+    expected_rows = np.concatenate([example_rows[i] for i in order])
+    assert gathered_counts == [window_counts[i] for i in order]
+    for array, gathered in zip(feature_arrays, gathered_arrays):
+        np.testing.assert_array_equal(array[expected_rows], gathered)
+
+    assert (feature_store.lookup(get_example_digests([("6",)])) == -1).all()
+
+
+def test_feature_store_compact_and_clear(tmp_path):
+    store_path = str(tmp_path / "feature_store")
+    digests = get_example_digests([(str(i),) for i in range(6)])
+    feature_arrays = make_feature_arrays(6)
+
+    feature_store = FeatureStore(store_path)
+    for i in range(3):
+        rows = slice(2 * i, 2 * i + 2)
+        feature_store.add(digests[rows], tuple(array[rows] for array in feature_arrays), [1, 1])
+    assert len(feature_store) == 6
+
+    # Only the given examples are kept, in a single shard
+    kept = [4, 1, 4]
+    feature_store.compact(digests[kept])
+    assert len(feature_store) == 2
+    assert len(os.listdir(store_path)) == 1
+
+    feature_store = FeatureStore(store_path)
+    assert (feature_store.lookup(digests[[0, 2, 3, 5]]) == -1).all()
+    gathered_arrays, _ = feature_store.gather(feature_store.lookup(digests[kept]))
+    for array, gathered in zip(feature_arrays, gathered_arrays):
+        np.testing.assert_array_equal(array[kept], gathered)
+
+    feature_store.clear()
+    assert len(feature_store) == 0
+    assert os.listdir(store_path) == []
+    assert len(FeatureStore(store_path)) == 0
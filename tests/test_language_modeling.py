@@ -0,0 +1,401 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+from simpletransformers.custom_models.models import ElectraForLanguageModelingModel
+from simpletransformers.language_modeling import language_modeling_utils
+from simpletransformers.language_modeling.language_modeling_utils import (
+    LineByLineTextDataset,
+    StreamingTextDataset,
+    TokenArrayDataset,
+    TokenMasker,
+    build_token_blocks,
+    get_line_aligned_shards,
+    get_offsets,
+    pack_sequences,
+    save_token_arrays,
+    tokenize_corpus,
+    truncate_batch,
+)
+from tokenizers.implementations import ByteLevelBPETokenizer
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer, ElectraConfig
+
+TINY_VOCAB = "the quick brown fox jumps over lazy dog".split()
+
+
+class WhitespaceTokenizer:
+    # Minimal tokenizer with one id per word, wrapping blocks in the ids of <s> and </s>
+    max_len = 512
+    max_len_single_sentence = 510
+
+    def tokenize(self, text):
+        return text.split()
+
+    def convert_tokens_to_ids(self, tokens):
+        return [int(token) for token in tokens]
+
+    def build_inputs_with_special_tokens(self, token_ids):
+        return [-1] + token_ids + [-2]
+
+
+class PairTemplateTokenizer(WhitespaceTokenizer):
+    # Special tokens that are not a fixed prefix and suffix of the block
+    def build_inputs_with_special_tokens(self, token_ids):
+        return [-1] + token_ids[: len(token_ids) // 2] + [-2] + token_ids[len(token_ids) // 2 :] + [-2]
+
+
+@pytest.fixture
+def corpus_file(tmp_path):
+    corpus_file = tmp_path / "corpus.txt"
+    corpus_file.write_text("\n".join(" ".join(str(i * 10 + j) for j in range(i % 7 + 1)) for i in range(200)))
+    return str(corpus_file)
+
+
+@pytest.fixture
+def tokenizer_dir(tmp_path):
+    corpus = tmp_path / "corpus.txt"
+    corpus.write_text("The quick brown fox jumps over the lazy dog.\n" * 10, encoding="utf-8")
+    tokenizer = ByteLevelBPETokenizer()
+    tokenizer.train([str(corpus)], vocab_size=300, min_frequency=1, special_tokens=["<s>", "<pad>", "</s>", "<unk>"])
+    tokenizer.save(str(tmp_path))
+    return str(tmp_path)
+
+
+@pytest.fixture(scope="module")
+def bert_tokenizer(tmp_path_factory):
+    tokenizer_dir = tmp_path_factory.mktemp("tiny_bert_tokenizer")
+    with open(str(tokenizer_dir / "vocab.txt"), "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + TINY_VOCAB))
+    return BertTokenizer.from_pretrained(str(tokenizer_dir))
+
+
+def test_pack_sequences():
+    sequences = [[0, 5, 2], [0, 6, 7, 2], [0, 8, 9, 10, 11, 2], [0, 12, 2]]
+
+    packed = pack_sequences(sequences, block_size=7)
+
+    assert packed == [[0, 5, 2, 6, 7, 2], [0, 8, 9, 10, 11, 2], [0, 12, 2]]
+    assert all(len(sequence) <= 7 for sequence in packed)
+
+
+@pytest.mark.parametrize("block_size", [8, 16, 64])
+def test_line_by_line_packing(tmp_path, tokenizer_dir, block_size):
+    lines = [
+        "The quick brown fox",
+        "jumps over",
+        "the lazy dog.",
+        "The dog",
+        "The quick brown fox jumps over the lazy dog.",
+    ]
+    train_file = tmp_path / "train.txt"
+    train_file.write_text("\n".join(lines), encoding="utf-8")
+
+    dataset = LineByLineTextDataset(
+        None, {"tokenizer_name": tokenizer_dir}, str(train_file), block_size=block_size, packing=True
+    )
+
+    assert all(len(example) <= block_size for example in dataset.examples)
+    assert 0 < dataset.packing_efficiency <= 1
+    assert dataset.packing_efficiency == sum(map(len, dataset.examples)) / (len(dataset.examples) * block_size)
+
+
+@pytest.mark.parametrize("num_workers", [1, 2, 3, 7])
+def test_streaming_worker_sharding(corpus_file, num_workers):
+    dataset = StreamingTextDataset(WhitespaceTokenizer(), {"manual_seed": None}, corpus_file, block_size=10)
+    with open(corpus_file) as f:
+        lines = f.read().splitlines()
+
+    # Every line is read by exactly one worker
+    worker_lines = [list(dataset._read_lines(worker_id, num_workers)) for worker_id in range(num_workers)]
+
+    assert [line for lines_read in worker_lines for line in lines_read] == lines
+
+
+def test_streaming_persistent_workers_epoch(corpus_file):
+    args = {"manual_seed": 42}
+    dataset = StreamingTextDataset(WhitespaceTokenizer(), args, corpus_file, block_size=10, shuffle_buffer_size=20)
+    dataloader = DataLoader(dataset, batch_size=None, num_workers=1, persistent_workers=True)
+
+    epochs = []
+    for epoch in range(2):
+        dataset.set_epoch(epoch)
+        epochs.append([block.tolist() for block in dataloader])
+
+    # The persistent worker shuffles each epoch like a dataset iterated in the main process
+    for epoch, blocks in enumerate(epochs):
+        expected = StreamingTextDataset(WhitespaceTokenizer(), args, corpus_file, 10, shuffle_buffer_size=20)
+        expected.set_epoch(epoch)
+        assert blocks == [block.tolist() for block in expected]
+    assert epochs[0] != epochs[1]
+    assert sorted(epochs[0]) == sorted(epochs[1])
+    assert all(len(block) == 10 for block in epochs[0])
+
+
+def test_token_masker(bert_tokenizer):
+    torch.manual_seed(0)
+    masker = TokenMasker(bert_tokenizer, mlm_probability=0.15)
+    special_token_ids = torch.tensor(bert_tokenizer.all_special_ids)
+    # Sequences of random words, with special tokens and padding
+    inputs = torch.randint(5, len(bert_tokenizer), (2048, 64))
+    inputs[:, 0] = bert_tokenizer.cls_token_id
+    inputs[:, 40] = bert_tokenizer.sep_token_id
+    inputs[:, 41:] = bert_tokenizer.pad_token_id
+
+    masked_inputs, labels = masker(inputs.clone())
+
+    is_special = (inputs.unsqueeze(-1) == special_token_ids).any(dim=-1)
+    masked = labels.ne(-100)
+    assert not (masked & is_special).any()
+    assert torch.equal(labels[masked], inputs[masked])
+    assert torch.equal(masked_inputs[~masked], inputs[~masked])
+    assert abs(masked.sum().item() / (~is_special).sum().item() - 0.15) < 0.01
+
+    # 80% MASK, 10% random word, 10% unchanged
+    replaced = masked_inputs[masked].eq(bert_tokenizer.mask_token_id).float().mean().item()
+    unchanged = masked_inputs[masked].eq(inputs[masked]).float().mean().item()
+    assert abs(replaced - 0.8) < 0.02
+    # Some random words are the original word
+    assert abs(unchanged - 0.1 - 0.1 / len(bert_tokenizer)) < 0.02
+
+
+def test_token_masker_pickle(bert_tokenizer):
+    masker = TokenMasker(bert_tokenizer)
+    masker(torch.randint(len(bert_tokenizer), (2, 8)))
+
+    # Masking in DataLoader workers sends the masker to each worker
+    worker_masker = pickle.loads(pickle.dumps(masker))
+
+    assert worker_masker._device_lookups == {}
+    assert torch.equal(worker_masker.special_tokens_lookup, masker.special_tokens_lookup)
+    inputs = torch.full((2, 8), bert_tokenizer.pad_token_id)
+    assert torch.equal(worker_masker(inputs.clone())[0], inputs)
+
+
+@pytest.mark.parametrize("shard_size", [1, 7, 50, 10000])
+@pytest.mark.parametrize("trailing_newline", [True, False])
+def test_line_aligned_shards(tmp_path, shard_size, trailing_newline):
+    text = "\n".join("the quick brown fox " * (i % 5) for i in range(30)) + ("\n" if trailing_newline else "")
+    file_path = tmp_path / "corpus.txt"
+    file_path.write_bytes(text.encode("utf-8"))
+    data = file_path.read_bytes()
+
+    shards = get_line_aligned_shards(str(file_path), shard_size)
+
+    # Contiguous byte ranges covering the file, each ending at the end of a line
+    assert shards[0][0] == 0
+    assert shards[-1][1] == len(data)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(shards, shards[1:]))
+    assert all(start < end for start, end in shards)
+    assert all(data[end - 1 : end] == b"\n" for _, end in shards[:-1])
+    if shard_size == 1:
+        # A shard never splits a line, so single byte shards hold a single line
+        assert len(shards) == text.count("\n") + (not trailing_newline)
+
+
+def test_tokenize_corpus_resume(tmp_path, bert_tokenizer, monkeypatch):
+    text = "\n".join(" ".join(TINY_VOCAB[(i + j) % len(TINY_VOCAB)] for j in range(i % 9)) for i in range(100))
+    file_path = tmp_path / "corpus.txt"
+    file_path.write_text(text, encoding="utf-8")
+    args = {
+        "cache_dir": str(tmp_path / "cache_dir"),
+        "tokenization_shard_size": 64,
+        "use_multiprocessing": False,
+        "process_count": 1,
+        "silent": True,
+    }
+
+    tokenized_shards = []
+    original_tokenize_shard = language_modeling_utils.tokenize_shard
+
+    def tokenize_shard(data):
+        tokenized_shards.append(data[-1])
+        return original_tokenize_shard(data)
+
+    monkeypatch.setattr(language_modeling_utils, "tokenize_shard", tokenize_shard)
+
+    (shard_paths,) = tokenize_corpus(bert_tokenizer, args, [str(file_path)])
+
+    assert tokenized_shards == shard_paths
+    assert len(shard_paths) > 5
+    token_ids = np.concatenate([np.load(path) for path in shard_paths])
+    assert token_ids.tolist() == bert_tokenizer.convert_tokens_to_ids(bert_tokenizer.tokenize(text))
+
+    # An interrupted run resumes from the shards it completed
+    for path in shard_paths[2:]:
+        os.remove(path)
+    del tokenized_shards[:]
+
+    assert tokenize_corpus(bert_tokenizer, args, [str(file_path)]) == [shard_paths]
+    assert tokenized_shards == shard_paths[2:]
+    assert np.concatenate([np.load(path) for path in shard_paths]).tolist() == token_ids.tolist()
+
+    # Shards of a changed file are not reused
+    del tokenized_shards[:]
+    file_path.write_text(text + "\nthe lazy dog", encoding="utf-8")
+    (changed_shard_paths,) = tokenize_corpus(bert_tokenizer, args, [str(file_path)])
+    assert tokenized_shards == changed_shard_paths
+    assert not set(changed_shard_paths) & set(shard_paths)
+
+
+@pytest.mark.parametrize("tokenizer_name", ["bert", "pair_template"])
+def test_build_token_blocks(bert_tokenizer, tokenizer_name):
+    tokenizer = bert_tokenizer if tokenizer_name == "bert" else PairTemplateTokenizer()
+    token_ids = np.arange(5, 5 + 47, dtype=np.int64)
+
+    tokens, block_lengths = build_token_blocks(tokenizer, token_ids, block_size=10)
+
+    # The last partial block is dropped
+    expected = [tokenizer.build_inputs_with_special_tokens(token_ids[i : i + 10].tolist()) for i in range(0, 40, 10)]
+    assert block_lengths.tolist() == [len(block) for block in expected]
+    assert tokens.tolist() == [token for block in expected for token in block]
+
+
+@pytest.mark.parametrize("max_token_id, dtype", [(2 ** 16 - 1, np.uint16), (2 ** 16, np.int32)])
+def test_token_arrays_dtype(tmp_path, max_token_id, dtype):
+    sequences = [[0, 1, 2], [max_token_id], [3, 4, max_token_id, 5]]
+    tokens = np.array([token for sequence in sequences for token in sequence], dtype=np.int64)
+    cache_path = str(tmp_path / "cached_lm")
+
+    save_token_arrays(cache_path, tokens, get_offsets([len(sequence) for sequence in sequences]))
+    dataset = TokenArrayDataset()
+    dataset._load_token_arrays(cache_path)
+
+    assert dataset.tokens.dtype == dtype
+    assert len(dataset) == 3
+    for i, sequence in enumerate(sequences):
+        assert dataset[i].dtype == torch.long
+        assert dataset[i].tolist() == sequence
+
+
+def get_electra_configs(generator_embedding_size=8):
+    config_kwargs = {
+        "vocab_size": 20,
+        "max_position_embeddings": 32,
+        "num_hidden_layers": 1,
+        "num_attention_heads": 2,
+    }
+    generator_config = ElectraConfig(
+        embedding_size=generator_embedding_size, hidden_size=8, intermediate_size=16, **config_kwargs
+    )
+    discriminator_config = ElectraConfig(embedding_size=8, hidden_size=16, intermediate_size=32, **config_kwargs)
+    return generator_config, discriminator_config
+
+
+@pytest.mark.parametrize("sampling", ["multinomial", "gumbel"])
+def test_electra_sample_tokens(sampling):
+    torch.manual_seed(0)
+    generator_config, discriminator_config = get_electra_configs()
+    model = ElectraForLanguageModelingModel(
+        discriminator_config,
+        generator_config=generator_config,
+        discriminator_config=discriminator_config,
+        sampling=sampling,
+    )
+    logits = torch.tensor([2.0, 1.0, 0.0, -1.0, -30.0]).repeat(50000, 1)
+
+    samples = model.sample_tokens(logits.requires_grad_())
+
+    assert samples.shape == (50000,)
+    assert samples.dtype == torch.long
+    frequencies = torch.bincount(samples, minlength=5).float() / len(samples)
+    assert torch.allclose(frequencies, torch.softmax(logits[0].detach(), dim=-1), atol=0.01)
+
+
+def test_electra_sampling_only_changes_masked_tokens():
+    torch.manual_seed(0)
+    generator_config, discriminator_config = get_electra_configs()
+    model = ElectraForLanguageModelingModel(
+        discriminator_config, generator_config=generator_config, discriminator_config=discriminator_config
+    )
+    inputs = torch.randint(5, 20, (4, 12))
+    masked_lm_labels = torch.full_like(inputs, -100)
+    mask = torch.rand(inputs.shape) < 0.3
+    masked_lm_labels[mask] = inputs[mask]
+    inputs[mask] = 4
+
+    g_loss, d_loss, g_scores, d_scores, d_labels = model(inputs, masked_lm_labels)
+
+    assert g_scores.shape == (4, 12, 20)
+    assert d_scores.shape == (4, 12)
+    # Only masked tokens can be labeled as replaced
+    assert not d_labels[~mask].any()
+    assert torch.isfinite(g_loss) and torch.isfinite(d_loss)
+
+    with pytest.raises(ValueError):
+        ElectraForLanguageModelingModel(discriminator_config, sampling="argmax")
+
+
+def test_electra_tied_embeddings():
+    generator_config, discriminator_config = get_electra_configs()
+    model = ElectraForLanguageModelingModel(
+        discriminator_config,
+        generator_config=generator_config,
+        discriminator_config=discriminator_config,
+        tie_generator_and_discriminator_embeddings=True,
+    )
+
+    discriminator_embeddings = model.discriminator_model.electra.embeddings
+    assert model.generator_model.electra.embeddings is discriminator_embeddings
+    assert model.generator_model.get_output_embeddings().weight is discriminator_embeddings.word_embeddings.weight
+    # Shared parameters are only counted once
+    n_parameters = sum(p.numel() for p in model.parameters())
+    untied_model = ElectraForLanguageModelingModel(
+        discriminator_config, generator_config=generator_config, discriminator_config=discriminator_config
+    )
+    embedding_parameters = sum(p.numel() for p in discriminator_embeddings.parameters())
+    assert sum(p.numel() for p in untied_model.parameters()) - n_parameters == embedding_parameters
+
+    # Both models are trained through the shared embeddings
+    inputs = torch.randint(5, 20, (2, 8))
+    masked_lm_labels = torch.full_like(inputs, -100)
+    masked_lm_labels[:, 3] = inputs[:, 3]
+    g_loss, d_loss, _, _, _ = model(inputs, masked_lm_labels)
+    g_loss.backward()
+    assert discriminator_embeddings.word_embeddings.weight.grad is not None
+
+    with pytest.raises(ValueError):
+        generator_config, discriminator_config = get_electra_configs(generator_embedding_size=4)
+        ElectraForLanguageModelingModel(
+            discriminator_config,
+            generator_config=generator_config,
+            discriminator_config=discriminator_config,
+            tie_generator_and_discriminator_embeddings=True,
+        )
+
+
+def test_truncate_batch():
+    # [CLS] tokens [SEP] padding, with 0 as the padding token
+    inputs = torch.tensor([[2, 5, 6, 7, 8, 9, 3], [2, 5, 6, 3, 0, 0, 0], [2, 5, 6, 7, 8, 3, 0]])
+    labels = torch.tensor([[-100, 5, -100, -100, -100, 9, -100], [-100] * 7, [-100, -100, 6, -100, -100, -100, -100]])
+
+    assert truncate_batch(inputs, 7, labels)[0] is inputs
+    assert truncate_batch(inputs, 10, labels)[0] is inputs
+
+    truncated_inputs, truncated_labels = truncate_batch(inputs, 4, labels)
+    assert torch.equal(truncated_inputs, inputs[:, :4])
+    assert torch.equal(truncated_labels, labels[:, :4])
+
+    # The [SEP] token of sequences longer than block_size replaces their token at position block_size - 1
+    truncated_inputs, truncated_labels = truncate_batch(inputs, 4, labels, pad_token_id=0, keep_last_token=True)
+    assert truncated_inputs.tolist() == [[2, 5, 6, 3], [2, 5, 6, 3], [2, 5, 6, 3]]
+    assert truncated_labels.tolist() == [[-100, 5, -100, -100], [-100] * 4, [-100, -100, 6, -100]]
+
+    # Without a padding token, every sequence is assumed to fill the batch
+    truncated_inputs, _ = truncate_batch(inputs, 4, keep_last_token=True)
+    assert truncated_inputs.tolist() == [[2, 5, 6, 3], [2, 5, 6, 0], [2, 5, 6, 0]]
+
+
+def test_truncate_batch_masked_padding_token():
+    inputs = torch.tensor([[2, 5, 6, 7, 3, 0, 0]])
+    # The last token before [SEP] was masked and replaced with the padding token id
+    masked_inputs = torch.tensor([[2, 5, 6, 0, 3, 0, 0]])
+    labels = torch.tensor([[-100, -100, -100, 7, -100, -100, -100]])
+
+    truncated_inputs, truncated_labels = truncate_batch(masked_inputs, 3, labels, pad_token_id=0, keep_last_token=True)
+
+    assert truncated_inputs.tolist() == [[2, 5, 3]]
+    assert truncated_labels.tolist() == [[-100, -100, -100]]
+    assert truncate_batch(inputs, 3, pad_token_id=0, keep_last_token=True)[0].tolist() == [[2, 5, 3]]
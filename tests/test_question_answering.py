@@ -1,7 +1,115 @@
+import copy
 import json
 import os
+import random
 
-from simpletransformers.question_answering import QuestionAnsweringModel
+import numpy as np
+import pytest
+from simpletransformers.question_answering import QuestionAnsweringModel, question_answering_utils
+from simpletransformers.question_answering.question_answering_utils import (
+    RawResult,
+    RawResultArrays,
+    _align_context_tokens,
+    _get_all_predictions,
+    _get_answer_token_span,
+    _get_valid_spans,
+    _improve_answer_span,
+    convert_examples_to_features,
+    get_examples,
+)
+from simpletransformers.tokenization_pool import TokenizationPool
+from tokenizers import BertWordPieceTokenizer
+from transformers import BertTokenizer
+
+TINY_VOCAB = (
+    "the year was born john smith ( ) - . , 18 ##95 19 ##43 japan ##ese leader what ? electronics industry is large"
+    " ##st in world a ##b ##c b c"
+).split()
+CONTEXT_WORDS = (
+    "The leader was John Smith (1895-1943). Japanese electronics industry is the largest in world, abc zzz JAPAN"
+).split()
+
+
+@pytest.fixture(scope="module")
+def tokenizer_dir(tmp_path_factory):
+    tokenizer_dir = tmp_path_factory.mktemp("tiny_bert_tokenizer")
+    with open(str(tokenizer_dir / "vocab.txt"), "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + TINY_VOCAB))
+    return tokenizer_dir
+
+
+@pytest.fixture(scope="module")
+def bert_tokenizer(tokenizer_dir):
+    return BertTokenizer.from_pretrained(str(tokenizer_dir))
+
+
+@pytest.fixture(scope="module")
+def encode_context(tokenizer_dir):
+    # Encodes doc_tokens with their character offsets, as _encode_contexts() does with a fast tokenizer
+    fast_tokenizer = BertWordPieceTokenizer(str(tokenizer_dir / "vocab.txt"), lowercase=True)
+
+    def encode(doc_tokens):
+        encoding = fast_tokenizer.encode(" ".join(doc_tokens), add_special_tokens=False)
+        return encoding.ids, encoding.offsets
+
+    return encode
+
+
+def get_qa_data(n_contexts=40, seed=0):
+    # Contexts of random lengths with several questions each, some of them impossible
+    rng = random.Random(seed)
+    data = []
+    for context_index in range(n_contexts):
+        words = [rng.choice(CONTEXT_WORDS) for _ in range(rng.randint(3, 60))]
+        qas = []
+        for question_index in range(rng.randint(1, 5)):
+            answer_word = rng.randrange(len(words))
+            answer_end = min(answer_word + rng.randint(1, 3), len(words))
+            is_impossible = rng.random() < 0.1
+            answer = {
+                "text": " ".join(words[answer_word:answer_end]),
+                "answer_start": sum(len(word) + 1 for word in words[:answer_word]),
+            }
+            qas.append(
+                {
+                    "id": "{}-{}".format(context_index, question_index),
+                    "question": " ".join(rng.choice(CONTEXT_WORDS) for _ in range(rng.randint(1, 12))),
+                    "is_impossible": is_impossible,
+                    "answers": [] if is_impossible else [answer],
+                }
+            )
+        data.append({"context": " ".join(words), "qas": qas})
+    return data
+
+
+def get_qa_features(tokenizer, seed=0):
+    examples = get_examples(get_qa_data(seed=seed), is_training=False)
+    features = convert_examples_to_features(
+        examples,
+        tokenizer,
+        max_seq_length=32,
+        doc_stride=8,
+        max_query_length=8,
+        is_training=False,
+        use_multiprocessing=False,
+        silent=True,
+    )
+    return examples, features
+
+
+def get_random_logits(features, ties, seed=0):
+    rng = np.random.RandomState(seed)
+    start_logits, end_logits = rng.randn(2, len(features), 32).astype(np.float32)
+    if ties:
+        # Few distinct values, so that many logits and span scores are tied
+        start_logits, end_logits = np.round(start_logits), np.round(end_logits)
+    return start_logits, end_logits
+
+
+def assert_same_features(features, expected_features):
+    assert len(features) == len(expected_features)
+    for feature, expected_feature in zip(features, expected_features):
+        assert vars(feature) == vars(expected_feature)
 
 
 def test_question_answering():
@@ -69,3 +177,246 @@ def test_question_answering():
     ]
 
     model.predict(to_predict)
+
+
+@pytest.mark.parametrize("is_training", [True, False])
+def test_convert_examples_to_features_multiprocessing(bert_tokenizer, is_training, monkeypatch):
+    examples = get_examples(get_qa_data(), is_training=is_training)
+    conversion_args = {
+        "max_seq_length": 32,
+        "doc_stride": 8,
+        "max_query_length": 8,
+        "is_training": is_training,
+        "silent": True,
+    }
+
+    # Direct calls convert in this process by default
+    with monkeypatch.context() as patch:
+        patch.setattr(question_answering_utils, "Pool", None)
+        features = convert_examples_to_features(examples, bert_tokenizer, **conversion_args)
+
+    # The features, and their unique_ids, do not depend on how the contexts are split between processes
+    assert [feature.unique_id for feature in features] == list(range(1000000000, 1000000000 + len(features)))
+    assert_same_features(
+        convert_examples_to_features(
+            examples, bert_tokenizer, process_count=2, chunksize=3, use_multiprocessing=True, **conversion_args
+        ),
+        features,
+    )
+    with TokenizationPool() as pool:
+        assert_same_features(
+            convert_examples_to_features(
+                examples, bert_tokenizer, process_count=2, use_multiprocessing=True, pool=pool, **conversion_args
+            ),
+            features,
+        )
+    # At least one process is used, whatever the number of CPUs
+    assert_same_features(
+        convert_examples_to_features(
+            examples, bert_tokenizer, process_count=0, use_multiprocessing=True, **conversion_args
+        ),
+        features,
+    )
+
+
+@pytest.mark.parametrize("is_training", [True, False])
+def test_convert_examples_to_features_once_per_context(bert_tokenizer, is_training, monkeypatch):
+    data = get_qa_data()
+    examples = get_examples(data, is_training=is_training)
+    # Examples which do not share their doc_tokens are converted separately, as they were before contexts were grouped
+    separate_examples = [copy.copy(example) for example in examples]
+    for example in separate_examples:
+        example.doc_tokens = list(example.doc_tokens)
+    conversion_args = {
+        "max_seq_length": 32,
+        "doc_stride": 8,
+        "max_query_length": 8,
+        "is_training": is_training,
+        "use_multiprocessing": False,
+        "silent": True,
+    }
+
+    tokenize_calls = []
+    tokenize = bert_tokenizer.tokenize
+    monkeypatch.setattr(bert_tokenizer, "tokenize", lambda text: tokenize_calls.append(text) or tokenize(text))
+
+    features = convert_examples_to_features(examples, bert_tokenizer, **conversion_args)
+    context_tokenize_calls = len(tokenize_calls) - len(examples)
+    del tokenize_calls[:]
+    separate_features = convert_examples_to_features(separate_examples, bert_tokenizer, **conversion_args)
+    separate_context_tokenize_calls = len(tokenize_calls) - len(separate_examples)
+
+    assert_same_features(features, separate_features)
+    if not is_training:
+        # Each word of a context is tokenized once for all of its questions (answers are tokenized too in training)
+        assert context_tokenize_calls == sum(len(paragraph["context"].split()) for paragraph in data)
+        assert separate_context_tokenize_calls == sum(len(example.doc_tokens) for example in examples)
+
+
+def get_valid_spans_loop(feature, start_logits, end_logits, n_best_size, max_answer_length):
+    # The span search as nested loops over the best start and end indexes
+    start_indexes = [i for i, _ in sorted(enumerate(start_logits), key=lambda x: x[1], reverse=True)][:n_best_size]
+    end_indexes = [i for i, _ in sorted(enumerate(end_logits), key=lambda x: x[1], reverse=True)][:n_best_size]
+    spans = []
+    for start_index in start_indexes:
+        for end_index in end_indexes:
+            if start_index >= len(feature.tokens) or end_index >= len(feature.tokens):
+                continue
+            if start_index not in feature.token_to_orig_map or end_index not in feature.token_to_orig_map:
+                continue
+            if not feature.token_is_max_context.get(start_index, False):
+                continue
+            if end_index < start_index or end_index - start_index + 1 > max_answer_length:
+                continue
+            spans.append((start_index, end_index))
+    return spans
+
+
+@pytest.mark.parametrize("ties", [False, True])
+@pytest.mark.parametrize("n_best_size, max_answer_length", [(20, 30), (5, 3)])
+def test_valid_spans(bert_tokenizer, ties, n_best_size, max_answer_length):
+    examples, features = get_qa_features(bert_tokenizer)
+    start_logits, end_logits = get_random_logits(features, ties)
+
+    for feature, feature_start_logits, feature_end_logits in zip(features, start_logits, end_logits):
+        start_indexes, end_indexes, scores = _get_valid_spans(
+            feature, feature_start_logits, feature_end_logits, n_best_size, max_answer_length
+        )
+        expected = get_valid_spans_loop(
+            feature, feature_start_logits.tolist(), feature_end_logits.tolist(), n_best_size, max_answer_length
+        )
+        assert list(zip(start_indexes.tolist(), end_indexes.tolist())) == expected
+        assert scores.tolist() == [feature_start_logits[i] + feature_end_logits[j] for i, j in expected]
+
+
+@pytest.mark.parametrize("ties", [False, True])
+@pytest.mark.parametrize("version_2_with_negative", [False, True])
+def test_all_predictions_multiprocessing(bert_tokenizer, ties, version_2_with_negative):
+    examples, features = get_qa_features(bert_tokenizer)
+    results = RawResultArrays(*get_random_logits(features, ties))
+    prediction_args = (20, 30, True, False, version_2_with_negative, 0.0)
+
+    predictions = _get_all_predictions(examples, features, results, *prediction_args)
+    parallel_predictions = _get_all_predictions(
+        examples, features, results, *prediction_args, process_count=2, chunksize=10
+    )
+
+    assert parallel_predictions == predictions
+    assert list(predictions[0]) == [example.qas_id for example in examples]
+    if not version_2_with_negative:
+        assert all(prediction == predictions[1][qas_id][0]["text"] for qas_id, prediction in predictions[0].items())
+
+
+@pytest.mark.parametrize("ties", [False, True])
+@pytest.mark.parametrize("version_2_with_negative", [False, True])
+def test_all_predictions_raw_result_arrays(bert_tokenizer, ties, version_2_with_negative):
+    examples, features = get_qa_features(bert_tokenizer)
+    start_logits, end_logits = get_random_logits(features, ties)
+    prediction_args = (20, 30, True, False, version_2_with_negative, 0.0)
+
+    # A list of RawResults, in any order, gives the same predictions as the logits arrays in feature order
+    results = [
+        RawResult(unique_id=feature.unique_id, start_logits=start.tolist(), end_logits=end.tolist())
+        for feature, start, end in zip(features, start_logits, end_logits)
+    ]
+    random.Random(0).shuffle(results)
+
+    assert _get_all_predictions(examples, features, results, *prediction_args) == _get_all_predictions(
+        examples, features, RawResultArrays(start_logits, end_logits), *prediction_args
+    )
+
+
+def align_context_tokens_loop(doc_tokens, tokenizer):
+    # The alignment of the slow tokenizers, which tokenize each word separately
+    all_doc_tokens, tok_to_orig_index, orig_to_tok_index = [], [], []
+    for i, token in enumerate(doc_tokens):
+        orig_to_tok_index.append(len(all_doc_tokens))
+        for sub_token in tokenizer.tokenize(token):
+            tok_to_orig_index.append(i)
+            all_doc_tokens.append(sub_token)
+    return all_doc_tokens, tok_to_orig_index, orig_to_tok_index
+
+
+def get_answer_token_span(example, tokenizer, encode_context):
+    _, _, _, token_char_spans, word_starts = _align_context_tokens(
+        example.doc_tokens, encode_context(example.doc_tokens), tokenizer
+    )
+    token_starts, token_ends = np.array(token_char_spans, dtype=np.int64).reshape(-1, 2).T
+    return _get_answer_token_span(example, word_starts, token_starts, token_ends)
+
+
+def test_align_context_tokens(bert_tokenizer, encode_context):
+    for example in get_examples(get_qa_data(), is_training=True):
+        doc_tokens = example.doc_tokens
+        all_doc_tokens, tok_to_orig_index, orig_to_tok_index, token_char_spans, word_starts = _align_context_tokens(
+            doc_tokens, encode_context(doc_tokens), bert_tokenizer
+        )
+
+        assert (all_doc_tokens, tok_to_orig_index, orig_to_tok_index) == align_context_tokens_loop(
+            doc_tokens, bert_tokenizer
+        )
+        context = " ".join(doc_tokens)
+        assert [context[start : start + len(word)] for start, word in zip(word_starts, doc_tokens)] == doc_tokens
+        # Each token is a piece of the word it belongs to
+        for token, orig_index, (start, end) in zip(all_doc_tokens, tok_to_orig_index, token_char_spans):
+            word_start = word_starts[orig_index]
+            assert word_start <= start < end <= word_start + len(doc_tokens[orig_index])
+            assert token in ["[UNK]", context[start:end].lower(), "##" + context[start:end].lower()]
+
+
+def test_answer_token_span(bert_tokenizer, encode_context):
+    for example in get_examples(get_qa_data(), is_training=True):
+        if example.is_impossible:
+            continue
+        # The answers are whole words, whose tokens are the same as those found by the slow tokenizers
+        all_doc_tokens, _, orig_to_tok_index = align_context_tokens_loop(example.doc_tokens, bert_tokenizer)
+        if example.end_position < len(example.doc_tokens) - 1:
+            tok_end_position = orig_to_tok_index[example.end_position + 1] - 1
+        else:
+            tok_end_position = len(all_doc_tokens) - 1
+        assert get_answer_token_span(example, bert_tokenizer, encode_context) == _improve_answer_span(
+            all_doc_tokens,
+            orig_to_tok_index[example.start_position],
+            tok_end_position,
+            bert_tokenizer,
+            example.orig_answer_text,
+        )
+
+
+@pytest.mark.parametrize(
+    "answer_text, expected_tokens",
+    [
+        ("1895", ["18", "##95"]),
+        ("1943", ["19", "##43"]),
+        ("(1895-1943).", ["(", "18", "##95", "-", "19", "##43", ")", "."]),
+        ("Smith", ["smith"]),
+        ("Japanese electronics", ["japan", "##ese", "electronics"]),
+    ],
+)
+def test_answer_token_span_inside_words(bert_tokenizer, encode_context, answer_text, expected_tokens):
+    # Answers which only cover part of a word are aligned to the tokens of that part
+    context = " ".join(CONTEXT_WORDS)
+    data = [
+        {
+            "context": context,
+            "qas": [
+                {
+                    "id": "0",
+                    "question": "what year?",
+                    "is_impossible": False,
+                    "answers": [{"text": answer_text, "answer_start": context.index(answer_text)}],
+                }
+            ],
+        }
+    ]
+    example = get_examples(data, is_training=True)[0]
+    all_doc_tokens = _align_context_tokens(example.doc_tokens, encode_context(example.doc_tokens), bert_tokenizer)[0]
+
+    tok_start_position, tok_end_position = get_answer_token_span(example, bert_tokenizer, encode_context)
+    assert all_doc_tokens[tok_start_position : tok_end_position + 1] == expected_tokens
+
+
+def test_answer_token_span_not_found(bert_tokenizer, encode_context):
+    example = get_examples(get_qa_data(n_contexts=1), is_training=True)[0]
+    example.orig_answer_text = "not in the context"
+    assert get_answer_token_span(example, bert_tokenizer, encode_context) is None